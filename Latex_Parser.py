@@ -1,7 +1,10 @@
 ##Functions
 import json
 import re
+from bisect import bisect_right
 from pyparsing import Forward, Combine, SkipTo, Regex, Suppress, White, Located, nestedExpr, Or
+from instrumentation import traced, count, span
+from document_model import Equation, Table, Figure, Section, LatexDocument, table_rows_dict, figure_value
 
 #Equations
 def extract_math_equations(latex_code):
@@ -66,25 +69,188 @@ def extract_math_equations(latex_code):
             equations.append('\\begin{aligned}' + result[0].align.strip() + '\\end{aligned}')
     return equations
 
-def latex_to_equations_json(latex_code):
+# Single pass replacement for extract_math_equations. Openers are tried in the
+# same order as the pyparsing alternatives above, and closers are looked up with
+# a forward-only cache so unmatched openers do not rescan the rest of the text.
+MATH_OPENER = re.compile(
+    r'\$|\\\[|\\begin\{(displaymath|math|equation\*?|eqnarray\*?|aligned\*|gathered\*?|array\*?|align\*?)\}'
+)
+MATH_ENV_WRAPPERS = {
+    'displaymath': None,
+    'math': None,
+    'equation': None,
+    'equation*': None,
+    'eqnarray': 'eqnarray',
+    'eqnarray*': 'eqnarray',
+    'aligned*': 'aligned',
+    'gathered': 'gathered',
+    'gathered*': 'gathered',
+    'array': 'array',
+    'array*': 'array',
+    'align': 'aligned',
+    'align*': 'aligned',
+}
+PYPARSING_WHITESPACE = ' \t\n\r'
+
+class ForwardFinder:
+    # str.find with memory: scan positions only ever move forward, so a cached
+    # hit (or miss) stays valid until the scan passes it.
+    def __init__(self, text):
+        self.text = text
+        self.cache = {}
+
+    def find(self, closer, start):
+        cached = self.cache.get(closer)
+        if cached is not None:
+            searched_from, found = cached
+            if searched_from <= start and (found == -1 or found >= start):
+                return found
+        found = self.text.find(closer, start)
+        self.cache[closer] = (start, found)
+        return found
+
+    def find_unescaped_dollar(self, start):
+        # Same rule as SkipTo('$', ignore=r'\$'): a dollar preceded by a
+        # backslash does not close inline math.
+        cached = self.cache.get('unescaped $')
+        if cached is not None:
+            searched_from, found = cached
+            if searched_from <= start and (found == -1 or found >= start):
+                return found
+        text = self.text
+        pos = text.find('$', start)
+        while pos > start and text[pos - 1] == '\\':
+            pos = text.find('$', pos + 1)
+        self.cache['unescaped $'] = (start, pos)
+        return pos
+
+def scan_math_spans(latex_code):
+    # Returns (start, end, equation) for every equation scan_math_equations
+    # finds, offsets into latex_code once tabs are expanded
+    # scanString expands tabs before matching, keep the output identical
+    if '\t' in latex_code:
+        latex_code = latex_code.expandtabs()
+
+    finder = ForwardFinder(latex_code)
+    equations = []
+    pos = 0
+    while True:
+        match = MATH_OPENER.search(latex_code, pos)
+        if not match:
+            break
+        start = match.start()
+        opener = match.group(0)
+        env = match.group(1)
+        body = None
+        end = start + 1
+
+        if opener == '$':
+            if latex_code.startswith('$$', start):
+                close = finder.find('$$', start + 2)
+                if close != -1:
+                    body = latex_code[start + 2:close]
+                    end = close + 2
+                    if body.strip(PYPARSING_WHITESPACE):
+                        equations.append((start, end, body.strip()))
+                    pos = end
+                    continue
+            close = finder.find_unescaped_dollar(start + 1)
+            if close != -1:
+                body = latex_code[start + 1:close]
+                end = close + 1
+                if body.strip(PYPARSING_WHITESPACE):
+                    equations.append((start, end, body.strip()))
+        else:
+            closer = r'\]' if env is None else '\\end{' + env + '}'
+            close = finder.find(closer, match.end())
+            if close != -1:
+                body = latex_code[match.end():close]
+                end = close + len(closer)
+                if body.strip(PYPARSING_WHITESPACE):
+                    wrapper = MATH_ENV_WRAPPERS.get(env)
+                    if wrapper:
+                        equations.append((start, end, '\\begin{' + wrapper + '}' + body.strip() + '\\end{' + wrapper + '}'))
+                    else:
+                        equations.append((start, end, body.strip()))
+
+        pos = end if body is not None else start + 1
+    return equations
+
+def scan_math_equations(latex_code):
+    return [equation for _, _, equation in scan_math_spans(latex_code)]
+
+MATH_ENGINES = {
+    'scan': scan_math_equations,
+    'pyparsing': extract_math_equations,
+}
+
+def equation_entry(i, eq):
+    # Key and text of the i-th equation, keyed by its \label or \tag
+    label_match = re.search(r'\\label\{([^}]*)\}', eq)
+    tag_match = re.search(r'\\tag\{([^}]*)\}', eq)
+    if label_match:
+        return label_match.group(1), re.sub(r'\\label\{[^}]*\}', '', eq).strip()
+    if tag_match:
+        return tag_match.group(1), re.sub(r'\\tag\{[^}]*\}', '', eq).strip()
+    return f'equation_{i+1}', eq
+
+MATH_SOURCE_TOKEN = re.compile(r'\\\\\$|[\t\n\r]')
+
+def math_source(latex_code):
+    # The text the math engines see: \\$ replaced as in latex_to_equations_json
+    # and tabs expanded like scanString. Also returns (scanned, original)
+    # offset pairs at every replacement, or None when the text is unchanged.
+    if '\t' not in latex_code and '\\\\$' not in latex_code:
+        return latex_code, None
+    parts = []
+    anchors = [(0, 0)]
+    pos = 0
+    out = 0
+    line_start = 0
+    for match in MATH_SOURCE_TOKEN.finditer(latex_code):
+        parts.append(latex_code[pos:match.start()])
+        out += match.start() - pos
+        token = match.group(0)
+        if token == '\t':
+            token = ' ' * (8 - (out - line_start) % 8)
+        elif token == '\\\\$':
+            token = 'dollar'
+        parts.append(token)
+        out += len(token)
+        pos = match.end()
+        if token in '\n\r':
+            line_start = out
+        else:
+            anchors.append((out, pos))
+    parts.append(latex_code[pos:])
+    return ''.join(parts), anchors
+
+def original_offset(anchors, offset):
+    if anchors is None:
+        return offset
+    scanned, original = anchors[bisect_right(anchors, (offset, float('inf'))) - 1]
+    return original + offset - scanned
+
+def scan_equations(latex_code, offset=0):
+    # Equation records for latex_code, offsets shifted by offset
+    scanned, anchors = math_source(latex_code)
+    equations = []
+    for i, (start, end, eq) in enumerate(scan_math_spans(scanned)):
+        key, text = equation_entry(i, eq)
+        equations.append(Equation(key, text, offset + original_offset(anchors, start),
+                                  offset + original_offset(anchors, end)))
+    return equations
+
+@traced('parse.equations')
+def latex_to_equations_json(latex_code, engine='scan'):
     latex_code = re.sub(r'\\\\\$', 'dollar', latex_code)
 
-    equations = extract_math_equations(latex_code)
+    equations = MATH_ENGINES[engine](latex_code)
 
     equations_dict = {}
     for i, eq in enumerate(equations):
-        label_match = re.search(r'\\label\{([^}]*)\}', eq)
-        tag_match = re.search(r'\\tag\{([^}]*)\}', eq)
-        if label_match:
-            key = label_match.group(1)
-            value = re.sub(r'\\label\{[^}]*\}', '', eq)
-            equations_dict[key] = value.strip()
-        elif tag_match:
-            key = tag_match.group(1)
-            value = re.sub(r'\\tag\{[^}]*\}', '', eq)
-            equations_dict[key] = value.strip()
-        else:
-            equations_dict[f'equation_{i+1}'] = eq
+        key, value = equation_entry(i, eq)
+        equations_dict[key] = value
 
     # Convert the dictionary to JSON format
     equations_json = json.dumps(equations_dict, indent=4)
@@ -177,7 +343,7 @@ def extract_tables_dict(latex_code):
       tables_dict[key] = ' '.join(table)
   return tables_dict
 
-def extract_rows(latex_code):
+def extract_rows_pyparsing(latex_code):
     begin_tabular_pattern = re.compile(r'\\begin\{tabular\}')
     end_tabular_pattern = re.compile(r'\\end\{tabular\}')
     begin_table_pattern = re.compile(r'\\begin\{table\}')
@@ -241,6 +407,167 @@ def extract_rows(latex_code):
 
     return all_tables_dict
 
+# Single pass replacement for extract_tables/extract_rows. One regex walk over
+# the document keeps a stack of open table/tabular environments and hands
+# every \caption and \label to the innermost enclosing table, so nothing is
+# searched past the end of its own environment.
+# Unlike extract_rows_pyparsing, column names and cells are whitespace
+# stripped (pyparsing kept the surrounding spaces and newlines and the \\ of
+# the last row) and table rules are dropped from every cell; otherwise the
+# rows match, see tests/test_latex_parser.py.
+TABLE_TOKEN = re.compile(r'\\(begin|end)\{(table\*?|tabular\*?)\}|\\(caption|label)\{')
+TABULAR_CELL_TOKEN = re.compile(r'\\\\(?:\[[^\]]*\])?|\\(?:begin|end)\{tabular\*?\}|\\.|[{}&]', re.DOTALL)
+TABLE_RULES = re.compile(r'\\(?:hline|toprule|midrule|bottomrule)\b|\\cline\{[^}]*\}')
+TABLE_DESCRIPTION = re.compile(r'\s*\\end\{center\}\s*\n\n([^\n]*?)Table\s+\d+(\.\d+)?\s*:\s*([^\n]*)\n')
+
+def read_braced(latex_code, pos):
+    # latex_code[pos] is just past an opening brace, returns the group's text
+    # and the position after its closing brace
+    depth = 1
+    i = pos
+    n = len(latex_code)
+    while i < n:
+        c = latex_code[i]
+        if c == '\\':
+            i += 2
+            continue
+        if c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+            if depth == 0:
+                return latex_code[pos:i], i + 1
+        i += 1
+    return latex_code[pos:], n
+
+def skip_tabular_arguments(latex_code, pos, env):
+    # Skips [pos] and the column spec ({width}{spec} for tabular*)
+    groups = 2 if env == 'tabular*' else 1
+    n = len(latex_code)
+    while pos < n and latex_code[pos].isspace():
+        pos += 1
+    if latex_code.startswith('[', pos):
+        close = latex_code.find(']', pos)
+        pos = close + 1 if close != -1 else pos
+    for _ in range(groups):
+        while pos < n and latex_code[pos].isspace():
+            pos += 1
+        if latex_code.startswith('{', pos):
+            _, pos = read_braced(latex_code, pos + 1)
+    return pos
+
+def split_tabular(body):
+    # Splits a tabular body into rows of cells on top-level \\ and &, leaving
+    # braces, escaped characters and nested tabulars intact
+    rows = []
+    cells = []
+    cell_start = 0
+    depth = 0
+    for token in TABULAR_CELL_TOKEN.finditer(body):
+        text = token.group(0)
+        if text == '{' or text.startswith('\\begin'):
+            depth += 1
+        elif text == '}' or text.startswith('\\end'):
+            depth -= 1
+        elif depth == 0 and (text == '&' or text.startswith('\\\\')):
+            cells.append(body[cell_start:token.start()])
+            cell_start = token.end()
+            if text != '&':
+                rows.append(cells)
+                cells = []
+    cells.append(body[cell_start:])
+    rows.append(cells)
+
+    cleaned = []
+    for row in rows:
+        row = [TABLE_RULES.sub('', cell).strip() for cell in row]
+        if any(row):
+            cleaned.append(row)
+    return cleaned
+
+def scan_tables(latex_code):
+    # Returns one record per outermost tabular with its rows, source offsets
+    # and the caption/label of the enclosing table environment
+    stack = []
+    tables = []
+    pos = 0
+    while True:
+        match = TABLE_TOKEN.search(latex_code, pos)
+        if not match:
+            break
+        pos = match.end()
+        action, env, command = match.group(1), match.group(2), match.group(3)
+
+        if command:
+            text, pos = read_braced(latex_code, pos)
+            for entry in reversed(stack):
+                if entry['env'].startswith('table') and not entry['env'].startswith('tabular'):
+                    entry.setdefault(command, text)
+                    break
+        elif action == 'begin':
+            stack.append({'env': env, 'start': match.start(), 'body_start': match.end(), 'tabulars': []})
+        else:
+            # Close the innermost matching environment, dropping unbalanced ones
+            while stack and stack[-1]['env'] != env:
+                stack.pop()
+            if not stack:
+                continue
+            entry = stack.pop()
+            if env.startswith('tabular'):
+                if any(open_env['env'].startswith('tabular') for open_env in stack):
+                    continue
+                body_start = skip_tabular_arguments(latex_code, entry['body_start'], env)
+                record = {
+                    'start': entry['start'],
+                    'end': match.end(),
+                    'rows': split_tabular(latex_code[body_start:match.start()]),
+                    'caption': None,
+                    'label': None,
+                    'description': None,
+                }
+                parent = next((open_env for open_env in reversed(stack) if open_env['env'].startswith('table')
+                               and not open_env['env'].startswith('tabular')), None)
+                if parent is not None:
+                    parent['tabulars'].append(record)
+                else:
+                    description = TABLE_DESCRIPTION.match(latex_code, match.end())
+                    if description:
+                        record['description'] = description.group(3)
+                tables.append(record)
+            else:
+                for record in entry['tabulars']:
+                    record['caption'] = entry.get('caption')
+                    record['label'] = entry.get('label')
+
+    for record in tables:
+        record['name'] = create_table_name(record['caption'], record['label'], record['description'])
+    return tables
+
+def table_records(latex_code, offset=0):
+    # Table records for latex_code with unique names, offsets shifted by offset
+    tables = []
+    names = set()
+    for i, record in enumerate(scan_tables(latex_code)):
+        name = record['name'] if record['name'] else f'table_{i+1}'
+        if name in names:
+            name = f'{name}_{i+1}'
+        names.add(name)
+        tables.append(Table(name, record['caption'], record['label'], record['rows'],
+                            offset + record['start'], offset + record['end']))
+    return tables
+
+def scan_rows(latex_code):
+    return {table.name: table_rows_dict(table.rows) for table in table_records(latex_code)}
+
+TABLE_ENGINES = {
+    'scan': scan_rows,
+    'pyparsing': extract_rows_pyparsing,
+}
+
+@traced('parse.tables')
+def extract_rows(latex_code, engine='scan'):
+    return TABLE_ENGINES[engine](latex_code)
+
 ###############################################################
 # Images captions
 
@@ -257,7 +584,7 @@ def extract_images(latex_code):
             images.append(result[0].image.strip())
     return images
 
-def extract_image_captions(latex_code):
+def extract_image_captions_pyparsing(latex_code):
     captions_dict = {}
     images = extract_images(latex_code)
     counter = len(images)
@@ -307,7 +634,127 @@ def extract_image_captions(latex_code):
     captions_dict = json.dumps(captions_dict, indent=4)
     return captions_dict
 
+# Single pass replacement for extract_images/extract_image_captions. Figure
+# environments are recorded as (start, end) spans once, every \includegraphics
+# is then placed inside or outside a span with a bisect over the span starts,
+# and captions and labels are searched only within their own span.
+# Like the pyparsing engine, environments with an empty body are not
+# numbered and a graphic outside the environments gets no entry of its own
+# when the same file is included in one. Unlike it, that is decided by file
+# name, not by the name occurring anywhere in a figure's text (a.png is no
+# longer hidden by data.png or by a mention of a.png in some figure).
+FIGURE_BEGIN = re.compile(r'\\begin\{(figure\*?|image)\}')
+FIGURE_GRAPHICS = re.compile(r'\\includegraphics(?:\[[^\]]*\])?\{([^}]+)\}')
+FIGURE_CENTER_SENTENCE = re.compile(r'\s*\\end\{center\}\s*Figure\s*([^\n]+)\n')
+FIGURE_CAPTION = re.compile(r'\\caption\{(.+?)\}')
+FIGURE_LABEL = re.compile(r'\\label\{(.+?)\}')
+FIGURE_CAPTION_NEST_LABEL = re.compile(r'\\caption\{\\label\{([^}]*)\}(.+?)\}')
+
+def scan_figure_spans(latex_code):
+    # (start, body start, body end, end) of figure, figure* and image
+    # environments, closed by the first matching \end like the pyparsing SkipTo
+    spans = []
+    pos = 0
+    while True:
+        match = FIGURE_BEGIN.search(latex_code, pos)
+        if not match:
+            return spans
+        closer = '\\end{%s}' % match.group(1)
+        end = latex_code.find(closer, match.end())
+        if end == -1:
+            pos = match.end()
+            continue
+        spans.append((match.start(), match.end(), end, end + len(closer)))
+        pos = end
+
+def figure_span_captions(latex_code, start, end):
+    captions = {}
+    nested = FIGURE_CAPTION_NEST_LABEL.findall(latex_code, start, end)
+    if nested:
+        for label, caption in nested:
+            captions[label] = caption
+        return captions
+    caption_matches = list(FIGURE_CAPTION.finditer(latex_code, start, end))
+    for j, caption_match in enumerate(caption_matches):
+        next_caption_start = caption_matches[j + 1].start() if j < len(caption_matches) - 1 else end
+        label_match = FIGURE_LABEL.search(latex_code, caption_match.end(), next_caption_start)
+        if label_match:
+            captions[label_match.group(1)] = caption_match.group(1)
+        else:
+            captions[f"subfig_{j+1}"] = caption_match.group(1)
+    return captions
+
+def scan_figures(latex_code, offset=0):
+    # Figure records for latex_code, offsets shifted by offset
+    spans = scan_figure_spans(latex_code)
+    span_starts = [body_start for _, body_start, _, _ in spans]
+    span_graphics = [[] for _ in spans]
+
+    # \includegraphics followed by \end{center} and a "Figure ..." sentence
+    # keys the sentence by file name, any other graphic outside a figure
+    # environment gets its own figure_{n} entry
+    sentences = {}
+    strays = []
+    for match in FIGURE_GRAPHICS.finditer(latex_code):
+        graphics = match.group(1)
+        index = bisect_right(span_starts, match.start()) - 1
+        inside = index >= 0 and match.start() < spans[index][2]
+        if inside:
+            span_graphics[index].append(graphics)
+        sentence = FIGURE_CENTER_SENTENCE.match(latex_code, match.end())
+        if sentence:
+            sentences[graphics] = Figure(graphics, 'sentence', [graphics], {}, sentence.group(1).strip(),
+                                         offset + match.start(), offset + sentence.end())
+        elif not inside:
+            strays.append(match)
+
+    figures = []
+    for i, (start, body_start, body_end, end) in enumerate(spans):
+        if not latex_code[body_start:body_end].strip():
+            continue
+        figures.append(Figure(f"figure_{len(figures)+1}", 'figure', span_graphics[i],
+                              figure_span_captions(latex_code, body_start, body_end), None,
+                              offset + start, offset + end))
+    counter = len(figures)
+    figures.extend(sentences.values())
+
+    keys = {figure.key for figure in figures}
+    keys.update(graphics for span in span_graphics for graphics in span)
+    for match in strays:
+        graphics = match.group(1)
+        if graphics not in keys:
+            counter += 1
+            figures.append(Figure(f'figure_{counter}', 'graphic', [graphics], {}, graphics,
+                                  offset + match.start(), offset + match.end()))
+            keys.add(f'figure_{counter}')
+    return figures
+
+def scan_image_captions(latex_code):
+    captions_dict = {}
+    for figure in scan_figures(latex_code):
+        captions_dict[figure.key] = figure_value(figure)
+    return json.dumps(captions_dict, indent=4)
+
+FIGURE_ENGINES = {
+    'scan': scan_image_captions,
+    'pyparsing': extract_image_captions_pyparsing,
+}
+
+@traced('parse.figures')
+def extract_image_captions(latex_code, engine='scan'):
+    return FIGURE_ENGINES[engine](latex_code)
+
 #Extract title, author name, date 
+def content_span(latex_code):
+    # Offsets of what extract_content returns
+    match = re.search(r'\\begin\{document\}(.*?)\\end\{document\}', latex_code, re.DOTALL)
+    if not match:
+        return 0, len(latex_code)
+    body = match.group(1)
+    stripped = body.lstrip()
+    start = match.start(1) + len(body) - len(stripped)
+    return start, start + len(stripped.rstrip())
+
 def extract_content(latex_code):
     pattern = r'\\begin\{document\}(.*?)\\end\{document\}'
     
@@ -333,16 +780,89 @@ def extract_title(latex_code):
 
     return results
 
-def create_json_object(latex_code):
+#Sections
+SECTION_LEVELS = {
+    'part': 0,
+    'chapter': 1,
+    'section': 2,
+    'subsection': 3,
+    'subsubsection': 4,
+    'paragraph': 5,
+}
+SECTION_COMMAND = re.compile(r'\\(part|chapter|section|subsection|subsubsection|paragraph)\*?\s*(?:\[[^\]]*\])?\s*\{')
+
+def scan_sections(latex_code, offset=0):
+    # Section records, each one ends where the next section of the same or a
+    # higher level starts
+    headings = []
+    for match in SECTION_COMMAND.finditer(latex_code):
+        title, _ = read_braced(latex_code, match.end())
+        headings.append((SECTION_LEVELS[match.group(1)], ' '.join(title.split()), match.start()))
+
+    sections = []
+    open_sections = []  # indices into sections, outermost first
+    for level, title, start in headings:
+        while open_sections and sections[open_sections[-1]].level >= level:
+            closed = open_sections.pop()
+            sections[closed] = sections[closed]._replace(end=offset + start)
+        open_sections.append(len(sections))
+        sections.append(Section(level, title, offset + start, offset + len(latex_code)))
+    return sections
+
+def parse_latex_content(content, offset=0):
+    # Equation, table, figure and section records of a document body,
+    # offsets shifted by offset
+    with span('parse.equations'):
+        equations = scan_equations(content, offset)
+    with span('parse.tables'):
+        tables = table_records(content, offset)
+    with span('parse.figures'):
+        figures = scan_figures(content, offset)
+    with span('parse.sections'):
+        sections = scan_sections(content, offset)
+    return equations, tables, figures, sections
+
+@traced('parse')
+def parse_latex_document(latex_code):
+    # Typed counterpart of create_json_object, see document_model.py
+    count('documents')
+    count('parsed_bytes', len(latex_code))
+    commands = extract_title(latex_code)
+    content_start, content_end = content_span(latex_code)
+    document_content = latex_code[content_start:content_end]
+    equations, tables, figures, sections = parse_latex_content(document_content, content_start)
+
+    return LatexDocument(
+        title=commands['title'],
+        author=commands['author'],
+        date=commands['date'],
+        content=document_content,
+        content_start=content_start,
+        content_byte_start=len(latex_code[:content_start].encode('utf-8')),
+        equations=equations,
+        tables=tables,
+        figures=figures,
+        sections=sections,
+    )
+
+def create_json_object(latex_code, engine='scan'):
+    if engine == 'scan':
+        return parse_latex_document(latex_code).to_json_object()
+    return create_json_object_pyparsing(latex_code)
+
+@traced('parse')
+def create_json_object_pyparsing(latex_code):
+    count('documents')
+    count('parsed_bytes', len(latex_code))
     # Extract the title, author, and date
     commands = extract_title(latex_code)
     
     # Extract content between \begin{document} and \end{document}
     document_content = extract_content(latex_code)
     
-    equations_json = latex_to_equations_json(document_content)
-    rows_dict = extract_rows(document_content)
-    image_dict = extract_image_captions(document_content)
+    equations_json = latex_to_equations_json(document_content, engine='pyparsing')
+    rows_dict = extract_rows(document_content, engine='pyparsing')
+    image_dict = extract_image_captions(document_content, engine='pyparsing')
 
     json_object = {
         "Title": commands['title'],
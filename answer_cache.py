@@ -0,0 +1,100 @@
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from instrumentation import count
+
+class SemanticAnswerCache:
+    # Answers keyed by query embedding. A lookup returns the stored answer of
+    # the most similar previous query if its cosine similarity reaches the
+    # threshold. Entries expire after ttl seconds, the least recently used
+    # entry is dropped when the cache is full, and everything is dropped when
+    # version_fn() (the index version) changes.
+    def __init__(self, embeddings, threshold=0.95, max_entries=1000, ttl=24 * 3600, version_fn=None):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.version_fn = version_fn
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._version = version_fn() if version_fn else None
+        self._matrix = None
+        self._entries = OrderedDict()  # slot -> (namespace, answer, created), in LRU order
+        self._free_slots = list(range(max_entries - 1, -1, -1))
+
+    def _embed(self, query, vector=None):
+        # vector is the query embedding when the caller already has it
+        if vector is None:
+            vector = self.embeddings.embed_query(query)
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _check_version(self):
+        if self.version_fn is None:
+            return
+        version = self.version_fn()
+        if version != self._version:
+            self._clear()
+            self._version = version
+
+    def _clear(self):
+        self._entries.clear()
+        self._free_slots = list(range(self.max_entries - 1, -1, -1))
+
+    def _drop(self, slot):
+        del self._entries[slot]
+        self._free_slots.append(slot)
+
+    def _expire(self, now):
+        expired = [slot for slot, (_, _, created) in self._entries.items() if now - created > self.ttl]
+        for slot in expired:
+            self._drop(slot)
+
+    def lookup(self, query, namespace=None, vector=None):
+        vector = self._embed(query, vector)
+        with self._lock:
+            self._check_version()
+            self._expire(time.time())
+            if self._entries:
+                slots = np.fromiter(self._entries.keys(), dtype=np.int64, count=len(self._entries))
+                scores = self._matrix[slots] @ vector
+                for i in np.argsort(-scores):
+                    if scores[i] < self.threshold:
+                        break
+                    slot = int(slots[i])
+                    entry_namespace, answer, _ = self._entries[slot]
+                    if entry_namespace == namespace:
+                        self._entries.move_to_end(slot)
+                        self.hits += 1
+                        count("answer_cache_hits")
+                        return answer
+            self.misses += 1
+        count("answer_cache_misses")
+        return None
+
+    def store(self, query, answer, namespace=None, vector=None):
+        vector = self._embed(query, vector)
+        with self._lock:
+            self._check_version()
+            if self._matrix is None:
+                self._matrix = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+            if not self._free_slots:
+                self._drop(next(iter(self._entries)))
+            slot = self._free_slots.pop()
+            self._matrix[slot] = vector
+            self._entries[slot] = (namespace, answer, time.time())
+
+    def invalidate(self):
+        with self._lock:
+            self._clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
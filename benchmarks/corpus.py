@@ -0,0 +1,75 @@
+# Seeded generator of synthetic LaTeX lecture notes for the benchmarks.
+import random
+
+WORDS = ["probability", "random", "variable", "expectation", "variance", "theorem", "proof",
+         "distribution", "independent", "measure", "sample", "limit", "sequence", "event",
+         "conditional", "density", "function", "moment", "bound", "converges", "therefore",
+         "we", "let", "the", "of", "is", "a", "and", "that", "for", "with", "by"]
+SYMBOLS = ["X", "Y", "Z", "\\mu", "\\sigma", "\\lambda", "p", "n", "k", "t"]
+
+def sentence(rnd, inline_math):
+    words = [rnd.choice(WORDS) for _ in range(rnd.randint(8, 20))]
+    if rnd.random() < inline_math:
+        words.insert(rnd.randrange(len(words)), "$%s_{%d} \\leq %s$" % (rnd.choice(SYMBOLS), rnd.randint(1, 9), rnd.choice(SYMBOLS)))
+    if rnd.random() < 0.02:
+        words.append("costs \\$%d" % rnd.randint(1, 99))
+    return " ".join(words).capitalize() + "."
+
+def equation(rnd, n):
+    lhs = "P(%s_{%d})" % (rnd.choice(SYMBOLS), n)
+    rhs = "\\frac{%s^{%d}}{%d!} e^{-%s}" % (rnd.choice(SYMBOLS), rnd.randint(1, 5), rnd.randint(1, 9), rnd.choice(SYMBOLS))
+    kind = rnd.random()
+    if kind < 0.4:
+        return "\\begin{equation}\\label{eq:%d}\n%s = %s\n\\end{equation}\n" % (n, lhs, rhs)
+    if kind < 0.6:
+        return "\\begin{align*}\n%s &= %s \\\\\n&= %s\n\\end{align*}\n" % (lhs, rhs, rhs)
+    if kind < 0.8:
+        return "$$%s = %s$$\n" % (lhs, rhs)
+    return "\\[ %s = %s \\tag{%d} \\]\n" % (lhs, rhs, n)
+
+def table(rnd, n):
+    columns = rnd.randint(2, 5)
+    rows = rnd.randint(2, 8)
+    lines = ["\\begin{table}", "\\centering", "\\begin{tabular}{|%s|}" % "|".join("c" * columns), "\\hline",
+             " & " + " & ".join("C%d" % c for c in range(1, columns)) + " \\\\", "\\hline"]
+    for r in range(rows):
+        lines.append("r%d & " % r + " & ".join(str(rnd.randint(0, 999)) for _ in range(columns - 1)) + " \\\\")
+    lines += ["\\hline", "\\end{tabular}", "\\caption{Table %d of %s}" % (n, rnd.choice(WORDS)),
+              "\\label{tab:%d}" % n, "\\end{table}"]
+    return "\n".join(lines) + "\n"
+
+def figure(rnd, n):
+    if rnd.random() < 0.7:
+        return ("\\begin{figure}\n\\centering\n\\includegraphics[width=0.6\\textwidth]{figures/fig%d.png}\n"
+                "\\caption{Plot of %s %d}\n\\label{fig:%d}\n\\end{figure}\n" % (n, rnd.choice(WORDS), n, n))
+    return ("\\begin{center}\n\\includegraphics{figures/plot%d.pdf}\n\\end{center}\n"
+            "Figure %d: %s %s\n" % (n, n, rnd.choice(WORDS), rnd.choice(WORDS)))
+
+def generate_latex(size, math=0.3, tables=0.05, figures=0.05, seed=0):
+    # Returns a document of roughly `size` characters. math, tables and
+    # figures are per-paragraph probabilities of a display equation, a table
+    # and a figure; math also sets the share of sentences with inline math.
+    rnd = random.Random(seed)
+    parts = ["\\documentclass{article}\n\\usepackage{amsmath}\n\\title{Synthetic Notes %d}\n"
+             "\\author{Benchmark}\n\\date{2024}\n\\begin{document}\n\\maketitle\n" % seed]
+    length = len(parts[0])
+    counters = {"section": 0, "equation": 0, "table": 0, "figure": 0}
+    while length < size:
+        if counters["section"] == 0 or rnd.random() < 0.1:
+            counters["section"] += 1
+            part = "\\section{Section %d}\n" % counters["section"]
+        else:
+            part = " ".join(sentence(rnd, math) for _ in range(rnd.randint(3, 8))) + "\n\n"
+            if rnd.random() < math:
+                counters["equation"] += 1
+                part += equation(rnd, counters["equation"])
+            if rnd.random() < tables:
+                counters["table"] += 1
+                part += table(rnd, counters["table"])
+            if rnd.random() < figures:
+                counters["figure"] += 1
+                part += figure(rnd, counters["figure"])
+        parts.append(part)
+        length += len(part)
+    parts.append("\\end{document}\n")
+    return "".join(parts)
@@ -0,0 +1,50 @@
+# Encoding throughput of SentenceTransformerEmbeddings.encode over a chunk
+# mix like textSplitter_latex's, for a few batch sizes.
+#
+#   python -m benchmarks.embedding_throughput --model Alibaba-NLP/gte-base-en-v1.5 --batch-sizes 16 32 64
+import time
+import json
+import random
+import argparse
+
+from preprocessing import SentenceTransformerEmbeddings
+
+def make_chunks(n, seed=0):
+    # Same mix textSplitter_latex produces: many tiny equation/caption
+    # entries and fewer prose blocks of up to ~1000 characters.
+    rnd = random.Random(seed)
+    words = ["probability", "random", "variable", "expectation", "variance", "theorem",
+             "distribution", "independent", "measure", "sample", "limit", "sequence"]
+    chunks = []
+    for i in range(n):
+        if rnd.random() < 0.6:
+            chunks.append('"equation_%d": "P(A_%d) = \\\\sum_{k} p_k x^%d"' % (i, i, rnd.randint(1, 9)))
+        else:
+            chunks.append(" ".join(rnd.choice(words) for _ in range(rnd.randint(20, 150))))
+    return chunks
+
+def run(model_name, n, batch_sizes, num_threads, repeat):
+    chunks = make_chunks(n)
+    embeddings = SentenceTransformerEmbeddings(model_name, num_threads=num_threads)
+    embeddings.encode(chunks[:32])  # warm up
+
+    results = {"model": model_name, "chunks": n, "num_threads": num_threads, "batch_sizes": {}}
+    for batch_size in batch_sizes:
+        embeddings.batch_size = batch_size
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            embeddings.encode(chunks)
+            best = min(best, time.perf_counter() - start)
+        results["batch_sizes"][batch_size] = {"seconds": round(best, 4), "chunks_per_second": round(n / best, 1)}
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="Alibaba-NLP/gte-base-en-v1.5")
+    parser.add_argument("--chunks", type=int, default=2000)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[32])
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    print(json.dumps(run(args.model, args.chunks, args.batch_sizes, args.threads, args.repeat), indent=4))
@@ -0,0 +1,179 @@
+# Times and memory-profiles every pipeline stage on synthetic documents.
+#
+#   python -m benchmarks.pipeline --scales 10KB,1MB,50MB --output bench.json
+#
+# Embedding and generation use the offline stubs unless --embeddings-model
+# names a SentenceTransformer model. Results are JSON so runs can be diffed.
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import tracemalloc
+
+from langchain.chains import RetrievalQA
+from langchain_core.prompts import PromptTemplate
+
+from Latex_Parser import (create_json_object, parse_latex_document, extract_content, latex_to_equations_json,
+                          extract_rows, extract_image_captions)
+from preprocessing import textSplitter_latex
+from vector_store import NumpyVectorStore
+from keyword_index import KeywordIndex, HybridRetriever
+from context_assembly import assemble_context
+from benchmarks.corpus import generate_latex
+from benchmarks.stubs import HashEmbeddings, EchoLLM
+
+QUERIES = ["What is the expectation of a random variable?", "equation eq:3", "Table 2",
+           "Define conditional probability", "variance bound"]
+
+PROMPT = PromptTemplate(template="CONTEXT: {context}\n\nQUERY: {question}\n",
+                        input_variables=["context", "question"])
+
+def parse_size(text):
+    units = {"KB": 1 << 10, "MB": 1 << 20, "GB": 1 << 30, "B": 1}
+    text = text.strip().upper()
+    for unit, factor in units.items():
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * factor)
+    return int(text)
+
+def measure(fn, memory):
+    start = time.perf_counter()
+    output = fn()
+    seconds = time.perf_counter() - start
+    peak = None
+    if memory:
+        # Separate run, tracemalloc slows allocations down
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return output, seconds, peak
+
+def count_items(value):
+    if isinstance(value, str):
+        return len(json.loads(value)) if value.startswith("{") else 1
+    try:
+        return len(value)
+    except TypeError:
+        return None
+
+def run_scale(size, args, embeddings, llm):
+    latex_code = generate_latex(size, math=args.math, tables=args.tables, figures=args.figures, seed=args.seed)
+    content = extract_content(latex_code)
+    results = []
+    state = {}
+
+    def stage(name, fn):
+        output, seconds, peak = measure(fn, args.memory)
+        results.append({
+            "scale": size,
+            "bytes": len(latex_code.encode("utf-8")),
+            "stage": name,
+            "seconds": round(seconds, 6),
+            "peak_bytes": peak,
+            "items": count_items(output),
+        })
+        print(f"{size:>10} {name:<24} {seconds:10.4f}s", file=sys.stderr)
+        return output
+
+    stage("latex_to_equations_json", lambda: latex_to_equations_json(content))
+    stage("extract_rows", lambda: extract_rows(content))
+    stage("extract_image_captions", lambda: extract_image_captions(content))
+    stage("create_json_object", lambda: create_json_object(latex_code))
+    state["data"] = stage("parse_latex_document", lambda: parse_latex_document(latex_code))
+    state["chunks"] = stage("textSplitter_latex",
+                            lambda: textSplitter_latex(state["data"], chunk_size=args.chunk_size,
+                                                       chunk_overlap=args.chunk_overlap))
+    texts = [chunk.page_content for chunk in state["chunks"]]
+    metadatas = [chunk.metadata for chunk in state["chunks"]]
+    state["vectors"] = stage("embed", lambda: embeddings.embed_documents(texts))
+
+    keys = [str(i) for i in range(len(texts))]
+
+    def build_index():
+        store = NumpyVectorStore(embeddings)
+        store.add_texts(texts, metadatas, embeddings=state["vectors"], keys=keys)
+        return store
+    state["store"] = stage("index", build_index)
+
+    def build_keyword_index():
+        index = KeywordIndex()
+        index.write(keys, texts, metadatas)
+        return index
+    state["keyword_index"] = stage("keyword_index", build_keyword_index)
+
+    retriever = state["store"].as_retriever(search_kwargs={"k": args.k})
+    stage("retrieve", lambda: [retriever.invoke(query) for query in QUERIES])
+    stage("label_lookup", lambda: [state["keyword_index"].references(query) for query in QUERIES])
+    hybrid = HybridRetriever(vectorstore=state["store"], index=state["keyword_index"], search_kwargs={"k": args.k})
+    stage("retrieve_hybrid", lambda: [hybrid.invoke(query) for query in QUERIES])
+    retrieved = [retriever.invoke(query) for query in QUERIES]
+    assembled = stage("assemble_context", lambda: [assemble_context(docs, token_budget=args.token_budget)[1]
+                                                   for docs in retrieved])
+    results[-1]["tokens_saved"] = sum(stats["tokens_saved"] for stats in assembled)
+    results[-1]["tokens_in"] = sum(stats["tokens_in"] for stats in assembled)
+
+    chain = RetrievalQA.from_chain_type(llm=llm, chain_type="stuff", retriever=retriever,
+                                        input_key="query", chain_type_kwargs={"prompt": PROMPT})
+    stage("generate", lambda: [chain.invoke({"query": query}) for query in QUERIES])
+    return results
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scales", default="10KB,100KB,1MB",
+                        help="comma separated document sizes, e.g. 10KB,1MB,50MB")
+    parser.add_argument("--math", type=float, default=0.3)
+    parser.add_argument("--tables", type=float, default=0.05)
+    parser.add_argument("--figures", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--chunk-overlap", type=int, default=100)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--token-budget", type=int, default=1500, help="context assembly budget")
+    parser.add_argument("--embeddings-model", default=None,
+                        help="SentenceTransformer model, the deterministic stub is used if omitted")
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+                        help="skip the tracemalloc pass")
+    parser.add_argument("--output", default=None, help="write JSON here instead of stdout")
+    args = parser.parse_args(argv)
+
+    if args.embeddings_model:
+        from preprocessing import SentenceTransformerEmbeddings
+        embeddings = SentenceTransformerEmbeddings(args.embeddings_model)
+    else:
+        embeddings = HashEmbeddings()
+    llm = EchoLLM()
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "git_revision": git_revision(),
+            "embeddings": args.embeddings_model or "stub",
+            "llm": "stub",
+            "args": vars(args),
+        },
+        "results": [],
+    }
+    for scale in args.scales.split(","):
+        report["results"].extend(run_scale(parse_size(scale), args, embeddings, llm))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+# Load test for query_service.py: requests per second and latency percentiles.
+#
+#   python -m benchmarks.query_load --requests 2000 --concurrency 64
+#   python -m benchmarks.query_load --url http://127.0.0.1:8080 --endpoint retrieve
+#
+# Without --url the service is started in-process on the offline stubs
+# (hash embeddings, echo LLM with --stub-latency seconds per call).
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+
+import numpy as np
+from aiohttp import ClientSession, web
+
+import instrumentation
+from query_service import QueryService, make_app
+from benchmarks.pipeline import QUERIES
+
+async def start_stub_service(args):
+    from langchain_core.prompts import PromptTemplate
+    from benchmarks.stubs import HashEmbeddings, EchoLLM, synthetic_store
+
+    embeddings = HashEmbeddings()
+    store = synthetic_store(embeddings, args.corpus_size)
+    prompt = PromptTemplate(template="CONTEXT: {context}\n\nQUERY: {question}\n",
+                            input_variables=["context", "question"])
+    service = QueryService(embeddings, store, EchoLLM(latency=args.stub_latency), prompt, k=args.k,
+                           max_batch=args.max_batch, max_wait=args.max_wait / 1000,
+                           max_generations=args.max_generations)
+    runner = web.AppRunner(make_app(service))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+async def run_load(url, args):
+    rnd = random.Random(args.seed)
+    queries = [f"{rnd.choice(QUERIES)} #{i}" for i in range(args.distinct)]
+    latencies = []
+    errors = 0
+    sent = 0
+
+    async with ClientSession() as session:
+        async def worker():
+            nonlocal errors, sent
+            while sent < args.requests:
+                sent += 1
+                body = {"query": rnd.choice(queries), "k": args.k}
+                start = time.perf_counter()
+                try:
+                    async with session.post(f"{url}/{args.endpoint}", json=body) as response:
+                        await response.read()
+                        if response.status != 200:
+                            errors += 1
+                except Exception:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        seconds = time.perf_counter() - start
+
+    latencies = np.array(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(seconds, 4),
+        "rps": round(len(latencies) / seconds, 2),
+        "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 3),
+        "p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 3),
+        "p99_ms": round(float(np.percentile(latencies, 99)) * 1000, 3),
+        "max_ms": round(float(latencies.max()) * 1000, 3),
+    }
+
+async def run(args):
+    runner = None
+    url = args.url
+    if url is None:
+        instrumentation.enable()
+        instrumentation.reset()
+        runner, url = await start_stub_service(args)
+    try:
+        report = await run_load(url.rstrip("/"), args)
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+    report["args"] = vars(args)
+    if runner is not None:
+        report["counters"] = instrumentation.snapshot()["counters"]
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default=None, help="running query_service, started in-process if omitted")
+    parser.add_argument("--endpoint", default="answer", choices=["answer", "retrieve"])
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--distinct", type=int, default=50, help="number of distinct queries")
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--corpus-size", type=int, default=200000, help="characters of synthetic LaTeX")
+    parser.add_argument("--stub-latency", type=float, default=0.05)
+    parser.add_argument("--max-batch", type=int, default=32)
+    parser.add_argument("--max-wait", type=float, default=2.0)
+    parser.add_argument("--max-generations", type=int, default=2)
+    parser.add_argument("--output", default=None, help="write JSON here instead of stdout")
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(run(args))
+    print(f"{report['rps']} req/s  p50 {report['p50_ms']} ms  p99 {report['p99_ms']} ms  "
+          f"errors {report['errors']}", file=sys.stderr)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
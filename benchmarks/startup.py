@@ -0,0 +1,56 @@
+# Import time of the TexRAG entry points and the libraries they pull in.
+#
+#   python -m benchmarks.startup
+#   python -m benchmarks.startup --modules Latex_Parser indexer --repeat 5
+#
+# Every import runs in a fresh interpreter, so nothing is shared between
+# measurements. Reports the best of --repeat runs per module and which heavy
+# libraries (torch, sentence_transformers, Streamlit, langchain_community,
+# the langchain package) ended up in sys.modules.
+import sys
+import json
+import argparse
+import subprocess
+
+MODULES = ["Latex_Parser", "latex_stream", "preprocessing", "indexer", "ingest", "query_service", "main"]
+HEAVY = ["torch", "sentence_transformers", "streamlit", "langchain_community", "langchain"]
+
+PROBE = """
+import sys, json, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "modules": len(sys.modules),
+                   "heavy": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+def measure(module, repeat):
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY)],
+                                capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    best = min(runs, key=lambda run: run["seconds"])
+    return {"module": module, "seconds": round(best["seconds"], 4), "modules": best["modules"],
+            "heavy": best["heavy"]}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modules", nargs="+", default=MODULES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default=None, help="write JSON here instead of stdout")
+    args = parser.parse_args(argv)
+
+    results = [measure(module, args.repeat) for module in args.modules]
+    for result in results:
+        print(f"{result['module']:<16} {result['seconds']:>8.3f} s  {result['modules']:>5} modules  "
+              f"{', '.join(result['heavy']) or '-'}", file=sys.stderr)
+    output = json.dumps({"python": sys.version.split()[0], "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
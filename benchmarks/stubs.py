@@ -0,0 +1,71 @@
+# Deterministic offline stand-ins for the embedding model and the LLM, so the
+# benchmarks run without downloading models or starting Ollama.
+import time
+import asyncio
+import hashlib
+from typing import Any, Iterator, List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.llms import LLM
+
+class HashEmbeddings(Embeddings):
+    def __init__(self, dim=768):
+        self.dim = dim
+
+    def _vector(self, text):
+        seed = int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+        return np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+
+    def embed_documents(self, documents: List[str]) -> np.ndarray:
+        vectors = np.empty((len(documents), self.dim), dtype=np.float32)
+        for i, text in enumerate(documents):
+            vectors[i] = self._vector(text)
+        return vectors
+
+    def embed_query(self, query: str) -> np.ndarray:
+        return self._vector(query)
+
+class EchoLLM(LLM):
+    # Answers with the last characters of the prompt (the end of the context
+    # and the query), token by token.
+    # latency seconds per call stand in for generation time.
+    answer_chars: int = 400
+    latency: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "echo"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, **kwargs: Any) -> str:
+        if self.latency:
+            time.sleep(self.latency)
+        return "".join(self._tokens(prompt))
+
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None, **kwargs: Any) -> str:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return "".join(self._tokens(prompt))
+
+    def _stream(self, prompt: str, stop: Optional[List[str]] = None, **kwargs: Any) -> Iterator:
+        from langchain_core.outputs import GenerationChunk
+        for token in self._tokens(prompt):
+            yield GenerationChunk(text=token)
+
+    def _tokens(self, prompt):
+        text = prompt[-self.answer_chars:]
+        for start in range(0, len(text), 4):
+            yield text[start:start + 4]
+
+def synthetic_store(embeddings, size=200000, seed=0, chunk_size=500, chunk_overlap=100):
+    # In-memory vector store over a synthetic document, for serving tests
+    # without a built index
+    from vector_store import NumpyVectorStore
+    from Latex_Parser import parse_latex_document
+    from preprocessing import textSplitter_latex
+    from benchmarks.corpus import generate_latex
+
+    chunks = textSplitter_latex(parse_latex_document(generate_latex(size, seed=seed)), chunk_size, chunk_overlap)
+    store = NumpyVectorStore(embeddings)
+    store.add_texts([chunk.page_content for chunk in chunks], [chunk.metadata for chunk in chunks])
+    return store
@@ -0,0 +1,186 @@
+import re
+from typing import Any, Callable, Dict, List
+
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+
+from instrumentation import span, count
+
+# Context assembly between retrieval and the stuff chain. Retrieved chunks
+# are grouped per source: content chunks whose byte ranges overlap or touch
+# are merged into one passage (the chunk overlap is sent once), and
+# equation, table and figure listings that lie inside a kept passage are
+# dropped. Passages that are near-duplicates of a better ranked one are
+# dropped too, then passages are packed in rank order into token_budget.
+
+# Rough token count for models without a local tokenizer: one token per
+# punctuation mark and per four word characters, close to BPE on LaTeX
+TOKEN_ESTIMATE = re.compile(r'\w{1,4}|[^\w\s]')
+SHINGLE_WORD = re.compile(r'\w+|[^\w\s]')
+
+def estimate_tokens(text):
+    return len(TOKEN_ESTIMATE.findall(text))
+
+def shingles(text, size=3):
+    words = SHINGLE_WORD.findall(text.lower())
+    if len(words) <= size:
+        return {tuple(words)}
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+def similarity(a, b):
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+class _Passage:
+    __slots__ = ('rank', 'source', 'text', 'byte_start', 'byte_end', 'document', 'parts')
+
+    def __init__(self, rank, document):
+        metadata = document.metadata
+        self.rank = rank
+        self.source = (metadata.get("source"), metadata.get("member"))
+        self.text = document.page_content
+        self.byte_start = int(metadata.get("byte_start", -1))
+        self.byte_end = int(metadata.get("byte_end", -1))
+        self.document = document
+        self.parts = 1
+
+    def extend(self, other):
+        # other starts inside or right at the end of this passage
+        if other.byte_end <= self.byte_end:
+            return
+        encoded = other.text.encode('utf-8')
+        self.text += encoded[self.byte_end - other.byte_start:].decode('utf-8', 'ignore')
+        self.byte_end = other.byte_end
+        self.rank = min(self.rank, other.rank)
+        self.parts += 1
+
+    def to_document(self):
+        if self.parts == 1:
+            return self.document
+        metadata = dict(self.document.metadata, byte_start=self.byte_start, byte_end=self.byte_end,
+                        merged_chunks=self.parts)
+        return Document(page_content=self.text, metadata=metadata)
+
+def merge_passages(documents):
+    # Content chunks of one source merged along their byte offsets, other
+    # chunks kept as they are. Offsets are exact for content chunks only:
+    # listings and tables are rewritten text, so they are never merged.
+    passages = [_Passage(rank, document) for rank, document in enumerate(documents)]
+    content = sorted((passage for passage in passages
+                      if passage.document.metadata.get("type") == "content" and passage.byte_start >= 0),
+                     key=lambda passage: (passage.source, passage.byte_start))
+    merged = []
+    for passage in content:
+        last = merged[-1] if merged else None
+        if last is not None and last.source == passage.source and passage.byte_start <= last.byte_end:
+            last.extend(passage)
+        else:
+            merged.append(passage)
+    others = [passage for passage in passages if passage.document.metadata.get("type") != "content"
+              or passage.byte_start < 0]
+    return merged, others
+
+def covered(passage, merged):
+    return passage.byte_start >= 0 and any(
+        other.source == passage.source and other.byte_start <= passage.byte_start
+        and passage.byte_end <= other.byte_end for other in merged)
+
+def truncated_metadata(document, text):
+    # Metadata of the head text of document: content offsets are exact, so
+    # byte_end moves to the end of the head; other offsets are dropped
+    metadata = {key: value for key, value in document.metadata.items() if key != "merged_chunks"}
+    byte_start = int(metadata.get("byte_start", -1))
+    if metadata.get("type") == "content" and byte_start >= 0:
+        metadata["byte_end"] = byte_start + len(text.encode('utf-8'))
+    else:
+        metadata.pop("byte_start", None)
+        metadata.pop("byte_end", None)
+    metadata["truncated"] = True
+    return metadata
+
+def assemble_context(documents, token_budget=1500, count_tokens=estimate_tokens, duplicate_threshold=0.8,
+                     separator="\n\n"):
+    # Returns the documents to stuff into the prompt, best ranked first, and
+    # the token counts before and after assembly
+    tokens_in = sum(count_tokens(document.page_content) for document in documents)
+    merged, others = merge_passages(documents)
+    dropped = 0
+    passages = list(merged)
+    for passage in others:
+        if passage.document.metadata.get("type") in ("equations", "table", "figures") and covered(passage, merged):
+            dropped += 1
+        else:
+            passages.append(passage)
+    passages.sort(key=lambda passage: passage.rank)
+
+    kept = []
+    kept_shingles = []
+    duplicates = 0
+    for passage in passages:
+        passage_shingles = shingles(passage.text)
+        if any(similarity(passage_shingles, other) >= duplicate_threshold for other in kept_shingles):
+            duplicates += 1
+            continue
+        kept.append(passage)
+        kept_shingles.append(passage_shingles)
+
+    selected = []
+    used = 0
+    separator_tokens = count_tokens(separator)
+    for passage in kept:
+        tokens = count_tokens(passage.text) + (separator_tokens if selected else 0)
+        if used + tokens > token_budget:
+            dropped += 1
+            continue
+        selected.append(passage.to_document())
+        used += tokens
+    if not selected and kept:
+        # Not even the best passage fits, send its head
+        document = kept[0].to_document()
+        text = document.page_content
+        while text and count_tokens(text) > token_budget:
+            text = text[:int(len(text) * token_budget / count_tokens(text) * 0.95)]
+        selected.append(Document(page_content=text, metadata=truncated_metadata(document, text)))
+        used = count_tokens(text)
+        dropped -= 1
+
+    stats = {
+        "tokens_in": tokens_in,
+        "tokens_out": used,
+        "tokens_saved": tokens_in - used,
+        "merged": len(documents) - len(merged) - len(others),
+        "duplicates": duplicates,
+        "dropped": dropped,
+    }
+    return selected, stats
+
+def assemble(documents, **kwargs):
+    # assemble_context with the per-query report: span attributes (JSONL
+    # exporter) and running counters
+    with span("assemble_context", documents=len(documents)) as current:
+        selected, stats = assemble_context(documents, **kwargs)
+        current.set(**stats)
+    count("context_tokens", stats["tokens_out"])
+    count("context_tokens_saved", stats["tokens_saved"])
+    return selected, stats
+
+class ContextAssemblingRetriever(BaseRetriever):
+    # Wraps the chain's retriever, search_kwargs is forwarded so callers can
+    # still read k from it
+    retriever: BaseRetriever
+    token_budget: int = 1500
+    duplicate_threshold: float = 0.8
+    count_tokens: Callable[[str], int] = estimate_tokens
+
+    @property
+    def search_kwargs(self) -> Dict[str, Any]:
+        return self.retriever.search_kwargs
+
+    def _get_relevant_documents(self, query: str, *,
+                                run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        # The inner retriever runs without callbacks, the metrics handler
+        # would otherwise time retrieval twice
+        documents = self.retriever.invoke(query)
+        selected, _ = assemble(documents, token_budget=self.token_budget, count_tokens=self.count_tokens,
+                               duplicate_threshold=self.duplicate_threshold)
+        return selected
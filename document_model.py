@@ -0,0 +1,131 @@
+import json
+from typing import Dict, List, NamedTuple, Optional
+
+# Parser output as compact records. Every start/end is a character offset
+# into the LaTeX source the document was parsed from; content_byte_start is
+# the UTF-8 byte offset of the content.
+
+class Equation(NamedTuple):
+    key: str
+    text: str
+    start: int
+    end: int
+
+class Table(NamedTuple):
+    name: str
+    caption: Optional[str]
+    label: Optional[str]
+    rows: List[List[str]]  # first row holds the column names
+    start: int
+    end: int
+
+class Figure(NamedTuple):
+    # kind is 'figure' for a figure environment (captions maps label or
+    # subfig_{j} to caption), 'sentence' for a graphic followed by a
+    # "Figure ...:" sentence (text) and 'graphic' for any other graphic
+    key: str
+    kind: str
+    graphics: List[str]
+    captions: Dict[str, str]
+    text: Optional[str]
+    start: int
+    end: int
+
+class Section(NamedTuple):
+    level: int  # 0 part, 1 chapter, 2 section, ... 5 paragraph
+    title: str
+    start: int
+    end: int
+
+def table_rows_dict(rows):
+    # The first row names the columns, and when its first cell is empty the
+    # first column names the rows
+    if not rows:
+        return {}
+    column_names = rows[0]
+    use_row_names = column_names[0] == ''
+    rows_dict = {}
+    for i, row in enumerate(rows[1:]):
+        key = row[0] if use_row_names else f"row{i+1}"
+        rows_dict[key] = dict(zip(column_names, row))
+    return rows_dict
+
+def figure_value(figure):
+    if figure.kind == 'figure':
+        return figure.captions
+    return figure.text
+
+class LatexDocument:
+    __slots__ = ('title', 'author', 'date', 'content', 'content_start', 'content_byte_start', 'equations',
+                 'tables', 'figures', 'sections', 'source', 'member')
+
+    def __init__(self, title='', author='', date='', content='', content_start=0, content_byte_start=0,
+                 equations=None, tables=None, figures=None, sections=None, source=None, member=None):
+        self.title = title
+        self.author = author
+        self.date = date
+        self.content = content
+        self.content_start = content_start
+        self.content_byte_start = content_byte_start
+        self.equations = equations or []
+        self.tables = tables or []
+        self.figures = figures or []
+        self.sections = sections or []
+        self.source = source
+        self.member = member
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def to_json_object(self):
+        # The dict create_json_object has always returned, Equations and Image
+        # Captions as JSON strings
+        equations = {}
+        for equation in self.equations:
+            equations[equation.key] = equation.text
+        image_captions = {}
+        for figure in self.figures:
+            image_captions[figure.key] = figure_value(figure)
+        return {
+            "Title": self.title,
+            "Author": self.author,
+            "Date": self.date,
+            "Content": self.content,
+            "Equations": json.dumps(equations, indent=4),
+            "Tables": {table.name: table_rows_dict(table.rows) for table in self.tables},
+            "Image Captions": json.dumps(image_captions, indent=4),
+        }
+
+    def to_record(self):
+        # Field -> plain value mapping for the parsed-document cache
+        return {
+            "Title": self.title,
+            "Author": self.author,
+            "Date": self.date,
+            "Content": self.content,
+            "ContentStart": self.content_start,
+            "ContentByteStart": self.content_byte_start,
+            "Equations": [list(equation) for equation in self.equations],
+            "Tables": [list(table) for table in self.tables],
+            "Figures": [list(figure) for figure in self.figures],
+            "Sections": [list(section) for section in self.sections],
+        }
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(
+            title=record["Title"],
+            author=record["Author"],
+            date=record["Date"],
+            content=record["Content"],
+            content_start=record["ContentStart"],
+            content_byte_start=record["ContentByteStart"],
+            equations=[Equation(*equation) for equation in record["Equations"]],
+            tables=[Table(*table) for table in record["Tables"]],
+            figures=[Figure(*figure) for figure in record["Figures"]],
+            sections=[Section(*section) for section in record["Sections"]],
+        )
@@ -0,0 +1,195 @@
+import os
+import re
+import json
+import hashlib
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows, only the in-process lock is used
+    fcntl = None
+
+# Keys are raw 16-byte digests. Bytes ('S16') fields would strip trailing
+# NUL bytes, so they are stored as uint8 arrays and read back with tobytes()
+KEY_DTYPE = np.dtype([('key', 'u1', (16,)), ('used', '<i8')])
+# Bumped when the file layout changes, older caches are recreated
+CACHE_VERSION = 2
+
+def text_key(model_name, text):
+    return hashlib.blake2b((model_name + '\0' + text).encode('utf-8'), digest_size=16).digest()
+
+class EmbeddingCache:
+    # On-disk cache of float32 embeddings for one model. Vectors live in a
+    # memory-mapped (capacity, dim) array; the key index is a memory-mapped
+    # array of 16-byte text hashes plus a last-used tick per slot. Only the
+    # key -> slot dict is held in RAM.
+    #
+    # Writers take an exclusive file lock, readers a shared one. Every write
+    # bumps the generation in the meta file so other processes reload the
+    # key index before their next lookup.
+    def __init__(self, cache_dir, model_name, dim, max_entries=100000, evict_fraction=0.1):
+        self.cache_dir = cache_dir
+        self.model_name = model_name
+        self.dim = dim
+        self.max_entries = max_entries
+        self.evict_fraction = evict_fraction
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        slug = re.sub(r'[^A-Za-z0-9_.-]+', '_', model_name)
+        self.vectors_path = os.path.join(cache_dir, slug + '.vectors')
+        self.keys_path = os.path.join(cache_dir, slug + '.keys')
+        self.meta_path = os.path.join(cache_dir, slug + '.meta.json')
+        self.lock_path = os.path.join(cache_dir, slug + '.lock')
+        self._thread_lock = threading.RLock()
+
+        with self._locked(exclusive=True):
+            meta = self._read_meta()
+            if (meta is None or meta.get('version') != CACHE_VERSION or meta['dim'] != dim
+                    or meta['capacity'] != max_entries):
+                self._create_files()
+                meta = self._read_meta()
+            self._open(meta)
+
+    @contextmanager
+    def _locked(self, exclusive=False):
+        with self._thread_lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.lock_path, 'a+') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_meta(self):
+        if not (os.path.exists(self.meta_path) and os.path.exists(self.vectors_path) and os.path.exists(self.keys_path)):
+            return None
+        with open(self.meta_path, 'r', encoding='utf-8') as meta_file:
+            return json.load(meta_file)
+
+    def _write_meta(self):
+        meta = {
+            'version': CACHE_VERSION,
+            'model_name': self.model_name,
+            'dim': self.dim,
+            'capacity': self.max_entries,
+            'generation': self.generation,
+            'tick': self.tick,
+        }
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(tmp_path, self.meta_path)
+
+    def _create_files(self):
+        np.lib.format.open_memmap(self.vectors_path, mode='w+', dtype=np.float32,
+                                  shape=(self.max_entries, self.dim)).flush()
+        np.lib.format.open_memmap(self.keys_path, mode='w+', dtype=KEY_DTYPE,
+                                  shape=(self.max_entries,)).flush()
+        self.generation = 0
+        self.tick = 0
+        self._write_meta()
+
+    def _open(self, meta):
+        self.vectors = np.load(self.vectors_path, mmap_mode='r+')
+        self.keys = np.load(self.keys_path, mmap_mode='r+')
+        self._load_index(meta)
+
+    def _load_index(self, meta):
+        self.generation = meta['generation']
+        self.tick = meta['tick']
+        keys = self.keys['key']
+        used = np.flatnonzero(keys.any(axis=1))
+        self.index = {keys[slot].tobytes(): int(slot) for slot in used}
+        self.free_slots = sorted(set(range(self.max_entries)) - set(self.index.values()), reverse=True)
+
+    def _refresh(self):
+        meta = self._read_meta()
+        if meta is not None and meta['generation'] != self.generation:
+            self._load_index(meta)
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_many(self, texts):
+        # Returns a (len(texts), dim) float32 array and the positions of the
+        # texts that were not cached (their rows are left as zeros).
+        result = np.zeros((len(texts), self.dim), dtype=np.float32)
+        missing = []
+        hit_slots = []
+        with self._locked():
+            self._refresh()
+            for i, text in enumerate(texts):
+                slot = self.index.get(text_key(self.model_name, text))
+                if slot is None:
+                    missing.append(i)
+                else:
+                    hit_slots.append((i, slot))
+            if hit_slots:
+                rows, slots = zip(*hit_slots)
+                result[list(rows)] = self.vectors[list(slots)]
+                # last-used ticks are advisory, they only steer eviction
+                self.tick += 1
+                self.keys['used'][list(slots)] = self.tick
+        self.hits += len(hit_slots)
+        self.misses += len(missing)
+        return result, missing
+
+    def put_many(self, texts, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._locked(exclusive=True):
+            self._refresh()
+            self.tick += 1
+            for text, vector in zip(texts, vectors):
+                key = text_key(self.model_name, text)
+                slot = self.index.get(key)
+                if slot is None:
+                    if not self.free_slots:
+                        self._evict()
+                    slot = self.free_slots.pop()
+                    self.index[key] = slot
+                self.vectors[slot] = vector
+                self.keys['key'][slot] = np.frombuffer(key, dtype=np.uint8)
+                self.keys['used'][slot] = self.tick
+            self.vectors.flush()
+            self.keys.flush()
+            self.generation += 1
+            self._write_meta()
+
+    def _evict(self):
+        # Drop the least recently used fraction of the cache in one go
+        count = max(1, int(self.max_entries * self.evict_fraction))
+        slots = np.argpartition(self.keys['used'], count - 1)[:count]
+        for slot in slots:
+            key = self.keys['key'][slot].tobytes()
+            self.index.pop(key, None)
+            self.keys['key'][slot] = 0
+            self.keys['used'][slot] = 0
+        self.free_slots.extend(int(slot) for slot in slots)
+        self.evictions += count
+
+    def clear(self):
+        with self._locked(exclusive=True):
+            self.keys[:] = np.zeros(self.max_entries, dtype=KEY_DTYPE)
+            self.keys.flush()
+            self.index = {}
+            self.free_slots = list(range(self.max_entries - 1, -1, -1))
+            self.generation += 1
+            self._write_meta()
+
+    def stats(self):
+        return {
+            'entries': len(self.index),
+            'capacity': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
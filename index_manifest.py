@@ -0,0 +1,93 @@
+import os
+import json
+import hashlib
+
+# Bump when the manifest layout changes, old manifests are then ignored and
+# the index is rebuilt from scratch.
+MANIFEST_VERSION = 1
+
+def content_hash(content):
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.sha256(content).hexdigest()
+
+def chunk_hash(chunk):
+    return content_hash(chunk.page_content + '\0' + json.dumps(chunk.metadata, sort_keys=True))
+
+def chunk_key(doc_id, digest):
+    return content_hash(doc_id + '\0' + digest)[:32]
+
+class IndexManifest:
+    # Records, for every indexed document, the hash of its source and the
+    # Redis key of every chunk it produced (keyed by chunk hash).
+    def __init__(self, settings=None, documents=None):
+        self.settings = settings or {}
+        self.documents = documents or {}
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(path):
+            return cls()
+        with open(path, 'r', encoding='utf-8') as manifest_file:
+            data = json.load(manifest_file)
+        if data.get('version') != MANIFEST_VERSION:
+            return cls()
+        return cls(data.get('settings'), data.get('documents'))
+
+    def save(self, path):
+        data = {
+            'version': MANIFEST_VERSION,
+            'settings': self.settings,
+            'documents': self.documents,
+        }
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as manifest_file:
+            json.dump(data, manifest_file)
+        os.replace(tmp_path, path)
+
+    def document_hash(self, doc_id):
+        entry = self.documents.get(doc_id)
+        return entry['hash'] if entry else None
+
+    def remove_document(self, doc_id):
+        entry = self.documents.pop(doc_id, None)
+        return list(entry['chunks'].values()) if entry else []
+
+    def iter_new_chunks(self, doc_id, chunks, new_chunks):
+        # Yields the (key, chunk) pairs that still have to be embedded and
+        # fills new_chunks, the chunk hash -> key map to commit once the
+        # changes are written. chunks can be a generator.
+        old_chunks = self.documents.get(doc_id, {}).get('chunks', {})
+        for chunk in chunks:
+            digest_ = chunk_hash(chunk)
+            if digest_ in new_chunks:
+                continue
+            if digest_ in old_chunks:
+                new_chunks[digest_] = old_chunks[digest_]
+            else:
+                key = chunk_key(doc_id, digest_)
+                new_chunks[digest_] = key
+                yield key, chunk
+
+    def stale_keys(self, doc_id, new_chunks):
+        # Keys of chunks that are no longer produced by this document
+        old_chunks = self.documents.get(doc_id, {}).get('chunks', {})
+        return [key for digest_, key in old_chunks.items() if digest_ not in new_chunks]
+
+    def diff_document(self, doc_id, chunks):
+        # Returns the (key, chunk) pairs to embed, the stale keys and the
+        # chunk hash -> key map, see iter_new_chunks
+        new_chunks = {}
+        to_add = list(self.iter_new_chunks(doc_id, chunks, new_chunks))
+        return to_add, self.stale_keys(doc_id, new_chunks), new_chunks
+
+    def commit_document(self, doc_id, digest, new_chunks):
+        self.documents[doc_id] = {'hash': digest, 'chunks': new_chunks}
+
+    def update_document(self, doc_id, digest, chunks):
+        to_add, stale_keys, new_chunks = self.diff_document(doc_id, chunks)
+        self.commit_document(doc_id, digest, new_chunks)
+        return to_add, stale_keys
+
+    def keys(self):
+        return [key for entry in self.documents.values() for key in entry['chunks'].values()]
@@ -0,0 +1,238 @@
+import os
+from functools import lru_cache
+
+from dotenv import load_dotenv
+from redis import Redis as RedisClient
+from redis import ConnectionPool
+from preprocessing import (process_latex_corpus, iter_latex_sources, source_id,
+                           hash_latex_source, textSplitter_latex, stream_latex_chunks,
+                           SentenceTransformerEmbeddings)
+from latex_stream import root_sources, hash_latex_tree
+from index_manifest import IndexManifest
+from vector_store import NumpyVectorStore
+from parsed_cache import ParsedDocumentCache
+from ingestion import IngestionPipeline, RedisChunkWriter, NumpyChunkWriter, ChunkWriters
+from keyword_index import KeywordIndex, KeywordIndexWriter
+from instrumentation import traced, span, count
+
+# Indexing side of TexRAG: settings, stores and create_vector_db. Shared by
+# the Streamlit app (main.py), query_service.py and the ingestion CLI
+# (ingest.py), and free of Streamlit and the LLM client so batch jobs stay
+# light. The embedding model and the LangChain Redis store are only loaded
+# when first used.
+
+load_dotenv()
+
+## loading and preprocessing
+file_path = "Probability/01.zip"
+chunk_size = 500
+chunk_overlap = 100
+
+embeddings_model_name = 'Alibaba-NLP/gte-base-en-v1.5'
+embeddings_cache_dir = 'embedding_cache'
+vectordb_file_path = 'Redis'
+manifest_file_path = 'Redis_manifest.json'
+# Parsed documents by source hash, reused whenever the index is rebuilt
+parsed_cache_dir = 'parsed_cache'
+# Streaming ingestion: chunks per embedding batch, batches buffered between
+# stages, Redis writer threads and seconds between manifest checkpoints
+ingest_batch_size = 256
+ingest_queue_size = 4
+ingest_writers = 2
+ingest_checkpoint_interval = 30
+# "document" parses every source whole in a process pool. "stream" follows
+# \input / \include and parses memory-mapped sources part by part (a
+# section, or at most stream_max_part_bytes), for books too large to hold in
+# memory; files included by another source are not indexed on their own.
+parse_mode = "document"
+stream_max_part_bytes = 1 << 20
+
+# Redis connection details
+redis_url = "redis://localhost:6379"
+index_name = "base"
+
+# Vector store backend: "redis" or "numpy" (in-process, memory-mapped)
+vector_backend = os.getenv("TEXRAG_VECTOR_BACKEND", "redis")
+numpy_index_path = 'vector_index'
+numpy_index_approximate = False
+
+# Keyword index (labels, tags, captions, BM25) built next to the vector
+# store, a directory of segments, see keyword_index.py
+keyword_index_path = 'keyword_index'
+
+# Long-lived resources, one instance per process
+@lru_cache(maxsize=None)
+def get_embeddings_model():
+    return SentenceTransformerEmbeddings(embeddings_model_name, cache_dir=embeddings_cache_dir)
+
+@lru_cache(maxsize=None)
+def get_redis_pool():
+    return ConnectionPool.from_url(redis_url)
+
+def get_redis_client():
+    return RedisClient(connection_pool=get_redis_pool())
+
+def vector_index_exists(backend):
+    if backend == "numpy":
+        return NumpyVectorStore.exists(numpy_index_path)
+    from langchain_community.vectorstores.redis.base import check_index_exists
+    return os.path.exists(vectordb_file_path) and check_index_exists(get_redis_client(), "users")
+
+def clear_vector_index(backend):
+    KeywordIndex.remove(keyword_index_path)
+    if backend == "numpy":
+        NumpyVectorStore.remove(numpy_index_path)
+    else:
+        get_redis_client().flushdb()
+
+def open_vector_store(backend):
+    if backend == "numpy":
+        return NumpyVectorStore.load(numpy_index_path, get_embeddings_model(), approximate=numpy_index_approximate)
+    from langchain_community.vectorstores.redis import Redis
+    rds = Redis.from_existing_index(
+        get_embeddings_model(),
+        index_name="users",
+        redis_url= redis_url,
+        schema= vectordb_file_path,
+    )
+    # Share one connection pool across every store and client in the process
+    rds.client = get_redis_client()
+    return rds
+
+def create_redis_index(metadata, dim):
+    # Same index Redis.from_documents creates, schema generated from the
+    # metadata of the first chunk
+    from langchain_community.vectorstores.redis import Redis
+    from langchain_community.vectorstores.redis.base import _generate_field_schema
+    rds = Redis(redis_url, "users", get_embeddings_model(), index_schema=_generate_field_schema(metadata))
+    rds.client = get_redis_client()
+    rds._create_index_if_not_exist(dim=dim)
+    rds.write_schema(vectordb_file_path)
+
+def open_vector_writer(backend, rebuild):
+    if backend == "numpy":
+        if rebuild:
+            store = NumpyVectorStore(get_embeddings_model(), approximate=numpy_index_approximate)
+        else:
+            store = open_vector_store(backend)
+        return NumpyChunkWriter(store, numpy_index_path)
+    if rebuild:
+        return RedisChunkWriter(get_redis_client(), "doc:users", create_index=create_redis_index)
+    return RedisChunkWriter.for_store(open_vector_store(backend))
+
+def open_chunk_writer(backend, rebuild):
+    # Vector store and keyword index are written together
+    keyword_index = KeywordIndex() if rebuild else KeywordIndex.load(keyword_index_path)
+    return ChunkWriters(open_vector_writer(backend, rebuild), KeywordIndexWriter(keyword_index, keyword_index_path))
+
+def index_version():
+    # The manifest is only rewritten when the index changes
+    try:
+        return os.stat(manifest_file_path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+@traced("create_vector_db")
+def create_vector_db(file_path,chunk_size=1000,chunk_overlap=50,max_workers=None,incremental=True,
+                     backend=vector_backend):
+    # file_path can be a .tex file, a zip, a directory, a glob or a list of them.
+    # Documents are parsed in a process pool and split as each one finishes.
+    # With incremental=True only new or changed chunks are embedded and only
+    # chunks that disappeared are deleted, using the manifest of content hashes.
+
+    settings = {
+        "backend": backend,
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+        "embeddings_model": embeddings_model_name,
+        "parse_mode": parse_mode,
+    }
+    manifest = IndexManifest.load(manifest_file_path)
+    rebuild = (not incremental
+               or manifest.settings != settings
+               or not vector_index_exists(backend)
+               or not KeywordIndex.exists(keyword_index_path))
+    if rebuild:
+        # Flush the existing data. The fresh manifest is saved right away so
+        # an interrupted rebuild never resumes from the old one.
+        clear_vector_index(backend)
+        manifest = IndexManifest(settings)
+        manifest.save(manifest_file_path)
+
+    # Hash pass, only new or changed sources are parsed. In stream mode a
+    # source's hash covers the files it includes.
+    if parse_mode == "stream":
+        sources, hash_source = root_sources(iter_latex_sources(file_path)), hash_latex_tree
+    else:
+        sources, hash_source = iter_latex_sources(file_path), hash_latex_source
+    source_hashes = {}
+    changed_sources = []
+    for source in sources:
+        doc_id = source_id(source)
+        source_hashes[doc_id] = hash_source(source)
+        if manifest.document_hash(doc_id) != source_hashes[doc_id]:
+            changed_sources.append(source)
+
+    stale_keys = []
+    for doc_id in list(manifest.documents):
+        if doc_id not in source_hashes:
+            stale_keys.extend(manifest.remove_document(doc_id))
+
+    def chunked_documents():
+        if parse_mode == "stream":
+            # One source at a time, chunks are produced while the pipeline
+            # embeds and writes the previous ones
+            for source in changed_sources:
+                doc_id = source_id(source)
+                yield doc_id, source_hashes[doc_id], stream_latex_chunks(
+                    source, chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                    max_part_bytes=stream_max_part_bytes)
+            return
+        parsed_cache = ParsedDocumentCache(parsed_cache_dir)
+        for document in process_latex_corpus(changed_sources, max_workers=max_workers, cache=parsed_cache,
+                                             source_hashes=source_hashes):
+            doc_id = source_id((document.source, document.member))
+            yield doc_id, source_hashes[doc_id], textSplitter_latex(document, chunk_size=chunk_size,
+                                                                     chunk_overlap=chunk_overlap)
+
+    # Parsing, embedding and writing overlap, see ingestion.py
+    writer = open_chunk_writer(backend, rebuild)
+    pipeline = IngestionPipeline(manifest, get_embeddings_model(), writer, manifest_file_path,
+                                 batch_size=ingest_batch_size, queue_size=ingest_queue_size,
+                                 writers=1 if backend == "numpy" else ingest_writers,
+                                 checkpoint_interval=ingest_checkpoint_interval)
+    # A cleared index is saved even when no document is added to it
+    pipeline.changed = rebuild
+    with span("index", backend=backend):
+        pipeline.delete(stale_keys)
+        added, deleted = pipeline.run(chunked_documents())
+
+    count("indexed_chunks_added", added)
+    count("indexed_chunks_deleted", deleted)
+    # changed tells the callers holding an open store to reload it
+    return {"added": added, "deleted": deleted, "parsed": len(changed_sources),
+            "changed": bool(rebuild or changed_sources or stale_keys)}
+
+def index_stats(backend=vector_backend):
+    # Sizes of the manifest, keyword index, vector store and parsed cache,
+    # read without loading the embedding model
+    manifest = IndexManifest.load(manifest_file_path)
+    stats = {
+        "backend": backend,
+        "settings": manifest.settings,
+        "documents": len(manifest.documents),
+        "chunks": len(manifest.keys()),
+        "vector_index_exists": vector_index_exists(backend),
+    }
+    if KeywordIndex.exists(keyword_index_path):
+        keyword_index = KeywordIndex.load(keyword_index_path)
+        stats["keyword_index"] = {"chunks": len(keyword_index), "terms": len(keyword_index.postings),
+                                  "labels": len(keyword_index.labels), "segments": len(keyword_index.segments)}
+    if stats["vector_index_exists"]:
+        if backend == "numpy":
+            stats["vectors"] = len(NumpyVectorStore.load(numpy_index_path, None))
+        else:
+            stats["vectors"] = get_redis_client().dbsize()
+    if os.path.isdir(parsed_cache_dir):
+        stats["parsed_cache_entries"] = ParsedDocumentCache(parsed_cache_dir).stats()["entries"]
+    return stats
@@ -0,0 +1,86 @@
+# Offline ingestion, without the Streamlit app.
+#
+#   python ingest.py ingest Probability/ --backend numpy
+#   python ingest.py reindex Probability/01.zip --parse-mode stream
+#   python ingest.py stats
+#
+# ingest updates the index incrementally (only new or changed sources are
+# parsed and embedded), reindex rebuilds it from scratch and stats reports
+# its size without loading the embedding model. The defaults match the
+# settings in indexer.py, an index built here is reused by the app as is.
+#
+# The report is JSON on stdout: the command's result, the counters and
+# timings of the run, and startup_seconds (importing the indexing modules)
+# and model_load_seconds (loading the embedding model), measured apart from
+# the work itself.
+import sys
+import json
+import time
+import argparse
+
+import instrumentation
+from instrumentation import span
+
+def run_ingest(indexer, args, incremental):
+    with span("load_embeddings"):
+        indexer.get_embeddings_model()
+    return indexer.create_vector_db(args.paths, chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap,
+                                    max_workers=args.workers, incremental=incremental, backend=args.backend)
+
+def main(argv=None):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--backend", default=None, help="redis or numpy, defaults to TEXRAG_VECTOR_BACKEND")
+    common.add_argument("--output", default=None, help="write JSON here instead of stdout")
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name, description in (("ingest", "add new and changed sources, drop removed ones"),
+                              ("reindex", "rebuild the index from scratch")):
+        command = commands.add_parser(name, help=description, parents=[common])
+        command.add_argument("paths", nargs="*", help=".tex files, zips, directories or globs")
+        command.add_argument("--chunk-size", type=int, default=None)
+        command.add_argument("--chunk-overlap", type=int, default=None)
+        command.add_argument("--workers", type=int, default=None, help="parser processes")
+        command.add_argument("--parse-mode", default=None, choices=["document", "stream"])
+    commands.add_parser("stats", help="sizes of the manifest, vector store, keyword index and parsed cache",
+                        parents=[common])
+    args = parser.parse_args(argv)
+
+    instrumentation.enable()
+    with span("startup"):
+        import indexer
+    args.backend = args.backend or indexer.vector_backend
+
+    if args.command == "stats":
+        result = indexer.index_stats(args.backend)
+    else:
+        args.paths = args.paths or indexer.file_path
+        args.chunk_size = args.chunk_size or indexer.chunk_size
+        args.chunk_overlap = args.chunk_overlap if args.chunk_overlap is not None else indexer.chunk_overlap
+        if args.parse_mode:
+            indexer.parse_mode = args.parse_mode
+        start = time.perf_counter()
+        result = run_ingest(indexer, args, incremental=args.command == "ingest")
+        result["seconds"] = round(time.perf_counter() - start, 4)
+
+    snapshot = instrumentation.snapshot()
+    spans = snapshot["spans"]
+    report = {
+        "command": args.command,
+        "result": result,
+        "startup_seconds": round(spans["startup"][1], 4),
+        "model_load_seconds": round(spans["load_embeddings"][1], 4) if "load_embeddings" in spans else None,
+        "counters": snapshot["counters"],
+        "spans": spans,
+    }
+    print(f"{args.command}: startup {report['startup_seconds']} s  "
+          + "  ".join(f"{key} {value}" for key, value in result.items() if not isinstance(value, dict)),
+          file=sys.stderr)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
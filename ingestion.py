@@ -0,0 +1,275 @@
+import time
+import queue
+import threading
+
+import numpy as np
+
+from instrumentation import span, count
+
+# Streaming ingestion: documents are chunked and diffed against the manifest
+# on the calling thread, embedded in bounded batches on one thread and written
+# by writer threads, so the vector store is written while the next batch is
+# being embedded. Both queues are bounded, which caps the number of chunks
+# and vectors held in memory at (queue_size + threads) batches.
+#
+# A document is committed to the manifest only after all of its batches are
+# written and its stale chunks deleted, and the manifest is saved every
+# checkpoint_interval seconds. Writes are idempotent (fixed keys), so after a
+# crash the next incremental run re-embeds only the documents that had not
+# been committed yet.
+
+_DONE = object()
+
+class RedisChunkWriter:
+    # Writes chunks as the hashes langchain's Redis vector store reads, with
+    # one pipelined (non-transactional) round trip per batch. The client can
+    # be shared between writer threads, each pipeline borrows a connection
+    # from the client's pool. create_index(metadata, dim) is called once
+    # before the first write when the index still has to be created.
+    def __init__(self, client, key_prefix, content_key="content", vector_key="content_vector",
+                 vector_dtype=np.float32, create_index=None):
+        self.client = client
+        self.key_prefix = key_prefix
+        self.content_key = content_key
+        self.vector_key = vector_key
+        self.vector_dtype = vector_dtype
+        self.create_index = create_index
+        self._index_lock = threading.Lock()
+
+    @classmethod
+    def for_store(cls, rds, create_index=None):
+        return cls(rds.client, rds.key_prefix, rds._schema.content_key, rds._schema.content_vector_key,
+                   rds._schema.vector_dtype, create_index)
+
+    def _redis_key(self, key):
+        return key if key.startswith(self.key_prefix + ":") else f"{self.key_prefix}:{key}"
+
+    def write(self, keys, texts, metadatas, vectors):
+        if not keys:
+            return
+        if self.create_index is not None:
+            with self._index_lock:
+                if self.create_index is not None:
+                    self.create_index(metadatas[0], len(vectors[0]))
+                    self.create_index = None
+        pipeline = self.client.pipeline(transaction=False)
+        for key, text, metadata, vector in zip(keys, texts, metadatas, vectors):
+            mapping = {self.content_key: text,
+                       self.vector_key: np.asarray(vector, dtype=self.vector_dtype).tobytes()}
+            mapping.update(metadata)
+            pipeline.hset(self._redis_key(key), mapping=mapping)
+        pipeline.execute()
+
+    def delete(self, keys):
+        if keys:
+            self.client.delete(*[self._redis_key(key) for key in keys])
+
+    def flush(self):
+        pass
+
+class NumpyChunkWriter:
+    # NumpyVectorStore is not thread safe, use a single writer thread
+    def __init__(self, store, path):
+        self.store = store
+        self.path = path
+
+    def write(self, keys, texts, metadatas, vectors):
+        if keys:
+            self.store.add_texts(texts, metadatas, keys=keys, embeddings=vectors)
+
+    def delete(self, keys):
+        self.store.delete(keys)
+
+    def flush(self):
+        self.store.save(self.path)
+
+class ChunkWriters:
+    # Fans every write and delete out to several writers, e.g. the vector
+    # store and the keyword index
+    def __init__(self, *writers):
+        self.writers = writers
+
+    def write(self, keys, texts, metadatas, vectors):
+        for writer in self.writers:
+            writer.write(keys, texts, metadatas, vectors)
+
+    def delete(self, keys):
+        for writer in self.writers:
+            writer.delete(keys)
+
+    def flush(self):
+        for writer in self.writers:
+            writer.flush()
+
+class _Batch:
+    __slots__ = ('doc_id', 'keys', 'chunks', 'vectors')
+
+    def __init__(self, doc_id, keys, chunks):
+        self.doc_id = doc_id
+        self.keys = keys
+        self.chunks = chunks
+        self.vectors = None
+
+class IngestionPipeline:
+    def __init__(self, manifest, embeddings, writer, manifest_path=None, batch_size=256, queue_size=4,
+                 writers=2, checkpoint_interval=30.0):
+        self.manifest = manifest
+        self.embeddings = embeddings
+        self.writer = writer
+        self.manifest_path = manifest_path
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.writers = writers
+        self.checkpoint_interval = checkpoint_interval
+        self.added = 0
+        self.deleted = 0
+        # Documents committed or chunks deleted since the last checkpoint.
+        # Checkpoints at the end of a run are skipped while it is False, so a
+        # run that changed nothing leaves the stores and manifest untouched.
+        self.changed = False
+        self._lock = threading.Lock()
+        self._pending = {}  # doc_id -> [batches left, digest, chunk map, stale keys]
+        self._errors = []
+        self._last_checkpoint = time.monotonic()
+
+    def checkpoint(self):
+        # Vectors first, then the manifest that refers to them
+        with self._lock:
+            self.writer.flush()
+            if self.manifest_path:
+                self.manifest.save(self.manifest_path)
+            self.changed = False
+            self._last_checkpoint = time.monotonic()
+        count("ingest_checkpoints")
+
+    def _put(self, target, item):
+        # Blocks while the queue is full, gives up once a stage has failed
+        while not self._errors:
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    # Both stages keep draining their queue after a failure, so upstream
+    # stages never block on a full queue and every thread reaches _DONE.
+    def _embed_stage(self, inbox, outbox):
+        while True:
+            batch = inbox.get()
+            if batch is _DONE:
+                break
+            if self._errors:
+                continue
+            try:
+                if batch.chunks:
+                    with span("ingest.embed", chunks=len(batch.chunks)):
+                        batch.vectors = self.embeddings.embed_documents(
+                            [chunk.page_content for chunk in batch.chunks])
+            except BaseException as exc:
+                self._errors.append(exc)
+                continue
+            self._put(outbox, batch)
+        for _ in range(self.writers):
+            outbox.put(_DONE)
+
+    def _write_stage(self, inbox):
+        while True:
+            batch = inbox.get()
+            if batch is _DONE:
+                break
+            if self._errors:
+                continue
+            try:
+                if batch.chunks:
+                    with span("ingest.write", chunks=len(batch.chunks)):
+                        self.writer.write(batch.keys, [chunk.page_content for chunk in batch.chunks],
+                                          [chunk.metadata for chunk in batch.chunks], batch.vectors)
+                    count("ingest_written_chunks", len(batch.chunks))
+                self._batch_written(batch.doc_id)
+            except BaseException as exc:
+                self._errors.append(exc)
+
+    def _batch_written(self, doc_id):
+        with self._lock:
+            entry = self._pending[doc_id]
+            entry[0] -= 1
+            if entry[0]:
+                return
+            del self._pending[doc_id]
+            _, digest, new_chunks, stale_keys = entry
+            self.writer.delete(stale_keys)
+            if self.manifest.documents.get(doc_id) != {'hash': digest, 'chunks': new_chunks}:
+                self.manifest.commit_document(doc_id, digest, new_chunks)
+                self.changed = True
+            self.deleted += len(stale_keys)
+            due = time.monotonic() - self._last_checkpoint >= self.checkpoint_interval
+        count("ingest_documents")
+        if due:
+            self.checkpoint()
+
+    def delete(self, keys):
+        # Deletes chunks outside any document, e.g. those of removed sources
+        if keys:
+            with self._lock:
+                self.writer.delete(keys)
+                self.deleted += len(keys)
+                self.changed = True
+
+    def _queue_document(self, to_embed, doc_id, digest, chunks):
+        # Chunks are diffed and batched as they come, so chunks can be a
+        # generator over a document that never is in memory as a whole. The
+        # pending count starts at one for the last batch and grows with every
+        # full batch, so the document is committed only after its last batch.
+        new_chunks = {}
+        with self._lock:
+            entry = self._pending[doc_id] = [1, digest, new_chunks, []]
+        keys = []
+        batch = []
+        for key, chunk in self.manifest.iter_new_chunks(doc_id, chunks, new_chunks):
+            keys.append(key)
+            batch.append(chunk)
+            if len(batch) == self.batch_size:
+                with self._lock:
+                    entry[0] += 1
+                    self.added += len(batch)
+                if not self._put(to_embed, _Batch(doc_id, keys, batch)):
+                    return False
+                keys = []
+                batch = []
+        with self._lock:
+            entry[3] = self.manifest.stale_keys(doc_id, new_chunks)
+            self.added += len(batch)
+        return self._put(to_embed, _Batch(doc_id, keys, batch))
+
+    def run(self, documents):
+        # documents yields (doc_id, digest, chunks). Returns the number of
+        # chunks added and deleted.
+        to_embed = queue.Queue(maxsize=self.queue_size)
+        to_write = queue.Queue(maxsize=self.queue_size)
+        threads = [threading.Thread(target=self._embed_stage, args=(to_embed, to_write), daemon=True)]
+        threads += [threading.Thread(target=self._write_stage, args=(to_write,), daemon=True)
+                    for _ in range(self.writers)]
+        for thread in threads:
+            thread.start()
+
+        # A failure in documents itself (parse or chunk error, interrupt) is
+        # handled like a failed stage: the stages finish what was queued and
+        # the committed documents are checkpointed before it is re-raised
+        producer_error = None
+        try:
+            for doc_id, digest, chunks in documents:
+                if not self._queue_document(to_embed, doc_id, digest, chunks) or self._errors:
+                    break
+        except BaseException as exc:
+            producer_error = exc
+        to_embed.put(_DONE)
+        for thread in threads:
+            thread.join()
+        if self.changed:
+            # After a failure this keeps what was committed, so the next run
+            # resumes from there
+            self.checkpoint()
+        if producer_error is not None or self._errors:
+            raise producer_error if producer_error is not None else self._errors[0]
+        return self.added, self.deleted
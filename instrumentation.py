@@ -0,0 +1,167 @@
+# Timing spans and counters for every pipeline stage.
+#
+# Disabled by default: span() then returns a shared no-op context manager and
+# count() returns immediately, so instrumented code pays one flag check.
+# When enabled, spans aggregate into count/sum/max per stage and can also be
+# appended to a JSONL file; aggregates are exported in the Prometheus text
+# format, either rendered on demand or served over HTTP.
+import json
+import time
+import threading
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class _State:
+    enabled = False
+    jsonl_path = None
+
+_state = _State()
+_lock = threading.Lock()
+_spans = {}     # stage -> [count, sum_seconds, max_seconds]
+_counters = {}  # name -> value
+
+def enable(jsonl_path=None):
+    _state.jsonl_path = jsonl_path
+    _state.enabled = True
+
+def disable():
+    _state.enabled = False
+
+def enabled():
+    return _state.enabled
+
+def reset():
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+_NOOP_SPAN = _NoopSpan()
+
+class _Span:
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __exit__(self, exc_type, exc, tb):
+        record_span(self.name, time.perf_counter() - self.start, self.attrs, error=exc_type is not None)
+        return False
+
+def span(name, **attrs):
+    if not _state.enabled:
+        return _NOOP_SPAN
+    return _Span(name, attrs)
+
+def traced(name):
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _state.enabled:
+                return fn(*args, **kwargs)
+            with _Span(name, {}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, value=1):
+    if not _state.enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+def record_span(name, seconds, attrs=None, error=False):
+    with _lock:
+        stats = _spans.get(name)
+        if stats is None:
+            stats = _spans[name] = [0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+        if error:
+            _counters["errors." + name] = _counters.get("errors." + name, 0) + 1
+        if _state.jsonl_path:
+            event = {"ts": time.time(), "span": name, "seconds": seconds, "error": error}
+            if attrs:
+                event.update(attrs)
+            with open(_state.jsonl_path, "a", encoding="utf-8") as jsonl_file:
+                jsonl_file.write(json.dumps(event) + "\n")
+
+def snapshot():
+    with _lock:
+        return {
+            "spans": {name: list(stats) for name, stats in _spans.items()},
+            "counters": dict(_counters),
+        }
+
+def merge(other):
+    # Folds in a snapshot() taken in another process (parser workers)
+    with _lock:
+        for name, (n, total, longest) in other["spans"].items():
+            stats = _spans.setdefault(name, [0, 0.0, 0.0])
+            stats[0] += n
+            stats[1] += total
+            stats[2] = max(stats[2], longest)
+        for name, value in other["counters"].items():
+            _counters[name] = _counters.get(name, 0) + value
+
+def _metric_name(name):
+    return "texrag_" + "".join(c if c.isalnum() else "_" for c in name)
+
+def render_prometheus():
+    data = snapshot()
+    lines = [
+        "# HELP texrag_stage_seconds Time spent per pipeline stage.",
+        "# TYPE texrag_stage_seconds summary",
+    ]
+    for name, (n, total, _) in sorted(data["spans"].items()):
+        lines.append(f'texrag_stage_seconds_count{{stage="{name}"}} {n}')
+        lines.append(f'texrag_stage_seconds_sum{{stage="{name}"}} {total:.6f}')
+    lines.append("# HELP texrag_stage_seconds_max Longest single span per stage.")
+    lines.append("# TYPE texrag_stage_seconds_max gauge")
+    for name, (_, _, longest) in sorted(data["spans"].items()):
+        lines.append(f'texrag_stage_seconds_max{{stage="{name}"}} {longest:.6f}')
+    for name, value in sorted(data["counters"].items()):
+        metric = _metric_name(name) + "_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {value}")
+    return "\n".join(lines) + "\n"
+
+def export_jsonl(path):
+    with open(path, "a", encoding="utf-8") as jsonl_file:
+        jsonl_file.write(json.dumps({"ts": time.time(), **snapshot()}) + "\n")
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") not in ("", "/metrics"):
+            self.send_error(404)
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def serve_prometheus(port=9464, host="127.0.0.1"):
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,426 @@
+import os
+import re
+import json
+import math
+import mmap
+import shutil
+import threading
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+
+from instrumentation import count
+
+# Keyword side of retrieval: an inverted index over the chunks with BM25
+# scoring, plus an exact lookup table from \label / \tag keys, table names and
+# figure keys to the chunks that carry them. It is filled by the ingestion
+# pipeline next to the vector store and holds the chunk text, so keyword hits
+# never touch the vector store.
+#
+# On disk the index is a directory of append-only segments listed in
+# segments.json, oldest first. A segment holds the chunks written between two
+# saves: their records (text and metadata, one JSON line each, read through
+# mmap) in records.jsonl, and in index.json their offsets, lengths and labels,
+# their postings and the keys it deletes from older segments. Postings and
+# labels are loaded into memory, chunk text never is. save writes the changes
+# since the last save as a new segment, then merges the newest segment into
+# the one before it while that one is not larger, like a binary counter: a
+# chunk is rewritten about log2(saves) times, so a save costs the size of the
+# change (amortised over the merges), not of the index.
+
+INDEX_VERSION = 2
+MANIFEST = 'segments.json'
+RECORDS = 'records.jsonl'
+SEGMENT_INDEX = 'index.json'
+
+
+# LaTeX commands, words and numbers, and compound keys such as eq:bayes or 2.1
+TOKEN = re.compile(r'\\[A-Za-z]+|[^\W_]+(?:[:._\-][^\W_]+)*')
+TOKEN_PART = re.compile(r'[:._\-]')
+# Label prefixes and reference words -> kind, so that "Equation 3",
+# "eq. (3)" and \label{eqn:3} all meet at eq:3
+KINDS = {'eq': 'eq', 'eqn': 'eq', 'equation': 'eq', 'tab': 'tab', 'table': 'tab', 'fig': 'fig',
+         'figure': 'fig', 'sec': 'sec', 'section': 'sec', 'thm': 'thm', 'theorem': 'thm', 'lem': 'lem',
+         'lemma': 'lem', 'def': 'def', 'definition': 'def'}
+CHUNK_KINDS = {'equations': 'eq', 'table': 'tab', 'figures': 'fig'}
+# "equation (3)", "eq. eq:bayes", "Table 2.1", "fig:setup", ...
+REFERENCE = re.compile(r'\b(' + '|'.join(sorted(KINDS, key=len, reverse=True)) + r')'
+                       r's?(?:\.|\b)\s*[~:]?\s*\(?([^\s()?!,;]+?)\)?(?=[\s?!,;]|\Z)', re.IGNORECASE)
+
+def tokenize(text):
+    tokens = []
+    for match in TOKEN.finditer(text):
+        token = match.group().lower()
+        tokens.append(token)
+        if TOKEN_PART.search(token):
+            tokens.extend(part for part in TOKEN_PART.split(token) if part)
+    return tokens
+
+def normalize_label(label):
+    return re.sub(r'\s+', '', label).lower()
+
+def chunk_labels(text, metadata):
+    # \label and \tag keys from the chunker metadata, plus the table name or
+    # figure keys that head table and figure chunks
+    labels = [label for label in metadata.get("labels", "").split(", ") if label]
+    if metadata.get("type") == "table" and text.startswith("table "):
+        labels.append(text[len("table "):].split("\n", 1)[0])
+    elif metadata.get("type") == "figures":
+        labels.extend(re.findall(r'^figure (\S+?):? ', text, re.MULTILINE))
+    return labels
+
+def document_id(document):
+    # Chunk key of a retrieved document, Redis ids carry the key prefix
+    key = document.metadata.get("id")
+    return key.rsplit(":", 1)[-1] if key else document.page_content
+
+def chunk_terms(text, labels, label_boost):
+    terms = Counter(tokenize(text))
+    for label in labels:
+        for term in tokenize(label):
+            terms[term] += label_boost
+    return terms
+
+class KeywordIndex:
+    def __init__(self, k1=1.5, b=0.75, label_boost=3):
+        self.k1 = k1
+        self.b = b
+        self.label_boost = label_boost
+        # key -> [segment, offset, size, length, labels, chunk type], segment
+        # is None until the chunk is saved
+        self.documents = {}
+        self.postings = {}   # term -> {key: term frequency}
+        self.labels = {}     # normalized label -> [keys]
+        self.total_length = 0
+        self.path = None
+        self.segments = []   # [name, entries, deleted keys], oldest first
+        self._segment_keys = {}  # segment name -> keys it holds that are still live
+        self._unsaved = {}   # key -> (text, metadata) written since the last save
+        self._deleted = set()  # saved keys deleted since the last save
+        self._maps = {}      # segment name -> mmap of its records
+        self._next_segment = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.documents)
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, MANIFEST))
+
+    @staticmethod
+    def remove(path):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        index = cls(**kwargs)
+        index.path = path
+        if not cls.exists(path):
+            return index
+        with open(os.path.join(path, MANIFEST), 'r', encoding='utf-8') as manifest_file:
+            data = json.load(manifest_file)
+        if data.get('version') != INDEX_VERSION:
+            return index
+        # Replay the segments, then keep the postings of the chunks that are
+        # still live in the segment that holds them
+        segment_postings = []
+        for name, entries in data['segments']:
+            with open(os.path.join(path, name, SEGMENT_INDEX), 'r', encoding='utf-8') as segment_file:
+                segment = json.load(segment_file)
+            for key in segment['deleted']:
+                entry = index.documents.pop(key, None)
+                if entry is not None:
+                    index._segment_keys[entry[0]].discard(key)
+            keys = index._segment_keys[name] = set()
+            for key, (offset, size, length, labels, chunk_type) in segment['documents'].items():
+                entry = index.documents.get(key)
+                if entry is not None:
+                    index._segment_keys[entry[0]].discard(key)
+                index.documents[key] = [name, offset, size, length, labels, chunk_type]
+                keys.add(key)
+            index.segments.append([name, entries, segment['deleted']])
+            index._open_map(name)
+            segment_postings.append((name, segment['postings']))
+        for name, postings in segment_postings:
+            for term, frequencies in postings.items():
+                live = {key: frequency for key, frequency in frequencies.items()
+                        if index.documents.get(key, (None,))[0] == name}
+                if live:
+                    index.postings.setdefault(term, {}).update(live)
+        for key, (_, _, _, length, labels, chunk_type) in index.documents.items():
+            index.total_length += length
+            index._add_labels(key, labels, chunk_type)
+        index._next_segment = max((int(name.split('-')[1]) + 1 for name, _ in data['segments']), default=0)
+        return index
+
+    ## Segments
+    def _open_map(self, name):
+        with open(os.path.join(self.path, name, RECORDS), 'rb') as records_file:
+            if os.fstat(records_file.fileno()).st_size:
+                self._maps[name] = mmap.mmap(records_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _close_map(self, name):
+        records_map = self._maps.pop(name, None)
+        if records_map is not None:
+            records_map.close()
+
+    def _record(self, key):
+        # (text, metadata) of a chunk, from memory if it is not saved yet
+        entry = self.documents[key]
+        if entry[0] is None:
+            return self._unsaved[key]
+        _, offset, size = entry[:3]
+        record = json.loads(self._maps[entry[0]][offset:offset + size])
+        return record['text'], record['metadata']
+
+    def _write_segment(self, keys, deleted):
+        # Writes the given live chunks and tombstones as a new segment and
+        # points the chunks at it; returns its [name, entries, deleted]
+        name = f"seg-{self._next_segment:06d}"
+        self._next_segment += 1
+        directory = os.path.join(self.path, name)
+        os.makedirs(directory)
+        documents = {}
+        postings = {}
+        offset = 0
+        with open(os.path.join(directory, RECORDS), 'wb') as records_file:
+            for key in keys:
+                text, metadata = self._record(key)
+                line = json.dumps({'text': text, 'metadata': metadata}).encode('utf-8') + b'\n'
+                records_file.write(line)
+                _, _, _, length, labels, chunk_type = self.documents[key]
+                documents[key] = [offset, len(line), length, labels, chunk_type]
+                for term, frequency in chunk_terms(text, labels, self.label_boost).items():
+                    postings.setdefault(term, {})[key] = frequency
+                offset += len(line)
+        with open(os.path.join(directory, SEGMENT_INDEX), 'w', encoding='utf-8') as segment_file:
+            json.dump({'documents': documents, 'postings': postings, 'deleted': deleted}, segment_file)
+        self._open_map(name)
+        for key, (offset, size, _, _, _) in documents.items():
+            self.documents[key][:3] = [name, offset, size]
+            self._unsaved.pop(key, None)
+        self._segment_keys[name] = set(documents)
+        count("keyword_index_written_bytes", offset)
+        return [name, len(documents) + len(deleted), deleted]
+
+    def _merge_segments(self):
+        while len(self.segments) >= 2 and self.segments[-2][1] <= self.segments[-1][1]:
+            older, newer = self.segments[-2], self.segments[-1]
+            keys = sorted(self._segment_keys.pop(older[0]) | self._segment_keys.pop(newer[0]))
+            # Tombstones only matter while there are older segments
+            deleted = sorted(set(older[2]) | set(newer[2])) if len(self.segments) > 2 else []
+            self.segments[-2:] = [self._write_segment(keys, deleted)]
+
+    def _write_manifest(self):
+        data = {'version': INDEX_VERSION, 'segments': [[name, entries] for name, entries, _ in self.segments]}
+        tmp_path = os.path.join(self.path, MANIFEST + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as manifest_file:
+            json.dump(data, manifest_file)
+        os.replace(tmp_path, os.path.join(self.path, MANIFEST))
+
+    def _remove_unlisted_segments(self):
+        listed = {name for name, _, _ in self.segments}
+        for name in os.listdir(self.path):
+            if name.startswith('seg-') and name not in listed:
+                self._close_map(name)
+                shutil.rmtree(os.path.join(self.path, name))
+
+    def save(self, path):
+        with self._lock:
+            if path != self.path:
+                # A new location, e.g. a rebuilt index: every chunk goes into
+                # the first segment of a fresh directory
+                for key, entry in self.documents.items():
+                    if entry[0] is not None:
+                        self._unsaved[key] = self._record(key)
+                        entry[0] = None
+                for name in list(self._maps):
+                    self._close_map(name)
+                self.remove(path)
+                self.path = path
+                self.segments = []
+                self._segment_keys = {}
+                self._deleted = set()
+                self._next_segment = 0
+            os.makedirs(path, exist_ok=True)
+            if self._unsaved or self._deleted or not self.segments:
+                deleted = sorted(self._deleted) if self.segments else []
+                self.segments.append(self._write_segment(list(self._unsaved), deleted))
+                self._deleted = set()
+                self._merge_segments()
+            self._write_manifest()
+            self._remove_unlisted_segments()
+
+    def _label_keys(self, label, chunk_type):
+        # The label itself and kind:name, with the kind taken from the label
+        # prefix or else from the chunk type (a \tag{2.1} in an equations
+        # chunk is eq:2.1)
+        label = normalize_label(label)
+        keys = [label]
+        prefix, _, name = label.partition(':')
+        if name and prefix in KINDS:
+            keys.append(KINDS[prefix] + ':' + name)
+        elif not name and chunk_type in CHUNK_KINDS:
+            keys.append(CHUNK_KINDS[chunk_type] + ':' + label)
+        return list(dict.fromkeys(keys))
+
+    def _add_labels(self, key, labels, chunk_type):
+        for label in labels:
+            for label_key in self._label_keys(label, chunk_type):
+                self.labels.setdefault(label_key, []).append(key)
+
+    ## Writes, same interface as the chunk writers in ingestion.py
+    def write(self, keys, texts, metadatas, vectors=None):
+        with self._lock:
+            self.delete(keys)
+            for key, text, metadata in zip(keys, texts, metadatas):
+                labels = chunk_labels(text, metadata)
+                terms = chunk_terms(text, labels, self.label_boost)
+                length = sum(terms.values())
+                for term, frequency in terms.items():
+                    self.postings.setdefault(term, {})[key] = frequency
+                self.documents[key] = [None, 0, 0, length, labels, metadata.get("type")]
+                self._unsaved[key] = (text, metadata)
+                self.total_length += length
+                self._add_labels(key, labels, metadata.get("type"))
+
+    def delete(self, keys):
+        with self._lock:
+            for key in keys:
+                if key not in self.documents:
+                    continue
+                text, _ = self._record(key)
+                segment, _, _, length, labels, chunk_type = self.documents.pop(key)
+                if segment is None:
+                    del self._unsaved[key]
+                else:
+                    self._segment_keys[segment].discard(key)
+                self._deleted.add(key)
+                self.total_length -= length
+                for term in chunk_terms(text, labels, self.label_boost):
+                    postings = self.postings.get(term)
+                    if postings is not None:
+                        postings.pop(key, None)
+                        if not postings:
+                            del self.postings[term]
+                for label in labels:
+                    for label_key in self._label_keys(label, chunk_type):
+                        keys_for_label = self.labels.get(label_key, [])
+                        if key in keys_for_label:
+                            keys_for_label.remove(key)
+                        if not keys_for_label:
+                            self.labels.pop(label_key, None)
+
+    ## Reads
+    def document(self, key):
+        with self._lock:
+            text, metadata = self._record(key)
+        return Document(page_content=text, metadata={**metadata, "id": key})
+
+    def references(self, query):
+        # Keys of the chunks whose label the query names exactly: label-like
+        # tokens (eq:bayes) and references (Table 2.1 -> tab:2.1)
+        candidates = [match.group() for match in TOKEN.finditer(query) if ':' in match.group()]
+        for match in REFERENCE.finditer(query):
+            name = match.group(2).rstrip('.')
+            candidates.append(name if ':' in name else KINDS[match.group(1).lower()] + ':' + name)
+        keys = []
+        with self._lock:
+            for candidate in candidates:
+                for key in self.labels.get(normalize_label(candidate), []):
+                    if key not in keys:
+                        keys.append(key)
+        count("keyword_label_hits", len(keys))
+        return keys
+
+    def search(self, query, k=4):
+        # (key, BM25 score) of the k best chunks
+        terms = set(tokenize(query))
+        scores = {}
+        with self._lock:
+            n = len(self.documents)
+            if not n:
+                return []
+            average_length = self.total_length / n
+            for term in terms:
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+                for key, frequency in postings.items():
+                    length = self.documents[key][3]
+                    norm = self.k1 * (1 - self.b + self.b * length / average_length)
+                    scores[key] = scores.get(key, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+        return sorted(scores.items(), key=lambda item: -item[1])[:k]
+
+class KeywordIndexWriter:
+    # Ingestion writer keeping the keyword index in step with the vector store
+    def __init__(self, index, path):
+        self.index = index
+        self.path = path
+
+    def write(self, keys, texts, metadatas, vectors):
+        self.index.write(keys, texts, metadatas)
+
+    def delete(self, keys):
+        self.index.delete(keys)
+
+    def flush(self):
+        self.index.save(self.path)
+
+def fuse_rankings(rankings, k, rrf_k=60, weights=None):
+    # Reciprocal rank fusion of several ranked key lists
+    weights = weights or [1.0] * len(rankings)
+    scores = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, key in enumerate(ranking):
+            scores[key] = scores.get(key, 0.0) + weight / (rrf_k + rank + 1)
+    return sorted(scores, key=lambda key: -scores[key])[:k]
+
+def hybrid_documents(index, query, k, vector_documents, fetch_k=None, keyword_weight=1.0):
+    # Direct label hits first, then vector and BM25 results fused by rank.
+    # vector_documents(n) returns the n nearest chunks and is only called
+    # when the label hits do not fill k.
+    direct = index.references(query)[:k]
+    documents = [index.document(key) for key in direct]
+    if len(documents) >= k:
+        count("keyword_direct_answers")
+        return documents
+    fetch_k = fetch_k or 4 * k
+    by_key = {}
+    vector_ranking = []
+    for document in vector_documents(fetch_k):
+        key = document_id(document)
+        by_key.setdefault(key, document)
+        vector_ranking.append(key)
+    keyword_ranking = [key for key, _ in index.search(query, fetch_k)]
+    for key in fuse_rankings([vector_ranking, keyword_ranking], k + len(direct),
+                             weights=[1.0, keyword_weight]):
+        if key in direct:
+            continue
+        documents.append(by_key[key] if key in by_key else index.document(key))
+        if len(documents) == k:
+            break
+    return documents
+
+class HybridRetriever(BaseRetriever):
+    # Drop-in for vectorstore.as_retriever(), k is read from search_kwargs
+    # like VectorStoreRetriever so callers can key caches on it
+    vectorstore: Any
+    index: Any
+    search_kwargs: Dict[str, Any] = {"k": 4}
+    fetch_k: Optional[int] = None
+    keyword_weight: float = 1.0
+
+    def _get_relevant_documents(self, query: str, *,
+                                run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return hybrid_documents(self.index, query, self.search_kwargs.get("k", 4),
+                                lambda n: self.vectorstore.similarity_search(query, k=n),
+                                fetch_k=self.fetch_k, keyword_weight=self.keyword_weight)
@@ -0,0 +1,249 @@
+import re
+from bisect import bisect_right
+
+import numpy as np
+from langchain_core.documents import Document
+
+# Structure-aware chunking of a LatexDocument.
+#
+# The content is cut at sectioning commands first. Inside a section the
+# split points are blank lines and environment boundaries, then sentence
+# ends and finally spaces for paragraphs longer than the budget. A split
+# point never falls inside an equation, a tabular, a table or figure
+# environment, so those stay whole even when they exceed the budget.
+# Pieces are packed greedily up to chunk_size as measured by
+# length_function. Equations and figures of a section are packed the same
+# way into listing chunks, and tables become one chunk each, split by rows
+# with the header repeated when they are too long.
+
+PARAGRAPH_BREAK = re.compile(r'\n[ \t]*\n\s*|(?=\\begin\{)|\\end\{[^}]*\}[ \t]*\n?')
+SENTENCE_BREAK = re.compile(r'(?<=[.!?])\s+')
+SPACE_BREAK = re.compile(r'\s+')
+PROTECTED_ENVIRONMENT = re.compile(r'\\begin\{(table\*?|figure\*?)\}.*?\\end\{\1\}', re.DOTALL)
+LABEL = re.compile(r'\\label\{([^}]*)\}')
+# The equation records follow the legacy parser, which lets an escaped \$
+# open inline math, so dollar math is protected with its own pattern
+DOLLAR_MATH = re.compile(r'(?<!\\)(\$\$?)(?:\\.|[^$\\])+?(?<!\\)\1', re.DOTALL)
+
+class ByteOffsets:
+    # Character offset -> UTF-8 byte offset for one text
+    def __init__(self, text, base=0):
+        self.base = base
+        self.cumulative = None
+        if not text.isascii():
+            codepoints = np.frombuffer(text.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+            widths = 1 + (codepoints >= 0x80) + (codepoints >= 0x800) + (codepoints >= 0x10000)
+            self.cumulative = np.concatenate(([0], np.cumsum(widths)))
+
+    def __call__(self, offset):
+        if self.cumulative is None:
+            return self.base + offset
+        return self.base + int(self.cumulative[offset])
+
+def merge_spans(spans):
+    merged = []
+    for start, end in sorted(spans):
+        if merged and start < merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+class ProtectedSpans:
+    def __init__(self, spans):
+        merged = merge_spans(spans)
+        self.starts = [start for start, _ in merged]
+        self.ends = [end for _, end in merged]
+
+    def contains(self, offset):
+        # True when a cut at offset would fall strictly inside a span
+        i = bisect_right(self.starts, offset) - 1
+        return i >= 0 and self.starts[i] < offset < self.ends[i]
+
+def section_segments(document):
+    # (start, end, section path) in content offsets, one per section body
+    # plus the text before the first section
+    content_start = document.content_start
+    segments = []
+    stack = []
+    position = 0
+    for section in document.sections:
+        start = section.start - content_start
+        if start > position:
+            segments.append((position, start, [entry.title for entry in stack]))
+        while stack and stack[-1].level >= section.level:
+            stack.pop()
+        stack.append(section)
+        position = start
+    segments.append((position, len(document.content), [entry.title for entry in stack]))
+    return [segment for segment in segments if segment[1] > segment[0]]
+
+def cut_points(pattern, text, start, end, protected):
+    return [match.end() for match in pattern.finditer(text, start, end)
+            if start < match.end() < end and not protected.contains(match.end())]
+
+def pieces(text, start, end, chunk_size, length_function, protected, patterns):
+    # Splits text[start:end] into pieces no longer than chunk_size, using the
+    # first pattern that yields cut points and recursing with the next
+    # pattern on pieces that are still too long
+    if length_function(text[start:end]) <= chunk_size or not patterns:
+        return [(start, end)]
+    points = cut_points(patterns[0], text, start, end, protected)
+    if not points:
+        return pieces(text, start, end, chunk_size, length_function, protected, patterns[1:])
+    result = []
+    for piece_start, piece_end in zip([start] + points, points + [end]):
+        result.extend(pieces(text, piece_start, piece_end, chunk_size, length_function, protected, patterns[1:]))
+    return result
+
+def pack(spans, sizes, chunk_size, chunk_overlap):
+    # Groups consecutive spans into (first, last) index ranges that fit
+    # chunk_size, starting each group with the trailing spans of the previous
+    # group that fit in chunk_overlap
+    groups = []
+    first = 0
+    total = 0
+    for i, size in enumerate(sizes):
+        if i > first and total + size > chunk_size:
+            groups.append((first, i - 1))
+            overlap_first = i
+            overlap = 0
+            while overlap_first - 1 > first and overlap + sizes[overlap_first - 1] <= chunk_overlap:
+                overlap_first -= 1
+                overlap += sizes[overlap_first]
+            if overlap + size > chunk_size:
+                overlap_first, overlap = i, 0
+            first, total = overlap_first, overlap
+        total += size
+    if sizes:
+        groups.append((first, len(sizes) - 1))
+    return groups
+
+def stripped_span(text, start, end):
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return start, end
+
+def chunk_metadata(base, chunk_type, section_path, byte_start, byte_end, labels):
+    return dict(base, type=chunk_type, section=" > ".join(section_path), byte_start=byte_start,
+                byte_end=byte_end, labels=", ".join(labels))
+
+def content_chunks(document, base, chunk_size, chunk_overlap, length_function, byte_offset):
+    content = document.content
+    offset = document.content_start
+    spans = [(equation.start - offset, equation.end - offset) for equation in document.equations
+             if not content.startswith('$', equation.start - offset)]
+    spans.extend((table.start - offset, table.end - offset) for table in document.tables)
+    spans.extend(match.span() for match in DOLLAR_MATH.finditer(content))
+    spans.extend((figure.start - offset, figure.end - offset) for figure in document.figures
+                 if figure.kind == 'figure')
+    spans.extend(match.span() for match in PROTECTED_ENVIRONMENT.finditer(content))
+    protected = ProtectedSpans(spans)
+    patterns = [SENTENCE_BREAK, SPACE_BREAK]
+
+    chunks = []
+    for segment_start, segment_end, path in section_segments(document):
+        points = cut_points(PARAGRAPH_BREAK, content, segment_start, segment_end, protected)
+        units = []
+        for start, end in zip([segment_start] + points, points + [segment_end]):
+            units.extend(pieces(content, start, end, chunk_size, length_function, protected, patterns))
+        sizes = [length_function(content[start:end]) for start, end in units]
+        for first, last in pack(units, sizes, chunk_size, chunk_overlap):
+            start, end = stripped_span(content, units[first][0], units[last][1])
+            if start == end:
+                continue
+            text = content[start:end]
+            chunks.append(Document(page_content=text, metadata=chunk_metadata(
+                base, "content", path, byte_offset(start), byte_offset(end), LABEL.findall(text))))
+    return chunks
+
+def table_text_rows(table):
+    return [" | ".join(row) for row in table.rows]
+
+def figure_line(figure):
+    if figure.kind == 'figure':
+        captions = "; ".join(f"{label}: {caption}" for label, caption in figure.captions.items())
+        return f"figure {figure.key} ({', '.join(figure.graphics)}) {captions}"
+    return f"figure {figure.key}: {figure.text}"
+
+class SectionPaths:
+    # Section path of any content offset, by bisecting the segment starts
+    def __init__(self, document):
+        segments = section_segments(document)
+        self.starts = [start for start, _, _ in segments]
+        self.paths = [path for _, _, path in segments]
+
+    def __call__(self, offset):
+        i = bisect_right(self.starts, offset) - 1
+        return self.paths[i] if i >= 0 else []
+
+def listing_chunks(items, base, chunk_type, chunk_size, length_function, byte_offset, document, section_paths):
+    # items are (text, start, end, label) in source offsets, packed per
+    # section under a "<chunk_type> in <section path>" line. Items longer
+    # than chunk_size are left to the content chunks that contain them.
+    chunks = []
+    groups = {}
+    offset = document.content_start
+    for item in items:
+        if length_function(item[0]) > chunk_size:
+            continue
+        path = tuple(section_paths(item[1] - offset))
+        groups.setdefault(path, []).append(item)
+    for path, group in groups.items():
+        header = chunk_type + (" in " + " > ".join(path) if path else "")
+        sizes = [length_function(text) + 1 for text, _, _, _ in group]
+        for first, last in pack(group, sizes, chunk_size - length_function(header), 0):
+            selected = group[first:last + 1]
+            text = header + "\n" + "\n".join(item[0] for item in selected)
+            chunks.append(Document(page_content=text, metadata=chunk_metadata(
+                base, chunk_type, list(path),
+                byte_offset(min(item[1] for item in selected) - offset),
+                byte_offset(max(item[2] for item in selected) - offset),
+                [item[3] for item in selected if item[3]])))
+    return chunks
+
+def table_chunks(document, base, chunk_size, length_function, byte_offset, section_paths):
+    chunks = []
+    offset = document.content_start
+    for table in document.tables:
+        path = section_paths(table.start - offset)
+        rows = table_text_rows(table)
+        header = "table " + table.name + ("\n" + rows[0] if rows else "")
+        body = rows[1:]
+        sizes = [length_function(row) + 1 for row in body]
+        groups = pack(body, sizes, chunk_size - length_function(header), 0) if body else [(0, -1)]
+        for first, last in groups:
+            text = "\n".join([header] + body[first:last + 1])
+            chunks.append(Document(page_content=text, metadata=chunk_metadata(
+                base, "table", path, byte_offset(table.start - offset), byte_offset(table.end - offset),
+                [table.label] if table.label else [])))
+    return chunks
+
+def chunk_document(document, chunk_size=1000, chunk_overlap=50, length_function=len):
+    base = {"source": document.source or "", "member": document.member or ""}
+    byte_offset = ByteOffsets(document.content, document.content_byte_start)
+
+    section_paths = SectionPaths(document)
+
+    chunks = content_chunks(document, base, chunk_size, chunk_overlap, length_function, byte_offset)
+
+    equations = [(f"{equation.key}: {equation.text}", equation.start, equation.end,
+                  None if equation.key.startswith('equation_') else equation.key)
+                 for equation in document.equations]
+    chunks.extend(listing_chunks(equations, base, "equations", chunk_size, length_function, byte_offset,
+                                 document, section_paths))
+    chunks.extend(table_chunks(document, base, chunk_size, length_function, byte_offset, section_paths))
+    figures = [(figure_line(figure), figure.start, figure.end,
+                ", ".join(label for label in figure.captions if not label.startswith('subfig_')))
+               for figure in document.figures]
+    chunks.extend(listing_chunks(figures, base, "figures", chunk_size, length_function, byte_offset,
+                                 document, section_paths))
+
+    details = [f"{name} {getattr(document, name)}" for name in ("title", "author", "date")
+               if getattr(document, name)]
+    if details:
+        chunks.append(Document(page_content="\n".join(details),
+                               metadata=chunk_metadata(base, "document", [], -1, -1, [])))
+    return chunks
@@ -0,0 +1,251 @@
+import os
+import re
+import mmap
+import shutil
+import hashlib
+import zipfile
+import posixpath
+import tempfile
+
+from Latex_Parser import SECTION_COMMAND, extract_title, parse_latex_content
+from document_model import LatexDocument, Section
+from instrumentation import count, span
+
+# Streaming parse for sources too large to hold in memory and for projects
+# split with \input / \include.
+#
+# Sources are memory-mapped (zip members are copied to a temporary file
+# first, compressed data cannot be mapped) and walked in reading order,
+# descending into included files. The body is cut at sectioning commands,
+# at include boundaries and, in runs longer than max_part_bytes, at blank
+# lines. Every part is decoded and parsed on its own and comes out as a
+# LatexDocument whose source/member name the file it was read from and whose
+# content_byte_start is its byte offset in that file; item offsets are
+# relative to the part content. Only one part is decoded at a time, so
+# memory follows the largest part rather than the whole project.
+
+INCLUDE = re.compile(rb'\\(?:input|include)\s*\{([^}]*)\}|\\input\s+([^\s{}\\%]+)')
+SECTION_START = re.compile(SECTION_COMMAND.pattern.encode('ascii'))
+COMMENT = re.compile(rb'(?<!\\)%')
+BEGIN_DOCUMENT = b'\\begin{document}'
+END_DOCUMENT = b'\\end{document}'
+PARAGRAPH = b'\n\n'
+NUMBERED_KEY = {
+    'equation': re.compile(r'equation_(\d+)'),
+    'table': re.compile(r'table_(\d+)'),
+    'figure': re.compile(r'figure_(\d+)'),
+}
+
+class MappedFile:
+    def __init__(self, path, member=None):
+        self.path = path
+        self.member = member
+        if member is None:
+            self._file = open(path, 'rb')
+        else:
+            self._file = tempfile.TemporaryFile()
+            with zipfile.ZipFile(path, 'r') as zip_ref, zip_ref.open(member) as member_file:
+                shutil.copyfileobj(member_file, self._file, 1 << 20)
+            self._file.flush()
+        if os.fstat(self._file.fileno()).st_size:
+            self.data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = b''
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+class IncludeResolver:
+    # \input / \include names are resolved against the directory of the main
+    # file, as LaTeX does, inside the zip for a zip member. ".tex" is
+    # appended when the name has no extension.
+    def __init__(self, root):
+        self.path, self.member = root
+        self.names = None
+        if self.member is not None:
+            with zipfile.ZipFile(self.path, 'r') as zip_ref:
+                self.names = set(zip_ref.namelist())
+
+    def resolve(self, name):
+        name = name.strip()
+        candidates = [name] if name.endswith('.tex') else [name + '.tex', name]
+        for candidate in candidates:
+            if self.member is None:
+                path = os.path.normpath(os.path.join(os.path.dirname(self.path), candidate))
+                if os.path.isfile(path):
+                    return path, None
+            else:
+                member = posixpath.normpath(posixpath.join(posixpath.dirname(self.member), candidate))
+                if member in self.names:
+                    return self.path, member
+        return None
+
+def commented(data, position):
+    line_start = data.rfind(b'\n', 0, position) + 1
+    return COMMENT.search(data, line_start, position) is not None
+
+def include_directives(data, start, end, resolver):
+    # (match, included source) of every \input / \include that is not
+    # commented out and resolves to a file
+    for match in INCLUDE.finditer(data, start, end):
+        if commented(data, match.start()):
+            continue
+        name = (match.group(1) or match.group(2)).decode('utf-8')
+        source = resolver.resolve(name)
+        if source is None:
+            count('unresolved_includes')
+            continue
+        yield match, source
+
+def walk_source(resolver, source, data, start, end, visiting=()):
+    # Yields (source, data, start, end) byte ranges in reading order, the
+    # text of included files in place of their directives
+    visiting = visiting + (source,)
+    position = start
+    for match, included in include_directives(data, start, end, resolver):
+        if included in visiting:
+            continue
+        if match.start() > position:
+            yield source, data, position, match.start()
+        with MappedFile(*included) as mapped:
+            yield from walk_source(resolver, included, mapped.data, 0, len(mapped.data), visiting)
+        position = match.end()
+    if end > position:
+        yield source, data, position, end
+
+def split_range(data, start, end, max_part_bytes):
+    # Cut at every sectioning command, then at blank lines within runs that
+    # are still longer than max_part_bytes
+    cuts = [match.start() for match in SECTION_START.finditer(data, start, end) if match.start() > start]
+    for part_start, part_end in zip([start] + cuts, cuts + [end]):
+        while part_end - part_start > max_part_bytes:
+            cut = data.rfind(PARAGRAPH, part_start + 1, part_start + max_part_bytes)
+            if cut == -1:
+                cut = data.find(PARAGRAPH, part_start + max_part_bytes, part_end)
+            if cut == -1:
+                break
+            yield part_start, cut
+            part_start = cut
+        yield part_start, part_end
+
+def include_tree(source):
+    # The source and every file it includes, depth first
+    resolver = IncludeResolver(source)
+    tree = []
+
+    def visit(current):
+        tree.append(current)
+        with MappedFile(*current) as mapped:
+            for _, included in include_directives(mapped.data, 0, len(mapped.data), resolver):
+                if included not in tree:
+                    visit(included)
+    visit(source)
+    return tree
+
+def hash_latex_tree(source):
+    # Content hash of a source together with everything it includes
+    digest = hashlib.sha256()
+    for path, member in include_tree(source):
+        digest.update(f"{path}::{member}\0".encode('utf-8'))
+        with MappedFile(path, member) as mapped:
+            digest.update(mapped.data)
+    return digest.hexdigest()
+
+def root_sources(sources):
+    # Drops the sources that another one includes, they are parsed as part
+    # of the source that includes them
+    sources = list(sources)
+    included = set()
+    for source in sources:
+        for path, member in include_tree(source)[1:]:
+            included.add((os.path.normpath(path), member))
+    return [source for source in sources if (os.path.normpath(source[0]), source[1]) not in included]
+
+def renumber(items, kind, field, offset):
+    # Keys numbered per part (equation_3) continue the numbering of the
+    # previous parts; returns the items and how many numbers they used
+    pattern = NUMBERED_KEY[kind]
+    used = 0
+    renumbered = []
+    for item in items:
+        match = pattern.fullmatch(getattr(item, field))
+        if match:
+            number = int(match.group(1))
+            used = max(used, number)
+            item = item._replace(**{field: f"{kind}_{number + offset}"})
+        renumbered.append(item)
+    return renumbered, used
+
+def parse_part(text, byte_start, source, open_sections, numbering, commands):
+    count('parsed_bytes', len(text))
+    equations, tables, figures, sections = parse_latex_content(text)
+    equations, _ = renumber(equations, 'equation', 'key', numbering['equation'])
+    numbering['equation'] += len(equations)
+    tables, _ = renumber(tables, 'table', 'name', numbering['table'])
+    numbering['table'] += len(tables)
+    figures, used = renumber(figures, 'figure', 'key', numbering['figure'])
+    numbering['figure'] += used
+
+    # Sections still open from the previous parts lead the list with empty
+    # spans, so section paths continue across parts
+    ancestors = [Section(section.level, section.title, 0, 0) for section in open_sections]
+    for section in sections:
+        while open_sections and open_sections[-1].level >= section.level:
+            open_sections.pop()
+        open_sections.append(section)
+
+    document = LatexDocument(
+        title=commands['title'],
+        author=commands['author'],
+        date=commands['date'],
+        content=text,
+        content_start=0,
+        content_byte_start=byte_start,
+        equations=equations,
+        tables=tables,
+        figures=figures,
+        sections=ancestors + sections,
+    )
+    document.source, document.member = source
+    return document
+
+def iter_latex_parts(source, max_part_bytes=1 << 20):
+    # LatexDocuments of one source part by part, see the top of the file.
+    # Title, author and date come from the preamble and are set on the first
+    # part only.
+    resolver = IncludeResolver(source)
+    open_sections = []
+    numbering = {'equation': 0, 'table': 0, 'figure': 0}
+    count('documents')
+    with MappedFile(*source) as root:
+        data = root.data
+        begin = data.find(BEGIN_DOCUMENT)
+        commands = extract_title(data[:begin].decode('utf-8') if begin != -1 else '')
+        start = begin + len(BEGIN_DOCUMENT) if begin != -1 else 0
+        end = data.rfind(END_DOCUMENT, start)
+        end = end if end != -1 else len(data)
+
+        no_commands = {'title': '', 'author': '', 'date': ''}
+        for part_source, part_data, range_start, range_end in walk_source(resolver, source, data, start, end):
+            for part_start, part_end in split_range(part_data, range_start, range_end, max_part_bytes):
+                text = part_data[part_start:part_end].decode('utf-8')
+                # Trailing whitespace is kept, a "Figure ..." sentence after a
+                # graphic needs the newline that ends it
+                content = text.lstrip()
+                if not content:
+                    continue
+                byte_start = part_start + len(text[:len(text) - len(content)].encode('utf-8'))
+                with span('parse.part', bytes=part_end - part_start):
+                    document = parse_part(content, byte_start, part_source, open_sections, numbering, commands)
+                commands = no_commands
+                count('parsed_parts')
+                yield document
@@ -2,67 +2,129 @@ import os
 import re
 import streamlit as st
 from dotenv import load_dotenv
-from langchain_community.llms import Ollama
-from langchain import PromptTemplate
-from langchain.chains import RetrievalQA
-from redis import Redis
-from langchain.vectorstores.redis import Redis
+from langchain_core.prompts import PromptTemplate, format_document
+from langchain_core.callbacks import BaseCallbackHandler
 import time
-from redis import Redis as RedisClient
-from preprocess import process_latex_file, textSplitter_latex, SentenceTransformerEmbeddings
+import indexer
+from indexer import (file_path, chunk_size, chunk_overlap, vector_backend, keyword_index_path,
+                     get_embeddings_model, open_vector_store, index_version)
+from answer_cache import SemanticAnswerCache
+from keyword_index import KeywordIndex, HybridRetriever
+from context_assembly import ContextAssemblingRetriever
+import instrumentation
+from instrumentation import count
 
-# Load environment variables
+# Indexing settings and stores live in indexer.py, shared with query_service.py
+# and the ingestion CLI (ingest.py). Ollama and the RetrievalQA chain are
+# imported where they are first used, so importing this module stays cheap.
+
+# Load environment variables. Tracing needs a LangChain API key, without one
+# the app runs untraced.
 load_dotenv()
-os.environ["LANGCHAIN_TRACING_V2"] = "true"
-os.environ["LANGCHAIN_API_KEY"] = os.getenv("LANGCHAIN_API_KEY")
+if os.getenv("LANGCHAIN_API_KEY"):
+    os.environ["LANGCHAIN_TRACING_V2"] = "true"
 
-## loading and preprocessing
-file_path = "Probability/01.zip"
-data = process_latex_file(file_path)
+llm_model_name = "qwen2"
 
-llm=Ollama(model="qwen2")
-embeddings_model_name = 'Alibaba-NLP/gte-base-en-v1.5'
-embeddings_model = SentenceTransformerEmbeddings(embeddings_model_name)
-vectordb_file_path = 'Redis'
+# With hybrid_search, label references in a query are answered from the
+# keyword index directly and its BM25 ranking is fused with the vector
+# ranking, over hybrid_fetch_k candidates per side.
+hybrid_search = True
+hybrid_fetch_k = 20
+hybrid_keyword_weight = 1.0
 
-# Redis connection details
-redis_url = "redis://localhost:6379" 
-index_name = "base" 
+# Context assembly before the stuff chain: overlapping chunks are merged,
+# near-duplicates dropped and the rest packed into context_token_budget
+# (estimated) tokens. None sends the retrieved chunks unchanged.
+context_token_budget = 1500
+context_duplicate_threshold = 0.8
 
-def create_vector_db(file_path,chunk_size=1000,chunk_overlap=50):
-    #Load data
-    data = process_latex_file(file_path)
-    
-    # Split data into LangChain Document objects
-    chunks = textSplitter_latex(data, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+# Semantic answer cache
+answer_cache_threshold = 0.95
+answer_cache_size = 1000
+answer_cache_ttl = 24 * 3600
 
-    # Connect to Redis
-    redis_client = RedisClient.from_url(redis_url)
+# Instrumentation, off unless one of the exporters is configured
+metrics_port = os.getenv("TEXRAG_METRICS_PORT")
+metrics_jsonl_path = os.getenv("TEXRAG_METRICS_JSONL")
 
-    # Flush the existing data
-    redis_client.flushdb()
-    
-    # Redis vector store
-    rds = Redis.from_documents(
-        chunks,
-        embeddings_model,
-        redis_url= redis_url,
-        index_name="users",
-    )
-    rds.write_schema(vectordb_file_path)
-
-def get_qa_chain(k=3):
-
-    new_rds = Redis.from_existing_index(
-        embeddings_model,
-        index_name="users",
-        redis_url= redis_url,
-        schema= vectordb_file_path,
-    )
-    
-    retriever = new_rds.as_retriever(search_type="similarity", search_kwargs={"k": k})
-    
-    prompt_template = """
+@st.cache_resource
+def setup_instrumentation():
+    if not (metrics_port or metrics_jsonl_path):
+        return None
+    instrumentation.enable(jsonl_path=metrics_jsonl_path)
+    if metrics_port:
+        return instrumentation.serve_prometheus(int(metrics_port))
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    # Times the retriever and LLM runs inside a chain call
+    def __init__(self):
+        self.starts = {}
+
+    def on_retriever_start(self, serialized, query, *, run_id, **kwargs):
+        self.starts[run_id] = time.perf_counter()
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        instrumentation.record_span("retrieve", time.perf_counter() - self.starts.pop(run_id))
+        count("retrieved_documents", len(documents))
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self.starts[run_id] = time.perf_counter()
+        count("prompt_chars", sum(len(prompt) for prompt in prompts))
+
+    def on_llm_new_token(self, token, **kwargs):
+        count("generated_tokens")
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        instrumentation.record_span("generate", time.perf_counter() - self.starts.pop(run_id))
+
+def metrics_callbacks():
+    return [MetricsCallbackHandler()] if instrumentation.enabled() else []
+
+# Long-lived resources. Streamlit re-executes this script on every
+# interaction, st.cache_resource keeps one instance per process instead.
+@st.cache_resource
+def get_llm():
+    from langchain_community.llms import Ollama
+    return Ollama(model=llm_model_name)
+
+# Read-only store used for retrieval, create_vector_db opens its own copy.
+# The store, keyword index and chain are keyed on index_version(), so an
+# index updated by another process (ingest.py) is reopened on the next query.
+@st.cache_resource(max_entries=1)
+def get_vector_store(backend, version=None):
+    return open_vector_store(backend)
+
+@st.cache_resource(max_entries=1)
+def get_keyword_index(version=None):
+    return KeywordIndex.load(keyword_index_path)
+
+@st.cache_resource
+def get_answer_cache():
+    return SemanticAnswerCache(get_embeddings_model(), threshold=answer_cache_threshold,
+                               max_entries=answer_cache_size, ttl=answer_cache_ttl,
+                               version_fn=index_version)
+
+def invalidate_vector_store():
+    # Called whenever the index changes so the next query reconnects and no
+    # answer computed from the old index is served
+    get_vector_store.clear()
+    get_keyword_index.clear()
+    get_qa_chain.clear()
+    get_answer_cache().invalidate()
+
+def create_vector_db(file_path, chunk_size=1000, chunk_overlap=50, max_workers=None, incremental=True,
+                     backend=vector_backend):
+    # indexer.create_vector_db, dropping the cached store, chain and answers
+    # when the index changed
+    result = indexer.create_vector_db(file_path, chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                                      max_workers=max_workers, incremental=incremental, backend=backend)
+    if result["changed"]:
+        invalidate_vector_store()
+    return result
+
+# Shared by the Streamlit chain and query_service.py
+prompt_template = """
     You are a QA bot designed to answer queries using TeX documents. Your goal is to generate an answer based on this context only.
     Ensure your responses meet the following criteria:
     1. Mathematical Accuracy: If the query involves a math problem, solve it independently to fully understand the query. 
@@ -76,15 +138,31 @@ def get_qa_chain(k=3):
     QUERY: {question}
     """
 
-    PROMPT = PromptTemplate(
-        template=prompt_template, input_variables=["context", "question"]
-    )
-    chain = RetrievalQA.from_chain_type(llm=llm,
+qa_prompt = PromptTemplate(
+    template=prompt_template, input_variables=["context", "question"]
+)
+
+@st.cache_resource(max_entries=1)
+def get_qa_chain(k=3, backend=vector_backend, version=None):
+    from langchain.chains import RetrievalQA
+
+    new_rds = get_vector_store(backend, version)
+    
+    if hybrid_search:
+        retriever = HybridRetriever(vectorstore=new_rds, index=get_keyword_index(version), search_kwargs={"k": k},
+                                    fetch_k=hybrid_fetch_k, keyword_weight=hybrid_keyword_weight)
+    else:
+        retriever = new_rds.as_retriever(search_type="similarity", search_kwargs={"k": k})
+    if context_token_budget is not None:
+        retriever = ContextAssemblingRetriever(retriever=retriever, token_budget=context_token_budget,
+                                               duplicate_threshold=context_duplicate_threshold)
+    
+    chain = RetrievalQA.from_chain_type(llm=get_llm(),
                                         chain_type="stuff",
                                         retriever=retriever,
                                         input_key="query",
                                         return_source_documents=True,
-                                        chain_type_kwargs={"prompt": PROMPT})
+                                        chain_type_kwargs={"prompt": qa_prompt})
 
     return chain
 
@@ -95,29 +173,124 @@ def clean_output(output):
     out_modified = re.sub(r"\\\\text", r"\\text", out_modified)
     return out_modified
 
+class StreamingOutputCleaner:
+    # Applies clean_output to a token stream. None of its patterns span a
+    # newline, so complete lines are cleaned once and kept. The open line is
+    # re-cleaned on every token, holding back trailing "$"s or a partial
+    # "\\text" that the next token could complete, so delimiters split across
+    # tokens render the same as in the final answer.
+    HOLD_BACK = re.compile(r"(\$+|\\|\\\\|\\\\t|\\\\te|\\\\tex)\Z")
+
+    def __init__(self):
+        self.cleaned_lines = ""
+        self.pending = ""
+
+    def feed(self, token):
+        self.pending += token
+        # The last newline is only committed once something follows it, the
+        # end of the answer is handled differently by clean_output
+        newline = self.pending.rfind("\n", 0, len(self.pending) - 1)
+        if newline != -1:
+            self.cleaned_lines += clean_output(self.pending[:newline + 1])
+            self.pending = self.pending[newline + 1:]
+        hold = self.HOLD_BACK.search(self.pending)
+        visible = self.pending[:hold.start()] if hold else self.pending
+        return self.cleaned_lines + clean_output(visible)
+
+    def flush(self):
+        return self.cleaned_lines + clean_output(self.pending)
+
 # Function to run the chain and parse the output
-def run_chain_with_parser(chain, query):
-    result = chain({"query": query})
+def run_chain_with_parser(chain, query, cache=None):
+    # Answers depend on k as well as on the query
+    namespace = chain.retriever.search_kwargs.get("k")
+    vector = None
+    if cache is not None:
+        # One query embedding for the lookup and the store
+        vector = cache.embeddings.embed_query(query)
+        cached = cache.lookup(query, namespace=namespace, vector=vector)
+        if cached is not None:
+            return cached
+
+    count("queries")
+    result = chain({"query": query}, callbacks=metrics_callbacks())
 
     out_modified = clean_output(result['result'])
     source_doc = [clean_output(doc_s.page_content) for doc_s in result["source_documents"]]
     
-    return {
+    output = {
         "output" : out_modified,
         "source_documents": source_doc    
     }
+    if cache is not None:
+        cache.store(query, output, namespace=namespace, vector=vector)
+    return output
+
+# Streaming variant of run_chain_with_parser. Yields ("source_documents", docs)
+# as soon as retrieval finishes, then ("output", text) with the cleaned answer
+# so far after every generated token.
+def stream_chain_with_parser(chain, query, cache=None):
+    namespace = chain.retriever.search_kwargs.get("k")
+    vector = None
+    if cache is not None:
+        # One query embedding for the lookup and the store
+        vector = cache.embeddings.embed_query(query)
+        cached = cache.lookup(query, namespace=namespace, vector=vector)
+        if cached is not None:
+            yield "source_documents", cached["source_documents"]
+            yield "output", cached["output"]
+            return
+
+    count("queries")
+    callbacks = metrics_callbacks()
+    docs = chain.retriever.invoke(query, config={"callbacks": callbacks})
+    source_doc = [clean_output(doc_s.page_content) for doc_s in docs]
+    yield "source_documents", source_doc
 
-def run(k=3):
+    combine = chain.combine_documents_chain
+    context = combine.document_separator.join(format_document(doc, combine.document_prompt) for doc in docs)
+    prompt = combine.llm_chain.prompt.format(context=context, question=query)
+
+    cleaner = StreamingOutputCleaner()
+    for token in combine.llm_chain.llm.stream(prompt, config={"callbacks": callbacks}):
+        yield "output", cleaner.feed(token)
+    out_modified = cleaner.flush()
+    yield "output", out_modified
+    if cache is not None:
+        cache.store(query, {"output": out_modified, "source_documents": source_doc}, namespace=namespace,
+                    vector=vector)
+
+def run(k=3, stream=True):
     st.title("TexRAG")
     query = st.text_input("Question: ")
 
     if query:
-        chain = get_qa_chain(k=k)
-        output = run_chain_with_parser(chain, query)    
+        chain = get_qa_chain(k=k, version=index_version())
+        if not stream:
+            output = run_chain_with_parser(chain, query, cache=get_answer_cache())    
+
+            st.header("Answer")
+            st.markdown(output['output'])
+            return
 
         st.header("Answer")
-        st.markdown(output['output'])
+        answer = st.empty()
+        answer.markdown("_Retrieving..._")
+        for kind, value in stream_chain_with_parser(chain, query, cache=get_answer_cache()):
+            if kind == "source_documents":
+                answer.markdown("_Generating..._")
+                with st.expander(f"Sources ({len(value)})"):
+                    for source in value:
+                        st.markdown(source)
+            else:
+                answer.markdown(value)
         
+# Streamlit reruns the script on every interaction, index only once per process
+@st.cache_resource
+def ensure_vector_db(file_path, chunk_size=1000, chunk_overlap=50):
+    return create_vector_db(file_path, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
 if __name__ == "__main__":
-    create_vector_db(file_path, chunk_size=500,chunk_overlap=100)    
+    setup_instrumentation()
+    ensure_vector_db(file_path, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
     run(k=5)
@@ -0,0 +1,172 @@
+import os
+import json
+import zlib
+import struct
+import hashlib
+import threading
+from collections.abc import MutableMapping
+
+import Latex_Parser
+import document_model
+
+# Bump when the file layout below, or the text documents are parsed from,
+# changes (3: sources are decoded from their raw bytes, CRLF included)
+FORMAT_VERSION = 3
+MAGIC = b'TXRP'
+HEADER = struct.Struct('<4sHI')         # magic, format version, field count
+FIELD = struct.Struct('<H?QQ')          # name length, is_json, offset, length
+
+def parser_version(engine='scan'):
+    # Hash of the format version and the parser and document model sources,
+    # so any edit to them invalidates every cached document without a manual
+    # version bump
+    digest = hashlib.sha256(f'{engine}\0{FORMAT_VERSION}'.encode('utf-8'))
+    for module in (Latex_Parser, document_model):
+        with open(module.__file__, 'rb') as source_file:
+            digest.update(b'\0' + source_file.read())
+    return digest.hexdigest()[:16]
+
+def encode_document(json_object):
+    # Layout: header, one index entry + name per field, then each field's
+    # value zlib-compressed (utf-8 text, or JSON for non-string values)
+    names = []
+    blobs = []
+    for name, value in json_object.items():
+        is_json = not isinstance(value, str)
+        text = json.dumps(value) if is_json else value
+        names.append((name.encode('utf-8'), is_json))
+        blobs.append(zlib.compress(text.encode('utf-8')))
+
+    index_size = HEADER.size + sum(FIELD.size + len(name) for name, _ in names)
+    parts = [HEADER.pack(MAGIC, FORMAT_VERSION, len(names))]
+    offset = index_size
+    for (name, is_json), blob in zip(names, blobs):
+        parts.append(FIELD.pack(len(name), is_json, offset, len(blob)))
+        parts.append(name)
+        offset += len(blob)
+    parts.extend(blobs)
+    return b''.join(parts)
+
+def read_index(parsed_file):
+    magic, version, n_fields = HEADER.unpack(parsed_file.read(HEADER.size))
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError(f"{parsed_file.name} is not a parsed document of format {FORMAT_VERSION}")
+    index = {}
+    for _ in range(n_fields):
+        name_length, is_json, offset, length = FIELD.unpack(parsed_file.read(FIELD.size))
+        index[parsed_file.read(name_length).decode('utf-8')] = (is_json, offset, length)
+    return index
+
+def write_document(path, json_object):
+    # Written under a unique name and renamed, so concurrent writers (parser
+    # workers) never expose a partial file
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as parsed_file:
+        parsed_file.write(encode_document(json_object))
+    os.replace(tmp_path, path)
+
+class ParsedDocument(MutableMapping):
+    # Dict view of a cached LatexDocument.to_record(). Only the field index
+    # is read on open; a field is read and decompressed the first time it is
+    # accessed. Assigned keys (Source, Member) live in memory only.
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as parsed_file:
+            self._index = read_index(parsed_file)
+        self._values = {}
+
+    def __getitem__(self, name):
+        if name in self._values:
+            return self._values[name]
+        is_json, offset, length = self._index[name]
+        with open(self.path, 'rb') as parsed_file:
+            parsed_file.seek(offset)
+            text = zlib.decompress(parsed_file.read(length)).decode('utf-8')
+        value = json.loads(text) if is_json else text
+        self._values[name] = value
+        return value
+
+    def __setitem__(self, name, value):
+        self._values[name] = value
+
+    def __delitem__(self, name):
+        found = name in self._values or name in self._index
+        self._values.pop(name, None)
+        self._index.pop(name, None)
+        if not found:
+            raise KeyError(name)
+
+    def __iter__(self):
+        yield from self._index
+        for name in self._values:
+            if name not in self._index:
+                yield name
+
+    def __len__(self):
+        return len(self._index) + sum(1 for name in self._values if name not in self._index)
+
+    def __reduce__(self):
+        # Worker processes and pickle get a plain dict
+        return (dict, (dict(self),))
+
+class ParsedDocumentCache:
+    # Parsed documents on disk, one file per (parser version, source hash)
+    # under cache_dir/<engine>/<parser version>/. Directories of older parser
+    # versions of the same engine are removed on open; each engine has its
+    # own directory, so processes parsing with different engines can share
+    # cache_dir.
+    def __init__(self, cache_dir, engine='scan'):
+        self.cache_dir = cache_dir
+        self.engine = engine
+        self.version = parser_version(engine)
+        self.engine_dir = os.path.join(cache_dir, engine)
+        self.version_dir = os.path.join(self.engine_dir, self.version)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.version_dir, exist_ok=True)
+        self.prune()
+
+    def path(self, digest):
+        return os.path.join(self.version_dir, digest + '.tdoc')
+
+    @staticmethod
+    def _remove_dir(path):
+        for file_name in os.listdir(path):
+            os.remove(os.path.join(path, file_name))
+        os.rmdir(path)
+
+    def prune(self):
+        for name in os.listdir(self.engine_dir):
+            path = os.path.join(self.engine_dir, name)
+            if name != self.version and os.path.isdir(path):
+                self._remove_dir(path)
+        # cache_dir/<parser version>/ directories of the layout before
+        # engines had their own directory
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if os.path.isdir(path) and any(file_name.endswith('.tdoc') for file_name in os.listdir(path)):
+                self._remove_dir(path)
+
+    def get(self, digest):
+        path = self.path(digest)
+        try:
+            document = ParsedDocument(path)
+        except (OSError, ValueError, struct.error):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return document
+
+    def put(self, digest, json_object):
+        write_document(self.path(digest), json_object)
+
+    def clear(self):
+        for file_name in os.listdir(self.version_dir):
+            os.remove(os.path.join(self.version_dir, file_name))
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "entries": len(os.listdir(self.version_dir))}
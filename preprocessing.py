@@ -1,81 +1,188 @@
+import os
+import glob
 import zipfile
-import json
-from Latex_Parser import create_json_object
-
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_text_splitters import (
-    Language,
-    RecursiveCharacterTextSplitter,
-)
-
-from langchain.embeddings.base import Embeddings
-from sentence_transformers import SentenceTransformer
-from typing import List
-
-def process_latex_file(file_path):
-    latex_code = ""
-    
-    if zipfile.is_zipfile(file_path):
-        with zipfile.ZipFile(file_path, 'r') as zip_ref:
-            for file_name in zip_ref.namelist():
-                if file_name.endswith('.tex'):
-                    with zip_ref.open(file_name) as tex_file:
-                        latex_code = tex_file.read().decode('utf-8')
-                    break
-    else:
-        with open(file_path, 'r', encoding='utf-8') as tex_file:
-            latex_code = tex_file.read()
-
-    # Preprocess the LaTeX code and create the JSON object
-    json_object = create_json_object(latex_code)
-    
-    return json_object
-
-
-def textSplitter_latex(data, chunk_size=1000, chunk_overlap=50):
-    latex_splitter = RecursiveCharacterTextSplitter.from_language(
-        language=Language.MARKDOWN, chunk_size=chunk_size, chunk_overlap=chunk_overlap
-    )
-    latex_data = json.dumps(data["Content"], indent=4)
-    latex_docs = latex_splitter.create_documents([latex_data])
-
-    text_splitter = RecursiveCharacterTextSplitter(
-        separators=[',\n  ', ',\\n  '], 
-        chunk_size=10,
-        chunk_overlap=0,
-        length_function=len,
-        is_separator_regex=False,
-    )
-
-    equations_data = json.dumps(data["Equations"])
-    equations = text_splitter.create_documents([equations_data])
-
-    table_data = json.dumps(data["Tables"], indent=4)
-    tables = text_splitter.create_documents([table_data])
-
-    image_captions_data = json.dumps(data["Image Captions"], indent=4)
-    captions = text_splitter.create_documents([image_captions_data])
-
-    title_data = json.dumps(data["Title"], indent=4)
-    title = text_splitter.create_documents(["title " + title_data])
-
-    author_data = json.dumps(data["Author"], indent=4)
-    author = text_splitter.create_documents(["author " + author_data])
-
-    date_data = json.dumps(data["Date"], indent=4)
-    date = text_splitter.create_documents(["date " + date_data])
-
-    chunks = latex_docs + equations + tables + captions + title + author + date
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from Latex_Parser import parse_latex_document
+from document_model import LatexDocument
+from latex_chunker import chunk_document
+from latex_stream import iter_latex_parts
+
+from langchain_core.embeddings import Embeddings
+from typing import List, Optional
+import numpy as np
+from embedding_cache import EmbeddingCache
+from parsed_cache import write_document
+import instrumentation
+from instrumentation import traced, count
+
+# Corpus ingestion: a source is a (path, member) pair, member is the name of
+# the .tex file inside a zip archive or None for a plain .tex file.
+def iter_latex_sources(paths):
+    if isinstance(paths, str):
+        paths = [paths]
+
+    for path in paths:
+        if isinstance(path, tuple):
+            yield path
+        elif os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for file_name in sorted(files):
+                    if file_name.endswith(('.tex', '.zip')):
+                        yield from iter_latex_sources(os.path.join(root, file_name))
+        elif glob.has_magic(path):
+            yield from iter_latex_sources(sorted(glob.glob(path, recursive=True)))
+        elif zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path, 'r') as zip_ref:
+                for file_name in zip_ref.namelist():
+                    if file_name.endswith('.tex'):
+                        yield (path, file_name)
+        elif path.endswith('.tex'):
+            yield (path, None)
+
+def source_id(source):
+    path, member = source
+    return path if member is None else f"{path}::{member}"
+
+def read_latex_bytes(source):
+    path, member = source
+    if member is None:
+        with open(path, 'rb') as tex_file:
+            return tex_file.read()
+    with zipfile.ZipFile(path, 'r') as zip_ref:
+        with zip_ref.open(member) as tex_file:
+            return tex_file.read()
+
+def read_latex_source(source):
+    # Decoded from the raw bytes, line endings included, so byte offsets
+    # computed on the text slice the source file
+    return read_latex_bytes(source).decode('utf-8')
+
+def hash_latex_source(source):
+    return hashlib.sha256(read_latex_bytes(source)).hexdigest()
+
+def parse_latex_source(source, collect_metrics=False, cache_path=None):
+    # Workers run in other processes, their metrics travel back with the
+    # document and are merged by process_latex_corpus. With cache_path the
+    # parsed document is also written to the parsed-document cache.
+    if collect_metrics:
+        instrumentation.enable()
+        instrumentation.reset()
+    document = parse_latex_document(read_latex_source(source))
+    if cache_path:
+        write_document(cache_path, document.to_record())
+    document.source, document.member = source
+    metrics = instrumentation.snapshot() if collect_metrics else None
+    return document, metrics
+
+def collect_parsed(future):
+    document, metrics = future.result()
+    if metrics:
+        instrumentation.merge(metrics)
+    return document
+
+def process_latex_corpus(paths, max_workers=None, max_pending=None, cache=None, source_hashes=None):
+    # Yields parsed LatexDocuments as soon as each one finishes. At most
+    # max_pending documents are in flight so memory stays bounded.
+    # With a ParsedDocumentCache, sources whose content hash is cached are
+    # served from disk without a worker; source_hashes (source_id -> hash)
+    # avoids hashing sources again.
+    max_workers = max_workers or os.cpu_count() or 1
+    max_pending = max_pending or 2 * max_workers
+    sources = iter_latex_sources(paths)
+    source_hashes = source_hashes or {}
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        for source in sources:
+            cache_path = None
+            if cache is not None:
+                digest = source_hashes.get(source_id(source)) or hash_latex_source(source)
+                record = cache.get(digest)
+                if record is not None:
+                    count("parsed_cache_hits")
+                    document = LatexDocument.from_record(record)
+                    document.source, document.member = source
+                    yield document
+                    continue
+                count("parsed_cache_misses")
+                cache_path = cache.path(digest)
+            pending.add(executor.submit(parse_latex_source, source, instrumentation.enabled(), cache_path))
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield collect_parsed(future)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield collect_parsed(future)
+
+
+@traced("chunk")
+def textSplitter_latex(document, chunk_size=1000, chunk_overlap=50, length_function=len):
+    # Chunks a LatexDocument along its sections and environments, see
+    # latex_chunker.py. chunk_size is measured with length_function.
+    chunks = chunk_document(document, chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                            length_function=length_function)
+    count("chunks", len(chunks))
     return chunks
 
+def stream_latex_chunks(source, chunk_size=1000, chunk_overlap=50, length_function=len, max_part_bytes=1 << 20):
+    # Chunks of a source parsed part by part with its \input / \include
+    # files, see latex_stream.py. A generator, the source is never held in
+    # memory as a whole.
+    for part in iter_latex_parts(source, max_part_bytes=max_part_bytes):
+        yield from textSplitter_latex(part, chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                                      length_function=length_function)
+
 
 class SentenceTransformerEmbeddings(Embeddings):
-    def __init__(self, model_name: str):
+    def __init__(self, model_name: str, cache_dir: Optional[str] = None, cache_size: int = 100000,
+                 batch_size: int = 32, num_threads: Optional[int] = None):
+        # sentence_transformers pulls in torch, imported only once a model is
+        # loaded so parsing and chunking stay light
+        from sentence_transformers import SentenceTransformer
+        self.model_name = model_name
         self.model = SentenceTransformer(model_name, trust_remote_code=True)
-
-    def embed_documents(self, documents: List[str]) -> List[List[float]]:
-        return self.model.encode(documents)
-
-    def embed_query(self, query: str) -> List[float]:
-        return self.model.encode([query])[0]
-
+        self.batch_size = batch_size
+        if num_threads:
+            import torch
+            torch.set_num_threads(num_threads)
+        self.cache = None
+        if cache_dir:
+            dim = self.model.get_sentence_embedding_dimension()
+            self.cache = EmbeddingCache(cache_dir, model_name, dim, max_entries=cache_size)
+
+    @traced("embed.encode")
+    def encode(self, texts: List[str]) -> np.ndarray:
+        # SentenceTransformer.encode already sorts its inputs by length before
+        # batching, so short equation chunks are not padded to the length of
+        # prose chunks. Returned as one float32 array in input order.
+        if not texts:
+            return np.empty((0, self.model.get_sentence_embedding_dimension()), dtype=np.float32)
+        count("embedded_texts", len(texts))
+        vectors = self.model.encode(texts, batch_size=self.batch_size, convert_to_numpy=True)
+        return np.ascontiguousarray(vectors, dtype=np.float32)
+
+    @traced("embed")
+    def embed_documents(self, documents: List[str]) -> np.ndarray:
+        if self.cache is None:
+            return self.encode(documents)
+
+        # Only cache misses are sent to the model, duplicates are encoded once
+        vectors, missing = self.cache.get_many(documents)
+        count("embedding_cache_hits", len(documents) - len(missing))
+        count("embedding_cache_misses", len(missing))
+        if missing:
+            missing_texts = list(dict.fromkeys(documents[i] for i in missing))
+            encoded = self.encode(missing_texts)
+            self.cache.put_many(missing_texts, encoded)
+            rows = {text: row for text, row in zip(missing_texts, encoded)}
+            for i in missing:
+                vectors[i] = rows[documents[i]]
+        return vectors
+
+    @traced("embed_query")
+    def embed_query(self, query: str) -> np.ndarray:
+        return self.encode([query])[0]
@@ -0,0 +1,338 @@
+# Asyncio HTTP query API next to the Streamlit app.
+#
+#   python query_service.py --port 8080
+#   curl -s localhost:8080/answer -d '{"query": "What is a random variable?", "k": 3}'
+#
+# POST (JSON body) or GET (query string) on /retrieve and /answer, GET on
+# /health and /metrics. Query embeddings of concurrent requests are
+# micro-batched into one encode call, identical in-flight requests share one
+# retrieval/generation, and at most max_generations LLM calls run at once.
+# --stub-llm and --stub-embeddings swap in the offline benchmark stubs so the
+# service can be load tested with benchmarks/query_load.py.
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from aiohttp import web
+
+import instrumentation
+from instrumentation import span, count
+from keyword_index import KeywordIndex, hybrid_documents
+from context_assembly import assemble
+
+class QueryEmbeddingBatcher:
+    # Collects queries for up to max_wait seconds (or max_batch queries) and
+    # embeds them with one embed_documents call on a dedicated thread. While
+    # a batch is being encoded the next one fills up.
+    def __init__(self, embeddings, max_batch=32, max_wait=0.002):
+        self.embeddings = embeddings
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embed")
+        self._queue = None
+        self._task = None
+
+    async def embed(self, text):
+        loop = asyncio.get_running_loop()
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = loop.create_task(self._run())
+        future = loop.create_future()
+        await self._queue.put((text, future))
+        return await future
+
+    async def _next_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            texts = list(dict.fromkeys(text for text, _ in batch))
+            try:
+                with span("service.embed", queries=len(batch), texts=len(texts)):
+                    vectors = await loop.run_in_executor(self._executor, self.embeddings.embed_documents, texts)
+            except Exception as exc:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+                continue
+            count("service_embed_batches")
+            index = {text: i for i, text in enumerate(texts)}
+            for text, future in batch:
+                if not future.done():
+                    future.set_result(np.asarray(vectors[index[text]], dtype=np.float32))
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        self._executor.shutdown(wait=False)
+
+class Coalescer:
+    # Requests with the same key while one is in flight await the same task.
+    # The task is shielded, a client that disconnects does not cancel it for
+    # the others.
+    def __init__(self):
+        self._inflight = {}
+
+    async def run(self, key, factory):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            count("service_coalesced")
+        return await asyncio.shield(task)
+
+    def __len__(self):
+        return len(self._inflight)
+
+class QueryService:
+    # With version_fn (the index version) and open_index (returns a fresh
+    # store and keyword index), the store and keyword index are reopened
+    # whenever the version changes, e.g. after ingest.py updated the index
+    # from another process. Requests wait for the reopen, so none is served
+    # from an index older than the version it saw. store may then be None,
+    # the index is opened here.
+    def __init__(self, embeddings, store, llm, prompt, clean=None, k=3, max_batch=32, max_wait=0.002,
+                 max_generations=2, answer_cache=None, keyword_index=None, fetch_k=None, token_budget=None,
+                 duplicate_threshold=0.8, version_fn=None, open_index=None):
+        self.store = store
+        self.token_budget = token_budget
+        self.duplicate_threshold = duplicate_threshold
+        self.keyword_index = keyword_index
+        self.fetch_k = fetch_k
+        self.llm = llm
+        self.prompt = prompt
+        self.clean = clean or (lambda text: text)
+        self.k = k
+        self.answer_cache = answer_cache
+        self.batcher = QueryEmbeddingBatcher(embeddings, max_batch=max_batch, max_wait=max_wait)
+        self.coalescer = Coalescer()
+        self.max_generations = max_generations
+        self._generations = None
+        self.version_fn = version_fn if open_index is not None else None
+        self.open_index = open_index
+        # Read before opening, a change while opening is picked up next time
+        self._index_version = self.version_fn() if self.version_fn else None
+        if store is None and open_index is not None:
+            self.store, self.keyword_index = open_index()
+        self._reopen_version = self._index_version
+        self._reopen_task = None
+
+    async def _reopen(self, version):
+        loop = asyncio.get_running_loop()
+        try:
+            with span("service.reopen_index"):
+                store, keyword_index = await loop.run_in_executor(None, self.open_index)
+        except Exception:
+            # e.g. a rebuild that has not written the index yet, keep serving
+            # the open one until the version changes again
+            count("service_reopen_failures")
+            return
+        self.store = store
+        self.keyword_index = keyword_index
+        self._index_version = version
+        count("service_index_reopens")
+
+    async def _check_index(self):
+        if self.version_fn is None:
+            return
+        version = self.version_fn()
+        if version == self._index_version:
+            return
+        if version != self._reopen_version:
+            self._reopen_version = version
+            self._reopen_task = asyncio.ensure_future(self._reopen(version))
+        if self._reopen_task is not None:
+            await asyncio.shield(self._reopen_task)
+
+    def _search(self, query, vector, k):
+        if self.keyword_index is None:
+            return self.store.similarity_search_by_vector(vector, k)
+        return hybrid_documents(self.keyword_index, query, k,
+                                lambda n: self.store.similarity_search_by_vector(vector, n), fetch_k=self.fetch_k)
+
+    async def _documents(self, query, vector, k):
+        loop = asyncio.get_running_loop()
+        with span("retrieve", k=k):
+            return await loop.run_in_executor(None, self._search, query, vector, k)
+
+    async def _retrieve(self, query, k):
+        await self._check_index()
+        # Label references that fill k need no embedding at all
+        if self.keyword_index is not None and len(self.keyword_index.references(query)) >= k:
+            docs = await self._documents(query, None, k)
+        else:
+            docs = await self._documents(query, await self.batcher.embed(query), k)
+        return {"documents": [{"text": doc.page_content, "metadata": doc.metadata} for doc in docs]}
+
+    async def _answer(self, query, k):
+        await self._check_index()
+        vector = await self.batcher.embed(query)
+        if self.answer_cache is not None:
+            cached = self.answer_cache.lookup(query, namespace=k, vector=vector)
+            if cached is not None:
+                return cached
+
+        docs = await self._documents(query, vector, k)
+        if self.token_budget is not None:
+            docs, _ = assemble(docs, token_budget=self.token_budget, duplicate_threshold=self.duplicate_threshold)
+        context = "\n\n".join(doc.page_content for doc in docs)
+        prompt = self.prompt.format(context=context, question=query)
+        if self._generations is None:
+            self._generations = asyncio.Semaphore(self.max_generations)
+        async with self._generations:
+            with span("generate"):
+                text = await self.llm.ainvoke(prompt)
+        output = {
+            "output": self.clean(text),
+            "source_documents": [self.clean(doc.page_content) for doc in docs],
+        }
+        if self.answer_cache is not None:
+            self.answer_cache.store(query, output, namespace=k, vector=vector)
+        return output
+
+    async def retrieve(self, query, k=None):
+        k = k or self.k
+        count("service_retrieve_requests")
+        return await self.coalescer.run(("retrieve", query, k), lambda: self._retrieve(query, k))
+
+    async def answer(self, query, k=None):
+        k = k or self.k
+        count("queries")
+        return await self.coalescer.run(("answer", query, k), lambda: self._answer(query, k))
+
+    def close(self):
+        self.batcher.close()
+
+async def read_request(request):
+    params = dict(request.query)
+    if request.method == "POST" and request.can_read_body:
+        try:
+            params.update(await request.json())
+        except ValueError:
+            raise web.HTTPBadRequest(text="body must be JSON")
+    query = str(params.get("query", "")).strip()
+    if not query:
+        raise web.HTTPBadRequest(text="missing query")
+    k = params.get("k")
+    if k is None or k == "":
+        return query, None
+    # JSON booleans and floats are not counts, query strings arrive as text
+    if isinstance(k, bool) or not isinstance(k, (int, str)):
+        raise web.HTTPBadRequest(text="k must be a positive integer")
+    try:
+        k = int(k)
+    except ValueError:
+        raise web.HTTPBadRequest(text="k must be a positive integer")
+    if k < 1:
+        raise web.HTTPBadRequest(text="k must be a positive integer")
+    return query, k
+
+def make_app(service):
+    async def retrieve(request):
+        query, k = await read_request(request)
+        return web.json_response(await service.retrieve(query, k))
+
+    async def answer(request):
+        query, k = await read_request(request)
+        return web.json_response(await service.answer(query, k))
+
+    async def health(request):
+        return web.json_response({"status": "ok", "inflight": len(service.coalescer)})
+
+    async def metrics(request):
+        return web.Response(text=instrumentation.render_prometheus(), content_type="text/plain")
+
+    async def on_cleanup(app):
+        service.close()
+
+    app = web.Application()
+    app.router.add_route("*", "/retrieve", retrieve)
+    app.router.add_route("*", "/answer", answer)
+    app.router.add_get("/health", health)
+    app.router.add_get("/metrics", metrics)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+def build_service(args):
+    # The app's models, store and prompt, or the offline stubs
+    import main
+
+    if args.stub_embeddings:
+        from benchmarks.stubs import HashEmbeddings
+        embeddings = HashEmbeddings()
+    else:
+        embeddings = main.get_embeddings_model()
+    if args.stub_llm:
+        from benchmarks.stubs import EchoLLM
+        llm = EchoLLM(latency=args.stub_latency)
+    else:
+        llm = main.get_llm()
+
+    if args.stub_embeddings:
+        # The index was built with the real model, query a synthetic one
+        from benchmarks.stubs import synthetic_store
+        store = synthetic_store(embeddings)
+        answer_cache = None
+        keyword_index = None
+        version_fn = open_index = None
+    else:
+        def open_index():
+            keyword_index = KeywordIndex.load(main.keyword_index_path) if main.hybrid_search else None
+            return main.open_vector_store(args.backend), keyword_index
+
+        store = keyword_index = None
+        version_fn = main.index_version
+        answer_cache = main.get_answer_cache()
+
+    return QueryService(embeddings, store, llm, main.qa_prompt, clean=main.clean_output, k=args.k,
+                        max_batch=args.max_batch, max_wait=args.max_wait / 1000,
+                        max_generations=args.max_generations,
+                        answer_cache=None if args.no_answer_cache else answer_cache,
+                        keyword_index=keyword_index, fetch_k=main.hybrid_fetch_k,
+                        token_budget=main.context_token_budget,
+                        duplicate_threshold=main.context_duplicate_threshold, version_fn=version_fn,
+                        open_index=open_index)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--backend", default=None, help="redis or numpy, defaults to TEXRAG_VECTOR_BACKEND")
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--max-batch", type=int, default=32, help="queries per embedding call")
+    parser.add_argument("--max-wait", type=float, default=2.0, help="ms to wait for a batch to fill")
+    parser.add_argument("--max-generations", type=int, default=2, help="concurrent LLM calls")
+    parser.add_argument("--no-answer-cache", action="store_true")
+    parser.add_argument("--stub-llm", action="store_true", help="echo LLM instead of Ollama")
+    parser.add_argument("--stub-latency", type=float, default=0.05, help="seconds per stub LLM call")
+    parser.add_argument("--stub-embeddings", action="store_true",
+                        help="hash embeddings over a synthetic in-memory index")
+    args = parser.parse_args(argv)
+
+    if args.backend is None:
+        import indexer
+        args.backend = indexer.vector_backend
+    instrumentation.enable()
+    web.run_app(make_app(build_service(args)), host=args.host, port=args.port)
+
+if __name__ == "__main__":
+    main()
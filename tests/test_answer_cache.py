@@ -0,0 +1,97 @@
+import numpy as np
+
+import answer_cache
+from answer_cache import SemanticAnswerCache
+
+class FakeEmbeddings:
+    # One orthogonal direction per known query
+    def __init__(self, queries):
+        self.vectors = {}
+        for i, query in enumerate(queries):
+            vector = np.zeros(len(queries), dtype=np.float32)
+            vector[i] = 1.0
+            self.vectors[query] = vector
+
+    def embed_query(self, query):
+        return self.vectors[query]
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+QUERIES = ['q0', 'q1', 'q2', 'q3']
+
+def test_similar_query_hits_and_namespace_is_respected():
+    embeddings = FakeEmbeddings(QUERIES)
+    cache = SemanticAnswerCache(embeddings, threshold=0.9, max_entries=4)
+    cache.store('q0', 'a0', namespace='k=4')
+    similar = np.array([1.0, 0.2, 0.0, 0.0], dtype=np.float32)
+    assert cache.lookup('q0 again', namespace='k=4', vector=similar) == 'a0'
+    assert cache.lookup('q0', namespace='k=8') is None
+    assert cache.lookup('q1', namespace='k=4') is None
+    assert cache.stats() == {'entries': 1, 'hits': 1, 'misses': 2}
+
+def test_entries_expire_after_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(answer_cache.time, 'time', clock)
+    cache = SemanticAnswerCache(FakeEmbeddings(QUERIES), max_entries=4, ttl=60)
+    cache.store('q0', 'a0')
+    clock.now += 30
+    cache.store('q1', 'a1')
+    clock.now += 30
+    assert cache.lookup('q0') == 'a0'
+    clock.now += 1
+    # q0 is 61 seconds old, a hit does not refresh its age
+    assert cache.lookup('q0') is None
+    assert cache.lookup('q1') == 'a1'
+    assert len(cache) == 1
+    clock.now += 30
+    assert cache.lookup('q1') is None
+    assert len(cache) == 0
+
+def test_least_recently_used_entry_is_evicted():
+    cache = SemanticAnswerCache(FakeEmbeddings(QUERIES), max_entries=3)
+    for i in range(3):
+        cache.store(f'q{i}', f'a{i}')
+    assert cache.lookup('q0') == 'a0'
+    cache.store('q3', 'a3')
+    assert len(cache) == 3
+    assert cache.lookup('q1') is None
+    assert [cache.lookup(query) for query in ('q0', 'q2', 'q3')] == ['a0', 'a2', 'a3']
+
+    # The freed slot is reused without leaving the old vector behind
+    cache.store('q1', 'a1')
+    assert cache.lookup('q1') == 'a1'
+    assert cache.lookup('q0') is None
+
+def test_version_change_drops_all_entries():
+    version = {'value': 1}
+    cache = SemanticAnswerCache(FakeEmbeddings(QUERIES), max_entries=4,
+                                version_fn=lambda: version['value'])
+    cache.store('q0', 'a0')
+    cache.store('q1', 'a1')
+    assert cache.lookup('q0') == 'a0'
+
+    version['value'] = 2
+    assert cache.lookup('q0') is None
+    assert len(cache) == 0
+    cache.store('q0', 'new a0')
+    assert cache.lookup('q0') == 'new a0'
+    assert cache.lookup('q1') is None
+
+    # An unchanged version keeps the entries
+    assert cache.lookup('q0') == 'new a0'
+    assert len(cache) == 1
+
+def test_invalidate_empties_the_cache():
+    cache = SemanticAnswerCache(FakeEmbeddings(QUERIES), max_entries=2)
+    cache.store('q0', 'a0')
+    cache.store('q1', 'a1')
+    cache.invalidate()
+    assert len(cache) == 0
+    cache.store('q2', 'a2')
+    cache.store('q3', 'a3')
+    assert [cache.lookup(query) for query in QUERIES] == [None, None, 'a2', 'a3']
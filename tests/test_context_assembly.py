@@ -0,0 +1,33 @@
+from langchain_core.documents import Document
+
+from context_assembly import assemble_context, estimate_tokens
+
+def content(text, start, source="notes.tex"):
+    return Document(page_content=text, metadata={"type": "content", "source": source, "byte_start": start,
+                                                 "byte_end": start + len(text.encode("utf-8"))})
+
+def test_overlapping_chunks_are_merged_exactly():
+    raw = "The variance of a random variable measures its spread around the mean value."
+    documents = [content(raw[20:60], 20), content(raw[0:30], 0)]
+    selected, stats = assemble_context(documents, token_budget=1000)
+    assert [document.page_content for document in selected] == [raw[0:60]]
+    assert selected[0].metadata["byte_end"] == 60
+    assert stats["merged"] == 1
+
+def test_truncated_head_has_matching_offsets():
+    raw = "variänce " * 400
+    documents = [content(raw[0:2000], 100), content(raw[1800:3600], 100 + len(raw[0:1800].encode("utf-8")))]
+    selected, stats = assemble_context(documents, token_budget=100)
+    document = selected[0]
+    assert estimate_tokens(document.page_content) <= 100
+    assert document.metadata["truncated"]
+    assert "merged_chunks" not in document.metadata
+    assert document.metadata["byte_start"] == 100
+    assert document.metadata["byte_end"] == 100 + len(document.page_content.encode("utf-8"))
+
+def test_truncated_listing_drops_offsets():
+    listing = Document(page_content="x = y + z " * 200,
+                       metadata={"type": "equations", "byte_start": 0, "byte_end": 50})
+    selected, _ = assemble_context([listing], token_budget=50)
+    assert "byte_start" not in selected[0].metadata
+    assert "byte_end" not in selected[0].metadata
@@ -0,0 +1,99 @@
+import os
+import sys
+import subprocess
+
+import numpy as np
+
+from embedding_cache import EmbeddingCache, text_key
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODEL = 'test-model'
+DIM = 4
+
+def vector(i):
+    return np.full(DIM, i, dtype=np.float32)
+
+def nul_terminated_texts(n):
+    # Texts whose key ends in a NUL byte, about 1 in 256
+    texts = []
+    i = 0
+    while len(texts) < n:
+        text = f'nul {i}'
+        if text_key(MODEL, text).endswith(b'\0'):
+            texts.append(text)
+        i += 1
+    return texts
+
+def test_get_many_returns_put_vectors(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), MODEL, DIM, max_entries=10)
+    cache.put_many(['a', 'b'], [vector(1), vector(2)])
+    result, missing = cache.get_many(['b', 'c', 'a'])
+    assert missing == [1]
+    assert np.array_equal(result[0], vector(2))
+    assert np.array_equal(result[2], vector(1))
+    assert not result[1].any()
+
+def test_eviction_drops_least_recently_used(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), MODEL, DIM, max_entries=10, evict_fraction=0.2)
+    texts = [f'text {i}' for i in range(10)]
+    cache.put_many(texts[:5], [vector(i) for i in range(5)])
+    cache.put_many(texts[5:], [vector(i) for i in range(5, 10)])
+    cache.get_many(texts[:5])
+    cache.put_many(['new 0', 'new 1'], [vector(10), vector(11)])
+
+    assert len(cache) == 10
+    assert cache.evictions == 2
+    result, missing = cache.get_many(texts + ['new 0', 'new 1'])
+    assert len(missing) == 2 and all(5 <= i < 10 for i in missing)
+    for i in range(12):
+        if i not in missing:
+            assert np.array_equal(result[i], vector(i))
+
+def test_keys_ending_in_nul_are_evicted_and_reloaded(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), MODEL, DIM, max_entries=10, evict_fraction=0.1)
+    nul_texts = nul_terminated_texts(3)
+    cache.put_many(nul_texts, [vector(100 + i) for i in range(3)])
+    for i in range(20):
+        cache.put_many([f'filler {i}'], [vector(i)])
+        assert len(cache) <= 10
+    # Every NUL-terminated key was evicted, none may alias a reused slot
+    result, missing = cache.get_many(nul_texts)
+    assert missing == [0, 1, 2]
+
+    cache.put_many(nul_texts, [vector(100 + i) for i in range(3)])
+    reopened = EmbeddingCache(str(tmp_path), MODEL, DIM, max_entries=10)
+    assert len(reopened) == 10
+    result, missing = reopened.get_many(nul_texts)
+    assert missing == []
+    assert np.array_equal(result, np.stack([vector(100 + i) for i in range(3)]))
+
+def test_reopen_keeps_entries(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), MODEL, DIM, max_entries=10)
+    cache.put_many(['a', 'b'], [vector(1), vector(2)])
+    reopened = EmbeddingCache(str(tmp_path), MODEL, DIM, max_entries=10)
+    result, missing = reopened.get_many(['a', 'b'])
+    assert missing == []
+    assert np.array_equal(result, np.stack([vector(1), vector(2)]))
+
+    # A different dimension or capacity starts an empty cache
+    resized = EmbeddingCache(str(tmp_path), MODEL, DIM, max_entries=20)
+    assert len(resized) == 0
+
+def test_writes_from_another_process_are_seen(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), MODEL, DIM, max_entries=10)
+    cache.put_many(['a'], [vector(1)])
+    generation = cache.generation
+
+    script = (
+        "import numpy as np\n"
+        "from embedding_cache import EmbeddingCache\n"
+        f"cache = EmbeddingCache({str(tmp_path)!r}, {MODEL!r}, {DIM}, max_entries=10)\n"
+        f"cache.put_many(['b'], [np.full({DIM}, 2, dtype=np.float32)])\n"
+    )
+    subprocess.run([sys.executable, "-c", script], check=True, cwd=REPO)
+
+    result, missing = cache.get_many(['a', 'b'])
+    assert missing == []
+    assert cache.generation > generation
+    assert np.array_equal(result[1], vector(2))
+    assert len(cache) == 2
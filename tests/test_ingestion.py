@@ -0,0 +1,133 @@
+import time
+
+import fakeredis
+import pytest
+from langchain_core.documents import Document
+
+from index_manifest import IndexManifest
+from ingestion import IngestionPipeline, RedisChunkWriter
+from benchmarks.stubs import HashEmbeddings
+
+CHUNKS_PER_DOCUMENT = 50
+
+class CountingEmbeddings(HashEmbeddings):
+    # Raises on the fail_on-th embed_documents call, once fail_when() is true
+    def __init__(self, fail_on=None, fail_when=None):
+        super().__init__(dim=8)
+        self.calls = 0
+        self.embedded = 0
+        self.fail_on = fail_on
+        self.fail_when = fail_when
+
+    def embed_documents(self, documents):
+        self.calls += 1
+        if self.calls == self.fail_on:
+            deadline = time.monotonic() + 5
+            while self.fail_when is not None and not self.fail_when() and time.monotonic() < deadline:
+                time.sleep(0.01)
+            raise RuntimeError("embedding failed")
+        self.embedded += len(documents)
+        return super().embed_documents(documents)
+
+def chunks(doc_id):
+    return [Document(page_content=f"{doc_id} chunk {i}", metadata={"type": "content", "source": doc_id})
+            for i in range(CHUNKS_PER_DOCUMENT)]
+
+def documents(count, fail_at=None, error=RuntimeError):
+    for n in range(count):
+        if n == fail_at:
+            raise error("parse failed")
+        yield f"doc{n}", f"hash{n}", chunks(f"doc{n}")
+
+def run(client, manifest_path, embeddings, docs, manifest=None):
+    manifest = manifest or IndexManifest.load(manifest_path)
+    writer = RedisChunkWriter(client, "doc:users")
+    # The default checkpoint interval, so only the failure path saves
+    pipeline = IngestionPipeline(manifest, embeddings, writer, manifest_path, batch_size=16, writers=2)
+    return pipeline.run(docs)
+
+def assert_committed_in_redis(client, manifest):
+    for key in manifest.keys():
+        assert client.exists(f"doc:users:{key}")
+
+@pytest.mark.parametrize("error", [RuntimeError, KeyboardInterrupt])
+def test_producer_failure_checkpoints_committed_documents(tmp_path, error):
+    client = fakeredis.FakeRedis()
+    manifest_path = str(tmp_path / "manifest.json")
+    with pytest.raises(error):
+        run(client, manifest_path, CountingEmbeddings(), documents(6, fail_at=4, error=error))
+
+    manifest = IndexManifest.load(manifest_path)
+    assert sorted(manifest.documents) == ["doc0", "doc1", "doc2", "doc3"]
+    assert len(manifest.keys()) == 4 * CHUNKS_PER_DOCUMENT
+    assert_committed_in_redis(client, manifest)
+
+    # The next run only embeds the documents that were not committed
+    embeddings = CountingEmbeddings()
+    added, deleted = run(client, manifest_path, embeddings, documents(6))
+    assert (added, deleted) == (2 * CHUNKS_PER_DOCUMENT, 0)
+    assert embeddings.embedded == 2 * CHUNKS_PER_DOCUMENT
+    assert len(IndexManifest.load(manifest_path).documents) == 6
+
+def test_chunk_generator_failure_leaves_document_uncommitted(tmp_path):
+    client = fakeredis.FakeRedis()
+    manifest_path = str(tmp_path / "manifest.json")
+
+    def failing_chunks():
+        yield from chunks("doc1")[:30]
+        raise UnicodeDecodeError("utf-8", b"\xff", 0, 1, "invalid start byte")
+
+    docs = iter([("doc0", "hash0", chunks("doc0")), ("doc1", "hash1", failing_chunks())])
+    with pytest.raises(UnicodeDecodeError):
+        run(client, manifest_path, CountingEmbeddings(), docs)
+
+    manifest = IndexManifest.load(manifest_path)
+    assert sorted(manifest.documents) == ["doc0"]
+    assert_committed_in_redis(client, manifest)
+
+def test_stage_failure_checkpoints_committed_documents(tmp_path):
+    client = fakeredis.FakeRedis()
+    manifest_path = str(tmp_path / "manifest.json")
+    # 50 chunks in batches of 16 are 4 batches per document, the 10th batch
+    # belongs to the third document. It fails once the writers committed the
+    # second one, batches still queued after a failure are not written.
+    manifest = IndexManifest()
+    embeddings = CountingEmbeddings(fail_on=10, fail_when=lambda: "doc1" in manifest.documents)
+    with pytest.raises(RuntimeError, match="embedding failed"):
+        run(client, manifest_path, embeddings, documents(6), manifest=manifest)
+
+    manifest = IndexManifest.load(manifest_path)
+    assert sorted(manifest.documents) == ["doc0", "doc1"]
+    assert_committed_in_redis(client, manifest)
+
+    embeddings = CountingEmbeddings()
+    added, _ = run(client, manifest_path, embeddings, documents(6))
+    assert added == embeddings.embedded == 4 * CHUNKS_PER_DOCUMENT
+
+class CountingWriter(RedisChunkWriter):
+    def __init__(self, client, key_prefix):
+        super().__init__(client, key_prefix)
+        self.flushes = 0
+
+    def flush(self):
+        self.flushes += 1
+
+def test_unchanged_run_does_not_checkpoint(tmp_path):
+    client = fakeredis.FakeRedis()
+    manifest_path = str(tmp_path / "manifest.json")
+    run(client, manifest_path, CountingEmbeddings(), documents(3))
+    mtime = (tmp_path / "manifest.json").stat().st_mtime_ns
+
+    writer = CountingWriter(client, "doc:users")
+    pipeline = IngestionPipeline(IndexManifest.load(manifest_path), CountingEmbeddings(), writer, manifest_path)
+    assert pipeline.run(documents(3)) == (0, 0)
+    assert writer.flushes == 0
+    assert (tmp_path / "manifest.json").stat().st_mtime_ns == mtime
+
+    # Deleting the chunks of a removed source is a change
+    manifest = IndexManifest.load(manifest_path)
+    pipeline = IngestionPipeline(manifest, CountingEmbeddings(), writer, manifest_path)
+    pipeline.delete(manifest.remove_document("doc2"))
+    assert pipeline.run(documents(2)) == (0, CHUNKS_PER_DOCUMENT)
+    assert writer.flushes == 1
+    assert sorted(IndexManifest.load(manifest_path).documents) == ["doc0", "doc1"]
@@ -0,0 +1,82 @@
+import os
+import random
+
+import instrumentation
+from keyword_index import KeywordIndex, KeywordIndexWriter
+
+WORDS = ["variance", "mean", "bayes", "prior", "posterior", "random", "variable", "limit", "bound", "sample"]
+
+def chunk(rnd, n):
+    text = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(5, 30)))
+    if n % 5 == 0:
+        return f"{text} \\label{{eq:{n}}}", {"type": "equations", "labels": f"eq:{n}"}
+    return text, {"type": "content", "source": f"doc{n % 7}"}
+
+def snapshot(index):
+    documents = {key: (document.page_content, document.metadata)
+                 for key in index.documents for document in [index.document(key)]}
+    labels = {label: sorted(keys) for label, keys in index.labels.items()}
+    postings = {term: dict(keys) for term, keys in index.postings.items()}
+    return documents, labels, postings, index.total_length
+
+def test_save_and_load_round_trip(tmp_path):
+    rnd = random.Random(0)
+    path = str(tmp_path / "keyword_index")
+    index = KeywordIndex()
+    keys = [f"k{n}" for n in range(50)]
+    texts, metadatas = zip(*(chunk(rnd, n) for n in range(50)))
+    index.write(keys, list(texts), list(metadatas))
+    index.save(path)
+
+    loaded = KeywordIndex.load(path)
+    assert snapshot(loaded) == snapshot(index)
+    assert loaded.search("bayes prior", 5) == index.search("bayes prior", 5)
+    assert loaded.references("see equation (10)") == ["k10"]
+
+def test_incremental_saves_match_an_unsaved_index(tmp_path):
+    # Random writes, rewrites and deletes with a save after every step; the
+    # index reloaded from disk always equals one that was never saved
+    rnd = random.Random(1)
+    path = str(tmp_path / "keyword_index")
+    saved = KeywordIndex()
+    reference = KeywordIndex()
+    for step in range(60):
+        keys = [f"k{rnd.randrange(200)}" for _ in range(rnd.randint(1, 20))]
+        keys = list(dict.fromkeys(keys))
+        if rnd.random() < 0.3:
+            for index in (saved, reference):
+                index.delete(keys)
+        else:
+            texts, metadatas = zip(*(chunk(rnd, int(key[1:])) for key in keys))
+            for index in (saved, reference):
+                index.write(keys, list(texts), list(metadatas))
+        saved.save(path)
+        if step % 10 == 9:
+            saved = KeywordIndex.load(path)
+        assert snapshot(saved) == snapshot(reference)
+    assert snapshot(KeywordIndex.load(path)) == snapshot(reference)
+
+def test_save_writes_the_change_not_the_index(tmp_path):
+    rnd = random.Random(2)
+    path = str(tmp_path / "keyword_index")
+    index = KeywordIndex()
+    writer = KeywordIndexWriter(index, path)
+    instrumentation.enable()
+    instrumentation.reset()
+    try:
+        for batch in range(64):
+            keys = [f"b{batch}-{n}" for n in range(10)]
+            texts, metadatas = zip(*(chunk(rnd, n) for n in range(10)))
+            writer.write(keys, list(texts), list(metadatas), None)
+            writer.flush()
+        written = instrumentation.snapshot()["counters"]["keyword_index_written_bytes"]
+    finally:
+        instrumentation.disable()
+        instrumentation.reset()
+    # Segments merge like a binary counter: few segments on disk, and the
+    # chunk text is rewritten a logarithmic number of times on average
+    # instead of once per save
+    assert len(index.segments) <= 8
+    total = sum(os.path.getsize(os.path.join(path, name, "records.jsonl")) for name, _, _ in index.segments)
+    assert written <= 8 * total
+    assert len(KeywordIndex.load(path)) == 640
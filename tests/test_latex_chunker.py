@@ -0,0 +1,104 @@
+import re
+
+import pytest
+
+from latex_chunker import chunk_document
+from preprocessing import parse_latex_source
+
+SOURCE = r"""\documentclass{article}
+\title{Chunking}
+\author{Tester}
+\begin{document}
+\maketitle
+Some text before the first section, with an accent: caf\'e and café.
+
+\section{Probability}
+A random variable maps outcomes to numbers. The expected value is a weighted average of them.
+Its variance measures the spread, see \eqref{eq:var}.
+
+\begin{equation}
+\label{eq:var}
+\operatorname{Var}(X) = \mathbb{E}\left[(X - \mathbb{E}[X])^2\right] = \mathbb{E}[X^2] - \mathbb{E}[X]^2
+\end{equation}
+
+\subsection{Moments}
+The $k$-th moment is $\mathbb{E}[X^k]$ and the inline sum $\sum_{i=1}^{n} x_i^k p_i$ stays whole.
+Higher moments describe the shape of the distribution, skewness and kurtosis among them.
+
+\begin{table}
+\caption{Moments}
+\label{tab:moments}
+\begin{tabular}{ll}
+Moment & Name \\
+1 & mean \\
+2 & variance \\
+3 & skewness \\
+\end{tabular}
+\end{table}
+
+\section{Estimation}
+An estimator is a function of the sample. It is unbiased when its expected value equals the parameter.
+The sample mean is unbiased for the mean, the sample variance with $n - 1$ is unbiased for the variance.
+\end{document}
+"""
+
+def chunks_of(tmp_path, newline, chunk_size=120, chunk_overlap=20):
+    path = tmp_path / 'source.tex'
+    raw = SOURCE.replace('\n', newline).encode('utf-8')
+    path.write_bytes(raw)
+    document, _ = parse_latex_source((str(path), None))
+    return raw, chunk_document(document, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+@pytest.mark.parametrize('newline', ['\n', '\r\n'], ids=['lf', 'crlf'])
+def test_content_offsets_slice_the_source(tmp_path, newline):
+    raw, chunks = chunks_of(tmp_path, newline)
+    content = [chunk for chunk in chunks if chunk.metadata['type'] == 'content']
+    assert len(content) > 5
+    for chunk in content:
+        source = raw[chunk.metadata['byte_start']:chunk.metadata['byte_end']].decode('utf-8')
+        assert source == chunk.page_content
+
+@pytest.mark.parametrize('newline', ['\n', '\r\n'], ids=['lf', 'crlf'])
+def test_listing_offsets_cover_their_items(tmp_path, newline):
+    raw, chunks = chunks_of(tmp_path, newline)
+    listings = {(chunk.metadata['type'], chunk.metadata['section']): chunk for chunk in chunks}
+    equation = listings['equations', 'Probability'].metadata
+    assert raw[equation['byte_start']:equation['byte_end']].startswith(b'\\begin{equation}')
+    assert b'\\label{eq:var}' in raw[equation['byte_start']:equation['byte_end']]
+    inline = listings['equations', 'Estimation'].metadata
+    assert raw[inline['byte_start']:inline['byte_end']] == b'$n - 1$'
+    table = listings['table', 'Probability > Moments'].metadata
+    assert raw[table['byte_start']:table['byte_end']].startswith(b'\\begin{tabular}')
+    assert b'3 & skewness' in raw[table['byte_start']:table['byte_end']]
+
+@pytest.mark.parametrize('chunk_size', [40, 80, 120])
+def test_protected_spans_are_not_split(tmp_path, chunk_size):
+    _, chunks = chunks_of(tmp_path, '\n', chunk_size=chunk_size, chunk_overlap=0)
+    for chunk in chunks:
+        if chunk.metadata['type'] != 'content':
+            continue
+        text = chunk.page_content
+        for environment in ('equation', 'table', 'tabular'):
+            assert text.count(r'\begin{%s}' % environment) == text.count(r'\end{%s}' % environment)
+        assert len(re.findall(r'(?<!\\)\$', text)) % 2 == 0
+    # An environment longer than the budget stays in one chunk
+    assert any(r'\begin{equation}' in chunk.page_content and r'\end{equation}' in chunk.page_content
+               for chunk in chunks if chunk.metadata['type'] == 'content')
+
+def test_section_paths(tmp_path):
+    _, chunks = chunks_of(tmp_path, '\n')
+    sections = {}
+    for chunk in chunks:
+        sections.setdefault(chunk.metadata['section'], []).append(chunk)
+    assert 'Probability' in sections
+    assert 'Probability > Moments' in sections
+    assert 'Estimation' in sections
+    assert not any('estimator' in chunk.page_content for chunk in sections['Probability'])
+    assert any('unbiased' in chunk.page_content for chunk in sections['Estimation'])
+    assert any('skewness and kurtosis' in chunk.page_content for chunk in sections['Probability > Moments'])
+    table, = [chunk for chunk in chunks if chunk.metadata['type'] == 'table']
+    assert table.metadata['section'] == 'Probability > Moments'
+    assert table.metadata['labels'] == 'tab:moments'
+    equations = {chunk.metadata['section']: chunk.metadata['labels'] for chunk in chunks
+                 if chunk.metadata['type'] == 'equations'}
+    assert equations == {'Probability': 'eq:var', 'Probability > Moments': '', 'Estimation': ''}
@@ -0,0 +1,135 @@
+import glob
+import os
+import re
+
+import pytest
+
+from Latex_Parser import (MATH_ENGINES, latex_to_equations_json, extract_rows, table_records,
+                          extract_image_captions, scan_figures)
+from benchmarks.corpus import generate_latex
+
+FIXTURES = sorted(glob.glob(os.path.join(os.path.dirname(__file__), 'fixtures', 'math', '*.tex')))
+TABLE_FIXTURES = sorted(glob.glob(os.path.join(os.path.dirname(__file__), 'fixtures', 'tables', '*.tex')))
+
+def read_fixture(path):
+    with open(path, 'r', encoding='utf-8') as fixture_file:
+        return fixture_file.read()
+
+@pytest.mark.parametrize('path', FIXTURES, ids=os.path.basename)
+def test_scan_matches_pyparsing(path):
+    latex_code = read_fixture(path)
+    assert MATH_ENGINES['scan'](latex_code) == MATH_ENGINES['pyparsing'](latex_code)
+
+@pytest.mark.parametrize('path', FIXTURES, ids=os.path.basename)
+def test_equations_json_matches_pyparsing(path):
+    # latex_to_equations_json rewrites \\$ before either engine runs
+    latex_code = read_fixture(path)
+    assert latex_to_equations_json(latex_code, engine='scan') == latex_to_equations_json(latex_code,
+                                                                                        engine='pyparsing')
+
+@pytest.mark.parametrize('seed', range(3))
+def test_generated_document_matches_pyparsing(seed):
+    latex_code = generate_latex(20000, seed=seed)
+    assert latex_to_equations_json(latex_code, engine='scan') == latex_to_equations_json(latex_code,
+                                                                                        engine='pyparsing')
+
+def test_fixtures_cover_edge_cases():
+    latex_code = ''.join(read_fixture(path) for path in FIXTURES)
+    for case in ('\\$', '\t', '$$', '\\begin{eqnarray}', '\\begin{align*}', '\\['):
+        assert case in latex_code
+
+def normalize_cell(text):
+    # The scan engine strips cells, pyparsing keeps the whitespace around them
+    # and the \\ ending the last row
+    return re.sub(r'\s+', ' ', re.sub(r'\\\\\s*$', '', text)).strip()
+
+def normalize_rows(tables):
+    return {name: {normalize_cell(row_name): {normalize_cell(column): normalize_cell(cell)
+                                              for column, cell in row.items()}
+                   for row_name, row in rows.items()}
+            for name, rows in tables.items()}
+
+@pytest.mark.parametrize('path', TABLE_FIXTURES, ids=os.path.basename)
+def test_table_rows_match_pyparsing(path):
+    latex_code = read_fixture(path)
+    rows = extract_rows(latex_code, engine='scan')
+    assert rows
+    assert rows == normalize_rows(extract_rows(latex_code, engine='pyparsing'))
+
+@pytest.mark.parametrize('seed', range(3))
+def test_generated_table_rows_match_pyparsing(seed):
+    latex_code = generate_latex(20000, seed=seed)
+    assert extract_rows(latex_code, engine='scan') == normalize_rows(extract_rows(latex_code, engine='pyparsing'))
+
+def test_table_cells_are_stripped():
+    rows = extract_rows(read_fixture(os.path.join(os.path.dirname(__file__), 'fixtures', 'tables', 'moments.tex')))
+    assert rows == {'Moments of distributions_tab:moments': {
+        'row1': {'Name': 'Normal', 'Mean': '$\\mu$', 'Variance': '$\\sigma^2$'},
+        'row2': {'Name': 'Poisson', 'Mean': '$\\lambda$', 'Variance': '$\\lambda$'},
+    }}
+
+TABLE_CASES = r"""
+\begin{table*}
+\caption{Escapes}
+\label{tab:esc}
+\begin{tabular}[t]{ll}
+\toprule
+Symbol & Meaning \\[2pt]
+\midrule
+\& & ampersand \\
+$\{x\}$ & set \\ \cline{1-2}
+\begin{tabular}{c} a \\ b \end{tabular} & nested \\
+\bottomrule
+\end{tabular}
+\end{table*}
+\begin{table}\begin{tabular}{l} A \\ 1 \end{tabular}\caption{Same}\end{table}
+\begin{table}\begin{tabular}{l} B \\ 2 \end{tabular}\caption{Same}\end{table}
+"""
+
+def test_table_cells_keep_escapes_and_nested_tabulars():
+    # Cases the pyparsing engine gets wrong: a caption before the tabular,
+    # table*, booktabs rules, escaped & and braces, row spacing and nested
+    # tabulars
+    rows = extract_rows(TABLE_CASES)
+    assert rows['Escapes_tab:esc'] == {
+        'row1': {'Symbol': '\\&', 'Meaning': 'ampersand'},
+        'row2': {'Symbol': '$\\{x\\}$', 'Meaning': 'set'},
+        'row3': {'Symbol': '\\begin{tabular}{c} a \\\\ b \\end{tabular}', 'Meaning': 'nested'},
+    }
+
+def test_table_names_are_unique_and_offsets_span_the_tabular():
+    tables = table_records(TABLE_CASES)
+    assert [table.name for table in tables] == ['Escapes_tab:esc', 'Same', 'Same_3']
+    for table in tables:
+        assert TABLE_CASES.startswith('\\begin{tabular}', table.start)
+        assert TABLE_CASES[:table.end].endswith('\\end{tabular}')
+
+FIGURE_FIXTURES = sorted(glob.glob(os.path.join(os.path.dirname(__file__), 'fixtures', 'figures', '*.tex')))
+
+@pytest.mark.parametrize('path', FIGURE_FIXTURES, ids=os.path.basename)
+def test_figure_captions_match_pyparsing(path):
+    latex_code = read_fixture(path)
+    assert extract_image_captions(latex_code, engine='scan') == extract_image_captions(latex_code,
+                                                                                      engine='pyparsing')
+
+@pytest.mark.parametrize('seed', range(3))
+def test_generated_figure_captions_match_pyparsing(seed):
+    latex_code = generate_latex(20000, seed=seed)
+    assert extract_image_captions(latex_code, engine='scan') == extract_image_captions(latex_code,
+                                                                                      engine='pyparsing')
+
+def test_empty_figures_are_not_numbered():
+    figures = scan_figures(read_fixture(os.path.join(os.path.dirname(__file__), 'fixtures', 'figures', 'empty.tex')))
+    assert [(figure.key, figure.graphics, figure.captions) for figure in figures] == [
+        ('figure_1', ['after.png'], {'fig:after': 'After the empty ones'})]
+
+def test_stray_graphics_are_matched_by_file_name():
+    # pyparsing hides a.png because "a.png" occurs in data.png's figure, the
+    # scan engine only skips graphics whose file a figure includes
+    latex_code = (r'\begin{figure}\includegraphics{data.png}\caption{Data}\end{figure}'
+                  r' \includegraphics{a.png} \includegraphics{data.png}')
+    figures = scan_figures(latex_code, offset=100)
+    assert [(figure.key, figure.kind, figure.graphics) for figure in figures] == [
+        ('figure_1', 'figure', ['data.png']), ('figure_2', 'graphic', ['a.png'])]
+    assert latex_code[figures[1].start - 100:figures[1].end - 100] == r'\includegraphics{a.png}'
+    assert latex_code[figures[0].start - 100:figures[0].end - 100].endswith(r'\end{figure}')
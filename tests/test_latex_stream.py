@@ -0,0 +1,131 @@
+import pytest
+
+from latex_stream import iter_latex_parts
+from preprocessing import parse_latex_source
+
+MAIN = r"""\documentclass{article}
+\title{Streaming}
+\author{Tester}
+\begin{document}
+\maketitle
+\input{intro}
+
+\section{Results}
+The estimate in Table~\ref{tab:results} uses $\hat{\theta} = \bar{x}$ from the method.
+
+\begin{table}
+\begin{tabular}{lr}
+Run & Error \\
+A & 0.1 \\
+B & 0.2 \\
+\end{tabular}
+\caption{Results}
+\label{tab:results}
+\end{table}
+
+\include{chapters/methods}
+\section{Conclusion}
+Everything converged, the bound $\epsilon < 10^{-3}$ held in every run.
+\end{document}
+"""
+
+INTRO = r"""\section{Introduction}
+Estimating a mean from samples, a naïve estimator first.
+
+\begin{equation}
+\label{eq:mean}
+\bar{x} = \frac{1}{n} \sum_{i=1}^{n} x_i
+\end{equation}
+
+\begin{figure}
+\includegraphics{samples.png}
+\caption{Samples drawn from the model}
+\label{fig:samples}
+\end{figure}
+"""
+
+METHODS = r"""\section{Methods}
+\subsection{Estimator}
+The variance of the estimator shrinks with the sample size.
+
+\begin{equation}
+\operatorname{Var}(\bar{x}) = \frac{\sigma^2}{n}
+\end{equation}
+
+\subsection{Résumé}
+Both estimators are unbiased, $\mathbb{E}[\bar{x}] = \mu$.
+
+\begin{figure}
+\includegraphics{variance.png}
+\caption{Variance against $n$}
+\label{fig:variance}
+\end{figure}
+"""
+
+def write_project(tmp_path, newline):
+    files = {'main.tex': MAIN, 'intro.tex': INTRO, 'chapters/methods.tex': METHODS}
+    raw = {}
+    for name, text in files.items():
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        raw[str(path)] = text.replace('\n', newline).encode('utf-8')
+        path.write_bytes(raw[str(path)])
+    # The same document in one file, included text in place of the directives
+    flat = (MAIN.replace(r'\input{intro}', INTRO.rstrip('\n'))
+            .replace(r'\include{chapters/methods}', METHODS.rstrip('\n')))
+    flat_path = tmp_path / 'flat.tex'
+    raw[str(flat_path)] = flat.replace('\n', newline).encode('utf-8')
+    flat_path.write_bytes(raw[str(flat_path)])
+    return str(tmp_path / 'main.tex'), str(flat_path), raw
+
+def byte_range(document, start, end):
+    # Byte offsets in the source file of a character range of the document
+    content_start = start - document.content_start
+    content_end = end - document.content_start
+    byte_start = document.content_byte_start + len(document.content[:content_start].encode('utf-8'))
+    return byte_start, byte_start + len(document.content[content_start:content_end].encode('utf-8'))
+
+def items(documents, raw):
+    # Every parsed item, by kind, with the source bytes its offsets point at
+    found = {'equations': [], 'tables': [], 'figures': []}
+    for document in documents:
+        source = raw[document.source]
+        for equation in document.equations:
+            start, end = byte_range(document, equation.start, equation.end)
+            found['equations'].append((equation.key, equation.text, source[start:end]))
+        for table in document.tables:
+            start, end = byte_range(document, table.start, table.end)
+            found['tables'].append((table.name, table.caption, table.label, table.rows, source[start:end]))
+        for figure in document.figures:
+            start, end = byte_range(document, figure.start, figure.end)
+            found['figures'].append((figure.key, figure.graphics, figure.captions, source[start:end]))
+    return found
+
+def section_titles(documents):
+    return [section.title for document in documents for section in document.sections
+            if section.end > section.start]
+
+@pytest.mark.parametrize('newline', ['\n', '\r\n'], ids=['lf', 'crlf'])
+@pytest.mark.parametrize('max_part_bytes', [1 << 20, 64])
+def test_stream_matches_document_mode(tmp_path, newline, max_part_bytes):
+    main, flat, raw = write_project(tmp_path, newline)
+    document, _ = parse_latex_source((flat, None))
+    parts = list(iter_latex_parts((main, None), max_part_bytes=max_part_bytes))
+
+    assert {part.source for part in parts} == {main, str(tmp_path / 'intro.tex'),
+                                                str(tmp_path / 'chapters' / 'methods.tex')}
+    assert (parts[0].title, parts[0].author) == (document.title, document.author)
+    assert items(parts, raw) == items([document], raw)
+    assert section_titles(parts) == section_titles([document]) == [
+        'Introduction', 'Results', 'Methods', 'Estimator', 'Résumé', 'Conclusion']
+    keys = {kind: [item[0] for item in found] for kind, found in items(parts, raw).items()}
+    assert keys == {'equations': ['eq:mean', 'equation_2', 'equation_3', 'equation_4', 'equation_5',
+                                  'equation_6'],
+                    'tables': ['Results_tab:results'], 'figures': ['figure_1', 'figure_2']}
+
+def test_parts_slice_their_own_files(tmp_path):
+    main, _, raw = write_project(tmp_path, '\r\n')
+    for part in iter_latex_parts((main, None), max_part_bytes=64):
+        source = raw[part.source]
+        start = part.content_byte_start
+        assert source[start:start + len(part.content.encode('utf-8'))].decode('utf-8') == part.content
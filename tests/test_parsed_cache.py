@@ -0,0 +1,29 @@
+import os
+
+from parsed_cache import ParsedDocumentCache
+
+def test_engines_share_cache_dir(tmp_path):
+    cache_dir = str(tmp_path)
+    scan = ParsedDocumentCache(cache_dir, engine='scan')
+    scan.put('a' * 64, {"Title": "scan"})
+    pyparsing = ParsedDocumentCache(cache_dir, engine='pyparsing')
+    pyparsing.put('a' * 64, {"Title": "pyparsing"})
+
+    # Opening one engine's cache keeps the other's
+    scan = ParsedDocumentCache(cache_dir, engine='scan')
+    assert dict(scan.get('a' * 64)) == {"Title": "scan"}
+    assert dict(pyparsing.get('a' * 64)) == {"Title": "pyparsing"}
+
+def test_older_parser_versions_are_pruned(tmp_path):
+    cache_dir = str(tmp_path)
+    stale = tmp_path / 'scan' / '0123456789abcdef'
+    stale.mkdir(parents=True)
+    (stale / ('b' * 64 + '.tdoc')).write_bytes(b'')
+    legacy = tmp_path / 'fedcba9876543210'
+    legacy.mkdir()
+    (legacy / ('c' * 64 + '.tdoc')).write_bytes(b'')
+
+    cache = ParsedDocumentCache(cache_dir, engine='scan')
+    assert not stale.exists()
+    assert not legacy.exists()
+    assert os.listdir(tmp_path / 'scan') == [cache.version]
@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from langchain_core.prompts import PromptTemplate
+
+from query_service import QueryService, make_app
+from benchmarks.stubs import HashEmbeddings, EchoLLM, synthetic_store
+
+def service():
+    embeddings = HashEmbeddings(dim=16)
+    prompt = PromptTemplate(template="CONTEXT: {context}\n\nQUERY: {question}\n",
+                            input_variables=["context", "question"])
+    return QueryService(embeddings, synthetic_store(embeddings, size=5000), EchoLLM(), prompt, k=3)
+
+async def request(method, path, **kwargs):
+    async with TestClient(TestServer(make_app(service()))) as client:
+        response = await client.request(method, path, **kwargs)
+        return response.status, await response.text()
+
+def call(method, path, **kwargs):
+    return asyncio.run(request(method, path, **kwargs))
+
+@pytest.mark.parametrize("k", [0, -1, 2.5, "two", True, [3]])
+def test_invalid_k_is_rejected(k):
+    status, _ = call("POST", "/retrieve", json={"query": "variance", "k": k})
+    assert status == 400
+
+@pytest.mark.parametrize("k", ["0", "-2", "x"])
+def test_invalid_k_in_query_string_is_rejected(k):
+    status, _ = call("GET", "/retrieve", params={"query": "variance", "k": k})
+    assert status == 400
+
+@pytest.mark.parametrize("k,expected", [(None, 3), (2, 2), ("1", 1)])
+def test_valid_k(k, expected):
+    body = {"query": "variance"} if k is None else {"query": "variance", "k": k}
+    status, text = call("POST", "/retrieve", json=body)
+    assert status == 200
+    assert text.count('"text"') == expected
+
+def test_index_is_reopened_when_its_version_changes():
+    embeddings = HashEmbeddings(dim=16)
+    prompt = PromptTemplate(template="{context}\n{question}", input_variables=["context", "question"])
+    stores = [synthetic_store(embeddings, size=5000, seed=0), synthetic_store(embeddings, size=5000, seed=1)]
+    state = {"version": 1, "opened": 0}
+
+    def open_index():
+        state["opened"] += 1
+        return stores[state["version"] - 1], None
+
+    service = QueryService(embeddings, None, EchoLLM(), prompt, k=2, version_fn=lambda: state["version"],
+                           open_index=open_index)
+
+    async def retrieve_twice():
+        first = await service.retrieve("variance")
+        state["version"] = 2
+        second = await asyncio.gather(service.retrieve("mean"), service.retrieve("expectation"))
+        return first, second
+
+    asyncio.run(retrieve_twice())
+    assert service.store is stores[1]
+    assert state["opened"] == 2
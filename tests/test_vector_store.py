@@ -0,0 +1,162 @@
+import os
+
+import numpy as np
+
+from vector_store import NumpyVectorStore
+from benchmarks.stubs import HashEmbeddings
+
+def make_store(texts):
+    store = NumpyVectorStore(HashEmbeddings(dim=16))
+    store.add_texts(texts, [{"n": i} for i in range(len(texts))], keys=[f"k{i}" for i in range(len(texts))])
+    return store
+
+def test_save_replaces_previous_index(tmp_path):
+    path = str(tmp_path / "index")
+    make_store(["a", "b"]).save(path)
+    make_store(["a", "b", "c"]).save(path)
+    assert len(NumpyVectorStore.load(path, HashEmbeddings(dim=16))) == 3
+    assert not os.path.exists(path + ".old")
+    assert not os.path.exists(path + ".tmp")
+
+def test_interrupted_swap_restores_previous_index(tmp_path):
+    # A crash after the old index was moved aside, before the new one was
+    # moved in
+    path = str(tmp_path / "index")
+    make_store(["a", "b"]).save(path)
+    os.replace(path, path + ".old")
+    assert NumpyVectorStore.exists(path)
+    store = NumpyVectorStore.load(path, HashEmbeddings(dim=16))
+    assert list(np.asarray(store.keys)) == ["k0", "k1"]
+
+def random_vectors(rnd, n, dim=16):
+    return rnd.standard_normal((n, dim)).astype(np.float32)
+
+def brute_force(vectors_by_key, query, k):
+    keys = sorted(vectors_by_key)
+    matrix = np.stack([vectors_by_key[key] for key in keys])
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    scores = matrix @ (query / np.linalg.norm(query))
+    return [keys[i] for i in np.argsort(-scores, kind="stable")[:k]]
+
+def search_keys(store, query, k):
+    return [document.metadata["id"] for document, _ in store.similarity_search_by_vector_with_score(query, k)]
+
+def test_exact_top_k_through_writes_saves_and_reloads(tmp_path):
+    # Adds, replacements and deletes, saved (appended or compacted) and
+    # reloaded in between, always match a brute force search
+    path = str(tmp_path / "index")
+    rnd = np.random.default_rng(0)
+    expected = {}
+    store = NumpyVectorStore(HashEmbeddings(dim=16))
+    for step in range(12):
+        keys = [f"k{i}" for i in rnd.choice(300, 40, replace=False)]
+        vectors = random_vectors(rnd, len(keys))
+        store.add_texts([f"text {key}" for key in keys], [{"step": step} for _ in keys], keys=keys,
+                        embeddings=vectors)
+        expected.update(zip(keys, vectors))
+        deleted = [key for key in rnd.choice(sorted(expected), 15, replace=False)]
+        store.delete(deleted)
+        for key in deleted:
+            del expected[key]
+        assert len(store) == len(expected)
+        for query in random_vectors(rnd, 3):
+            assert search_keys(store, query, 5) == brute_force(expected, query, 5)
+        if step % 3 == 2:
+            store.save(path)
+            store = NumpyVectorStore.load(path, HashEmbeddings(dim=16))
+        elif step % 3 == 1:
+            store.save(path)
+    assert sorted(store.keys) == sorted(expected)
+    document = store.similarity_search_by_vector(expected[sorted(expected)[0]], k=1)[0]
+    assert document.metadata["id"] == sorted(expected)[0]
+    assert document.page_content == f"text {sorted(expected)[0]}"
+
+def test_k_larger_than_the_index_skips_deleted_rows():
+    store = make_store(["a", "b", "c"])
+    store.delete(["k1"])
+    assert sorted(search_keys(store, np.ones(16, dtype=np.float32), 10)) == ["k0", "k2"]
+
+def test_saves_append_only_the_changes(tmp_path):
+    import instrumentation
+    path = str(tmp_path / "index")
+    rnd = np.random.default_rng(1)
+    store = NumpyVectorStore(HashEmbeddings(dim=16))
+    instrumentation.enable()
+    instrumentation.reset()
+    try:
+        for batch in range(20):
+            keys = [f"b{batch}-{i}" for i in range(50)]
+            store.add_texts(keys, None, keys=keys, embeddings=random_vectors(rnd, 50))
+            store.save(path)
+        written = instrumentation.snapshot()["counters"]["vector_store_written_bytes"]
+    finally:
+        instrumentation.disable()
+    total = sum(os.path.getsize(os.path.join(path, name))
+                for name in ("vectors.f32", "records.jsonl", "ends.i64", "keys.txt"))
+    assert written == total
+    assert len(NumpyVectorStore.load(path, None)) == 1000
+
+def test_interrupted_append_is_ignored(tmp_path):
+    path = str(tmp_path / "index")
+    store = make_store(["a", "b"])
+    store.save(path)
+    # Bytes of a save that crashed before meta.json was replaced
+    for name in ("vectors.f32", "records.jsonl", "ends.i64", "keys.txt"):
+        with open(os.path.join(path, name), "ab") as data_file:
+            data_file.write(b"\x01" * 13)
+    store = NumpyVectorStore.load(path, HashEmbeddings(dim=16))
+    assert store.keys == ["k0", "k1"]
+    store.add_texts(["c"], [{"n": 2}], keys=["k2"])
+    store.save(path)
+    store = NumpyVectorStore.load(path, HashEmbeddings(dim=16))
+    assert store.keys == ["k0", "k1", "k2"]
+    assert [document.page_content for document in store.similarity_search("c", k=3)][0] == "c"
+
+def test_deletes_compact_the_index(tmp_path):
+    path = str(tmp_path / "index")
+    store = make_store([str(i) for i in range(10)])
+    store.save(path)
+    store.delete([f"k{i}" for i in range(6)])
+    store.save(path)
+    meta = NumpyVectorStore._read_meta(path)
+    assert meta["rows"] == 4 and meta["deleted"] is None
+    assert NumpyVectorStore.load(path, None).keys == ["k6", "k7", "k8", "k9"]
+
+def test_older_layout_counts_as_missing(tmp_path):
+    path = tmp_path / "index"
+    path.mkdir()
+    (path / "meta.json").write_text('{"version": 1, "count": 0, "dim": 0}')
+    assert not NumpyVectorStore.exists(str(path))
+
+def test_ivf_recall(tmp_path):
+    # Clustered data, as embeddings are: probing a few lists finds nearly
+    # all of the exact top 10, also for rows added after training
+    path = str(tmp_path / "index")
+    rnd = np.random.default_rng(2)
+    centers = random_vectors(rnd, 64, dim=32)
+
+    def clustered(n):
+        return centers[rnd.integers(0, len(centers), n)] + 0.3 * random_vectors(rnd, n, dim=32)
+
+    vectors = clustered(8000)
+    keys = [f"k{i}" for i in range(len(vectors))]
+    store = NumpyVectorStore(HashEmbeddings(dim=32), approximate=True, n_lists=64, nprobe=8)
+    store.add_texts(keys, None, keys=keys, embeddings=vectors)
+    store.save(path)
+    more = clustered(1000)
+    more_keys = [f"m{i}" for i in range(len(more))]
+    store = NumpyVectorStore.load(path, HashEmbeddings(dim=32), approximate=True, n_lists=64, nprobe=8)
+    store.add_texts(more_keys, None, keys=more_keys, embeddings=more)
+    store.delete(keys[:500])
+    assert store.ivf_rows == 8000
+
+    exact = NumpyVectorStore(HashEmbeddings(dim=32))
+    exact.add_texts(keys[500:] + more_keys, None, keys=keys[500:] + more_keys,
+                    embeddings=np.concatenate([vectors[500:], more]))
+    found = 0
+    queries = clustered(50)
+    for query in queries:
+        approximate = search_keys(store, query, 10)
+        assert not set(approximate) & set(keys[:500])
+        found += len(set(approximate) & set(search_keys(exact, query, 10)))
+    assert found / (10 * len(queries)) >= 0.9
@@ -0,0 +1,511 @@
+import os
+import glob
+import json
+import mmap
+import shutil
+import uuid
+from typing import Any, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from instrumentation import count
+
+STORE_VERSION = 2
+VECTORS = "vectors.f32"
+RECORDS = "records.jsonl"
+ENDS = "ends.i64"
+KEYS = "keys.txt"
+META = "meta.json"
+# save rewrites (compacts) the index once more than this fraction of its rows
+# are deleted, and retrains the IVF lists once the rows added since they were
+# trained exceed this fraction of the trained ones
+COMPACT_FRACTION = 0.5
+IVF_RETRAIN_FRACTION = 0.5
+
+def normalize_rows(vectors):
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors.reshape(1, -1)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+def top_k(scores, k):
+    if k >= len(scores):
+        return np.argsort(-scores, kind="stable")
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx], kind="stable")]
+
+def train_ivf(vectors, n_lists, n_iter=10, sample_size=100000, seed=0, block=65536):
+    # Spherical k-means: centroids and vectors are unit length, so the best
+    # list for a vector is the centroid with the largest dot product.
+    rnd = np.random.default_rng(seed)
+    count = len(vectors)
+    sample = vectors[np.sort(rnd.choice(count, min(count, sample_size), replace=False))]
+    centroids = sample[rnd.choice(len(sample), n_lists, replace=False)].copy()
+    for _ in range(n_iter):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        empty = np.bincount(assign, minlength=n_lists) == 0
+        sums[empty] = sample[rnd.choice(len(sample), int(empty.sum()))]
+        centroids = normalize_rows(sums)
+
+    assign = np.empty(count, dtype=np.int64)
+    for start in range(0, count, block):
+        assign[start:start + block] = np.argmax(vectors[start:start + block] @ centroids.T, axis=1)
+    list_ids = np.argsort(assign, kind="stable")
+    list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+    np.cumsum(np.bincount(assign, minlength=n_lists), out=list_offsets[1:])
+    return centroids, list_offsets, list_ids
+
+class NumpyVectorStore(VectorStore):
+    # In-process vector store with the same retriever interface as the Redis
+    # store. Vectors are kept unit length in a float32 matrix, so cosine
+    # similarity is a single matrix-vector product.
+    #
+    # Rows are only ever appended. The rows of the directory the store was
+    # loaded from (or last saved to) stay memory-mapped, rows added since go
+    # to a preallocated matrix that doubles when full. Deleting a key only
+    # tombstones its row, a key -> row dict (built on the first write) finds
+    # the rows to tombstone.
+    #
+    # On disk (one directory):
+    #   vectors.f32    rows x dim float32, memory-mapped on load
+    #   records.jsonl  one {"key", "text", "metadata"} line per row
+    #   ends.i64       end offset of every line in records.jsonl
+    #   keys.txt       one key per line, only read by writes
+    #   deleted-<generation>.npy   the tombstoned rows
+    #   ivf-<generation>.npz       optional IVF lists for approximate search
+    #   meta.json      row count, file sizes and the files above
+    # Loading only maps the files, records are read on demand for the hits.
+    # save appends the new rows to the first four files and then replaces
+    # meta.json, so a save costs the size of the change and a crash leaves
+    # the previous meta.json in charge (bytes past its sizes are dropped by
+    # the next save). Once too many rows are deleted the index is compacted
+    # into a new directory instead.
+
+    def __init__(self, embedding: Embeddings, approximate: bool = False, n_lists: Optional[int] = None,
+                 nprobe: int = 8):
+        self.embedding = embedding
+        self.approximate = approximate
+        self.n_lists = n_lists
+        self.nprobe = nprobe
+        self.dim = None
+        self.path = None
+        self.ivf = None  # (centroids, list offsets, list ids), over the first ivf_rows rows
+        self.ivf_rows = 0
+        self._meta = None
+        # Rows saved in path, memory-mapped
+        self._saved_rows = 0
+        self._saved_vectors = None
+        self._records_map = None
+        self._ends = None
+        # Rows added since, in memory
+        self._vectors = None
+        self._records = []
+        self._keys = None  # every row's key, read from keys.txt on the first write
+        self._rows = None  # key -> row of the live rows
+        self._deleted = set()
+        self._deleted_rows = None
+        self._ivf_changed = False
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self.embedding
+
+    @property
+    def rows(self):
+        return self._saved_rows + len(self._records)
+
+    def __len__(self):
+        return self.rows - len(self._deleted)
+
+    @property
+    def keys(self):
+        # Keys of the live rows, in row order
+        self._load_keys()
+        return [key for row, key in enumerate(self._keys) if row not in self._deleted]
+
+    ## Persistence
+    @staticmethod
+    def _backup_path(path):
+        return path.rstrip("/\\") + ".old"
+
+    @classmethod
+    def _recover(cls, path):
+        # A compaction interrupted between its two renames leaves the previous
+        # index in the backup directory only, put it back
+        backup_path = cls._backup_path(path)
+        if os.path.isdir(backup_path) and not os.path.exists(path):
+            os.replace(backup_path, path)
+
+    @staticmethod
+    def _read_meta(path):
+        try:
+            with open(os.path.join(path, META), "r", encoding="utf-8") as meta_file:
+                return json.load(meta_file)
+        except FileNotFoundError:
+            return None
+
+    @classmethod
+    def exists(cls, path):
+        # An index in an older layout counts as missing, so it is rebuilt
+        cls._recover(path)
+        meta = cls._read_meta(path)
+        return meta is not None and meta.get("version") == STORE_VERSION
+
+    @classmethod
+    def remove(cls, path):
+        for directory in (path, cls._backup_path(path)):
+            if os.path.isdir(directory):
+                shutil.rmtree(directory)
+
+    @classmethod
+    def load(cls, path, embedding, **kwargs):
+        cls._recover(path)
+        store = cls(embedding, **kwargs)
+        meta = cls._read_meta(path)
+        if meta is None:
+            raise FileNotFoundError(f"No vector store in {path}")
+        if meta["version"] != STORE_VERSION:
+            raise ValueError(f"Unsupported vector store version {meta['version']} in {path}")
+        store._open(path, meta)
+        return store
+
+    def _open(self, path, meta):
+        # Maps the rows saved in path, the rows in memory are dropped
+        self._close()
+        self.path = path
+        self._meta = meta
+        self.dim = meta["dim"] or None
+        self._saved_rows = meta["rows"]
+        self._vectors = None
+        self._records = []
+        if self._saved_rows:
+            self._saved_vectors = np.memmap(os.path.join(path, VECTORS), dtype=np.float32, mode="r",
+                                            shape=(self._saved_rows, self.dim))
+            self._ends = np.memmap(os.path.join(path, ENDS), dtype=np.int64, mode="r",
+                                   shape=(self._saved_rows,))
+            with open(os.path.join(path, RECORDS), "rb") as records_file:
+                self._records_map = mmap.mmap(records_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._deleted = set()
+        if meta["deleted"]:
+            self._deleted.update(np.load(os.path.join(path, meta["deleted"])).tolist())
+        self._deleted_rows = None
+        self.ivf = None
+        self.ivf_rows = meta["ivf_rows"]
+        if meta["ivf"]:
+            ivf = np.load(os.path.join(path, meta["ivf"]))
+            self.ivf = (ivf["centroids"], ivf["list_offsets"], ivf["list_ids"])
+        self._ivf_changed = False
+
+    def _close(self):
+        if self._records_map is not None:
+            self._records_map.close()
+        self._records_map = None
+        self._saved_vectors = None
+        self._ends = None
+
+    def _load_keys(self):
+        if self._keys is not None:
+            return
+        keys = []
+        if self._saved_rows:
+            with open(os.path.join(self.path, KEYS), "rb") as keys_file:
+                keys = keys_file.read(self._meta["keys_bytes"]).decode("utf-8").split("\n")[:self._saved_rows]
+        self._keys = keys + [record[0] for record in self._records]
+
+    def _key_rows(self):
+        if self._rows is None:
+            self._load_keys()
+            self._rows = {key: row for row, key in enumerate(self._keys) if row not in self._deleted}
+        return self._rows
+
+    def _record_line(self, row):
+        start = int(self._ends[row - 1]) if row else 0
+        return self._records_map[start:int(self._ends[row])]
+
+    def _record(self, row):
+        if row >= self._saved_rows:
+            return self._records[row - self._saved_rows]
+        data = json.loads(self._record_line(row))
+        return data["key"], data["text"], data["metadata"]
+
+    def _row_vectors(self, rows):
+        # Vectors of the given rows, rows sorted
+        split = np.searchsorted(rows, self._saved_rows)
+        parts = []
+        if split:
+            parts.append(self._saved_vectors[rows[:split]])
+        if split < len(rows):
+            parts.append(self._vectors[rows[split:] - self._saved_rows])
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def _all_vectors(self):
+        added = self._vectors[:len(self._records)] if self._records else None
+        if added is None:
+            return self._saved_vectors
+        if self._saved_vectors is None:
+            return added
+        return np.concatenate([self._saved_vectors, added])
+
+    def _deleted_array(self):
+        if self._deleted_rows is None:
+            self._deleted_rows = np.fromiter(sorted(self._deleted), dtype=np.int64, count=len(self._deleted))
+        return self._deleted_rows
+
+    def save(self, path):
+        self._recover(path)
+        meta = self._read_meta(path)
+        if (self.path != path or meta is None or meta.get("version") != STORE_VERSION
+                or meta.get("generation") != self._meta.get("generation")
+                or len(self._deleted) > COMPACT_FRACTION * self.rows):
+            self._save_compacted(path)
+        else:
+            self._save_appended(path, meta)
+
+    @staticmethod
+    def _append(path, data, size):
+        # Appends data to the file, first dropping anything past size left by
+        # an interrupted save
+        with open(path, "ab") as data_file:
+            data_file.truncate(size)
+            data_file.write(data)
+        count("vector_store_written_bytes", len(data))
+        return size + len(data)
+
+    def _save_appended(self, path, meta):
+        records = self._records
+        if records:
+            keys = "".join(key + "\n" for key, _, _ in records).encode("utf-8")
+            lines = [json.dumps({"key": key, "text": text, "metadata": metadata}).encode("utf-8") + b"\n"
+                     for key, text, metadata in records]
+            ends = meta["records_bytes"] + np.cumsum([len(line) for line in lines], dtype=np.int64)
+            rows = self.rows
+            meta = dict(meta, rows=rows, dim=self.dim)
+            meta["vectors_bytes"] = self._append(os.path.join(path, VECTORS),
+                                                 self._vectors[:len(records)].tobytes(), meta["vectors_bytes"])
+            meta["records_bytes"] = self._append(os.path.join(path, RECORDS), b"".join(lines),
+                                                 meta["records_bytes"])
+            meta["ends_bytes"] = self._append(os.path.join(path, ENDS), ends.tobytes(), meta["ends_bytes"])
+            meta["keys_bytes"] = self._append(os.path.join(path, KEYS), keys, meta["keys_bytes"])
+        self._commit(path, meta)
+
+    def _save_compacted(self, path):
+        # Writes the live rows to a sibling directory and swaps it in through
+        # a backup of the previous index, so a crash never leaves a half
+        # written index behind and at worst leaves the previous one in the
+        # backup, which exists and load restore.
+        tmp_path = path.rstrip("/\\") + ".tmp"
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        live = np.setdiff1d(np.arange(self.rows, dtype=np.int64), self._deleted_array(), assume_unique=True)
+        sizes = {"vectors_bytes": 0, "records_bytes": 0, "ends_bytes": 0, "keys_bytes": 0}
+        for start in range(0, len(live), 65536):
+            rows = live[start:start + 65536]
+            lines = []
+            keys = []
+            for row in rows.tolist():
+                if row < self._saved_rows:
+                    line = self._record_line(row)
+                    key = json.loads(line)["key"]
+                else:
+                    key, text, metadata = self._records[row - self._saved_rows]
+                    line = json.dumps({"key": key, "text": text, "metadata": metadata}).encode("utf-8") + b"\n"
+                lines.append(line)
+                keys.append(key + "\n")
+            ends = sizes["records_bytes"] + np.cumsum([len(line) for line in lines], dtype=np.int64)
+            for name, size_key, data in ((VECTORS, "vectors_bytes", self._row_vectors(rows).tobytes()),
+                                         (RECORDS, "records_bytes", b"".join(lines)),
+                                         (ENDS, "ends_bytes", ends.tobytes()),
+                                         (KEYS, "keys_bytes", "".join(keys).encode("utf-8"))):
+                sizes[size_key] = self._append(os.path.join(tmp_path, name), data, sizes[size_key])
+        meta = {"version": STORE_VERSION, "dim": self.dim or 0, "rows": len(live), "generation": 0,
+                "deleted": None, "ivf": None, "ivf_rows": 0, **sizes}
+        self._commit(tmp_path, meta, compacted=True)
+
+        self._close()
+        backup_path = self._backup_path(path)
+        if os.path.isdir(backup_path):
+            shutil.rmtree(backup_path)
+        if os.path.isdir(path):
+            os.replace(path, backup_path)
+        os.replace(tmp_path, path)
+        shutil.rmtree(backup_path, ignore_errors=True)
+        self._keys = None
+        self._rows = None
+        self._open(path, self._read_meta(path))
+
+    def _commit(self, path, meta, compacted=False):
+        # Writes the tombstones and IVF lists the new meta.json refers to,
+        # then meta.json itself, then maps the saved rows
+        generation = meta["generation"] + 1
+        meta["generation"] = generation
+        if not compacted:
+            if self._deleted:
+                meta["deleted"] = f"deleted-{generation}.npy"
+                np.save(os.path.join(path, meta["deleted"]), self._deleted_array())
+            else:
+                meta["deleted"] = None
+        rows = meta["rows"]
+        if self.approximate and rows:
+            if compacted or self.ivf is None or rows - self.ivf_rows > IVF_RETRAIN_FRACTION * self.ivf_rows:
+                vectors = np.memmap(os.path.join(path, VECTORS), dtype=np.float32, mode="r",
+                                    shape=(rows, meta["dim"]))
+                self.ivf = self._train_ivf(vectors, None if compacted else self._deleted_array())
+                self.ivf_rows = rows
+                self._ivf_changed = True
+                del vectors
+            if self._ivf_changed:
+                meta["ivf"] = f"ivf-{generation}.npz"
+                centroids, list_offsets, list_ids = self.ivf
+                np.savez(os.path.join(path, meta["ivf"]), centroids=centroids, list_offsets=list_offsets,
+                         list_ids=list_ids)
+            meta["ivf_rows"] = self.ivf_rows
+        else:
+            meta["ivf"] = None
+            meta["ivf_rows"] = 0
+
+        tmp_path = os.path.join(path, META + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(tmp_path, os.path.join(path, META))
+        for name in glob.glob(os.path.join(path, "deleted-*.npy")) + glob.glob(os.path.join(path, "ivf-*.npz")):
+            if os.path.basename(name) not in (meta["deleted"], meta["ivf"]):
+                os.remove(name)
+        if not compacted:
+            self._open(path, meta)
+
+    ## Writes
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None,
+                  embeddings: Optional[np.ndarray] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        if not texts:
+            return []
+        keys = kwargs.get("keys", kwargs.get("ids")) or [uuid.uuid4().hex for _ in texts]
+        metadatas = metadatas or [{} for _ in texts]
+        if embeddings is None:
+            embeddings = self.embedding.embed_documents(texts)
+        vectors = normalize_rows(embeddings)
+        self.dim = self.dim or vectors.shape[1]
+
+        added = len(self._records)
+        if self._vectors is None or added + len(vectors) > len(self._vectors):
+            grown = np.empty((max(1024, 2 * added, added + len(vectors)), self.dim), dtype=np.float32)
+            if added:
+                grown[:added] = self._vectors[:added]
+            self._vectors = grown
+        self._vectors[added:added + len(vectors)] = vectors
+
+        # Re-adding an existing key replaces it
+        key_rows = self._key_rows()
+        first = self.rows
+        for i, key in enumerate(keys):
+            old = key_rows.get(key)
+            if old is not None:
+                self._deleted.add(old)
+            key_rows[key] = first + i
+        self._deleted_rows = None
+        self._keys.extend(keys)
+        self._records.extend(zip(keys, texts, metadatas))
+        return list(keys)
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        if not ids or not len(self):
+            return True
+        key_rows = self._key_rows()
+        for key in ids:
+            row = key_rows.pop(key, None)
+            if row is not None:
+                self._deleted.add(row)
+                self._deleted_rows = None
+        return True
+
+    def _train_ivf(self, vectors, deleted=None, n_lists=None, n_iter=10):
+        # IVF lists over the given rows, without the deleted ones
+        live = len(vectors) - (0 if deleted is None else len(deleted))
+        n_lists = n_lists or self.n_lists or max(1, int(np.sqrt(max(live, 1))))
+        centroids, list_offsets, list_ids = train_ivf(vectors, min(n_lists, len(vectors)), n_iter=n_iter)
+        if deleted is not None and len(deleted):
+            keep = ~np.isin(list_ids, deleted)
+            lists = np.repeat(np.arange(len(centroids)), np.diff(list_offsets))[keep]
+            list_ids = list_ids[keep]
+            list_offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(lists, minlength=len(centroids)), out=list_offsets[1:])
+        return centroids, list_offsets, list_ids
+
+    def build_ivf(self, n_lists=None, n_iter=10):
+        if not len(self):
+            self.ivf = None
+            return
+        self.ivf = self._train_ivf(self._all_vectors(), self._deleted_array(), n_lists, n_iter)
+        self.ivf_rows = self.rows
+        self._ivf_changed = True
+
+    ## Search
+    def _search(self, embedding, k):
+        if not len(self):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        query = normalize_rows(embedding)[0]
+        if self.approximate and self.ivf is not None:
+            # Rows added after the lists were trained are scanned exactly
+            centroids, list_offsets, list_ids = self.ivf
+            probes = top_k(centroids @ query, self.nprobe)
+            candidates = np.sort(np.concatenate(
+                [list_ids[list_offsets[p]:list_offsets[p + 1]] for p in probes]
+                + [np.arange(self.ivf_rows, self.rows, dtype=np.int64)]))
+        else:
+            candidates = None
+        if candidates is None:
+            scores = []
+            if self._saved_vectors is not None:
+                scores.append(self._saved_vectors @ query)
+            if self._records:
+                scores.append(self._vectors[:len(self._records)] @ query)
+            scores = np.concatenate(scores)
+            if self._deleted:
+                scores[self._deleted_array()] = -np.inf
+        else:
+            if self._deleted:
+                candidates = candidates[~np.isin(candidates, self._deleted_array())]
+            scores = self._row_vectors(candidates) @ query
+        best = top_k(scores, k)[:k]
+        best = best[np.isfinite(scores[best])]
+        rows = best if candidates is None else candidates[best]
+        return rows, scores[best]
+
+    def _document(self, row):
+        key, text, metadata = self._record(int(row))
+        return Document(page_content=text, metadata={**metadata, "id": key})
+
+    def similarity_search_by_vector_with_score(self, embedding, k: int = 4) -> List[Tuple[Document, float]]:
+        rows, scores = self._search(embedding, k)
+        return [(self._document(i), float(score)) for i, score in zip(rows, scores)]
+
+    def similarity_search_by_vector(self, embedding, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(self.embedding.embed_query(query), k)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+    def _select_relevance_score_fn(self):
+        # scores are already cosine similarities
+        return lambda score: score
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None,
+                   path: Optional[str] = None, **kwargs: Any) -> "NumpyVectorStore":
+        keys = kwargs.pop("keys", kwargs.pop("ids", None))
+        store = cls(embedding, **kwargs)
+        store.add_texts(texts, metadatas, keys=keys)
+        if path:
+            store.save(path)
+        return store